@@ -2,7 +2,7 @@ import micropython
 micropython.opt_level(2)
 
 import comutils
-import blobstar, astro_sensor, time_location, captive_portal, star_finder, guider_calibration, backlash_mgr, guide_filter
+import blobstar, astro_sensor, time_location, captive_portal, star_finder, star_grid, thresh_ctrl, guider_calibration, backlash_mgr, guide_filter, frame_registration, guider_packet
 import guidepulser
 import guidestar
 import exclogger
@@ -17,7 +17,6 @@ blue_led  = pyb.LED(3)
 ir_leds   = pyb.LED(4)
 
 LOG_BUFF_LEN        = micropython.const(3)
-STAR_CNT_JSON_LIMIT = micropython.const(100)
 WIFI_HW_RETRIES     = micropython.const(5)
 
 GUIDESTATE_IDLE              = micropython.const(0)
@@ -40,18 +39,23 @@ CALIIDX_DEC = micropython.const(1)
 
 class AutoGuider(object):
 
-    def __init__(self, debug = False, simulate_file = None, simulate = False):
+    def __init__(self, debug = False, simulate_file = None, simulate = False, cam = None, offline = False):
+        # cam replaces the guide camera, offline skips the WiFi and the files on the flash, scripts/host_guider_bench.py uses both
         #gc.disable()
-        exclogger.init()
+        if offline == False:
+            exclogger.init()
         guidepulser.init()
-        self.cam = astro_sensor.AstroCam(simulate = simulate_file)
-        try:
-            self.cam.init(gain_db = 48, shutter_us = 1000000)
-        except OSError as exc:
-            exclogger.log_exception(exc)
-            guidepulser.panic(True)
-            self.cam = None
-            print("ERROR: guidecam cannot initialize, serious HW error, must reboot")
+        if cam is not None:
+            self.cam = cam
+        else:
+            self.cam = astro_sensor.AstroCam(simulate = simulate_file)
+            try:
+                self.cam.init(gain_db = 48, shutter_us = 1000000)
+            except OSError as exc:
+                exclogger.log_exception(exc)
+                guidepulser.panic(True)
+                self.cam = None
+                print("ERROR: guidecam cannot initialize, serious HW error, must reboot")
 
         self.cam_initing = 0
         self.time_mgr = time_location.TimeLocationManager()
@@ -65,6 +69,7 @@ class AutoGuider(object):
         self.selected_star = None
         self.target_coord = None
         self.origin_coord = None
+        self.virtual_star = None
         self.passive_guiding = False
 
         if simulate_file is not None or simulate:
@@ -101,6 +106,13 @@ class AutoGuider(object):
         self.dbg_t3 = 0
         self.dbg_t4 = 0
         self.hotpixels_eff = 0
+        self.roi_frm_cnt = 0
+        self.roi_expand = 0
+        self.roi_active = False
+        self.registration = None
+        self.field_rotation = 0
+        self.reg_prev_coords = None
+        self.thresh_ctrl = thresh_ctrl.ThresholdController()
         self.queue_imgsave = 0
         self.save_image_name = None
         self.save_image_dir  = None
@@ -108,26 +120,32 @@ class AutoGuider(object):
 
         self.settings = {}
         self.default_settings()
-        self.load_settings()
-        self.load_hotpixels(use_log = False, set_usage = False)
-
-        self.portal = captive_portal.CaptivePortal(debug = self.debug)
-        self.portal.allow_hw_kick = False
+        self.portal = None
+        if offline == False:
+            self.load_settings()
+            self.load_hotpixels(use_log = False, set_usage = False)
+            self.portal = captive_portal.CaptivePortal(debug = self.debug)
+            self.portal.allow_hw_kick = False
         if self.portal is not None:
             self.register_http_handlers()
 
         self.img = None
+        self.img_owned = False # True if self.img is a copy that the camera won't overwrite
         self.img_compressed = None
+        self.img_is_compressed = False
         self.extra_fb = None
         self.expo_code = 0
         self.histogram = None
         self.img_stats = None
         self.stars = None
+        self.star_grid = None
         self.prev_stars = None
         self.hotpixels = []
         self.multistar_cnt = [0, 0]
         self.zoom = 1
         self.dither_interval = 0
+        self.dither_calm = 0
+        self.dither_frames = 0
 
         self.imgstream_sock = None
         self.websock = None
@@ -135,7 +153,7 @@ class AutoGuider(object):
         self.websock_randid = 0
         self.stream_sock_err = 0
         self.session_randid = 0
-        self.need_send_stars = False
+        self.packet = guider_packet.PacketWriter()
 
         self.pulselog_buff = [[0, 0, 0, 0, 0]] * LOG_BUFF_LEN
         self.msglog_buff   = [[0, 0, None]] * LOG_BUFF_LEN
@@ -188,6 +206,15 @@ class AutoGuider(object):
         self.settings.update({"use_led"                  : True})
         self.settings.update({"fast_mode"                : True})
         self.settings.update({"always_guiding"           : False})
+        self.settings.update({"roi_mode"                 : True})
+        self.settings.update({"roi_size"                 : 160})
+        self.settings.update({"roi_full_interval"        : 10})
+        self.settings.update({"registration"             : True})
+        self.settings.update({"centroid_refine"          : False}) # off until it is timed on the camera
+        self.settings.update({"double_buffer"            : True})
+        self.settings.update({"centroid_win"             : 4})
+        self.settings.update({"auto_thresh"              : True})
+        self.settings.update({"auto_thresh_target"       : 30})
         self.advfilt_ra    .fill_settings(self.settings)
         self.advfilt_dec   .fill_settings(self.settings)
         self.preempfilt_ra .fill_settings(self.settings)
@@ -200,147 +227,45 @@ class AutoGuider(object):
             obj.update({k: self.settings[k]})
         self.send_websocket(obj)
 
-    def get_state_obj(self):
-        state = {}
-        state.update({"pkt_type"            : "state"})
-        state.update({"time"                : self.time_mgr.get_sec()})
-        state.update({"session_rand_id"     : self.session_randid})
-        state.update({"ws_rand_id"          : self.websock_randid})
-        state.update({"guide_state"         : self.guide_state})
-        state.update({"interval_state"      : self.intervalometer_state})
-        state.update({"blub_remaining"      : guidepulser.shutter_remaining()})
-        state.update({"dither_interval"     : self.dither_interval})
+    def get_expo_code(self):
         if self.cam.check_init() == False:
-            state.update({"expo_code": star_finder.EXPO_NOT_READY})
+            return star_finder.EXPO_NOT_READY
         elif self.img is not None and self.cam_err <= 0:
-            state.update({"expo_code": self.expo_code})
+            return self.expo_code
         elif self.img is None:
-            state.update({"expo_code": star_finder.EXPO_NO_IMG})
+            return star_finder.EXPO_NO_IMG
         elif self.cam_err > 0:
-            state.update({"expo_code": star_finder.EXPO_CAMERA_ERR})
-        else:
-            state.update({"expo_code": self.expo_code})
-        if self.img_stats is not None:
-            state.update({"img"      : True})
-            state.update({"img_mean" : self.img_stats.mean()})
-            state.update({"img_stdev": self.img_stats.stdev()})
-            state.update({"img_max"  : self.img_stats.max()})
-            state.update({"img_min"  : self.img_stats.min()})
-        else:
-            state.update({"img"      : False})
-
-        # star list can be sent here but there's a huge risk of memory allocation error if the list is long
-        # problem is solved by sending it separately, in small chunks
-        if self.stars is not None:
-            if len(self.stars) <= STAR_CNT_JSON_LIMIT:
-                x = ""
-                for i in self.stars:
-                    x += guidestar_to_str(i)
-                state.update({"stars": x})
-                self.need_send_stars = False
-            else:
-                state.update({"stars": False})
-                self.need_send_stars = True
-        else:
-            state.update({"stars": None})
-            self.need_send_stars = False
-
-        if self.selected_star is not None:
-            state.update({"sel_star"        : self.selected_star.coord()})
-            state.update({"sel_star_profile": self.selected_star.star_profile()})
-        else:
-            state.update({"sel_star": None})
-        state.update({"tgt_coord": self.target_coord})
-        state.update({"ori_coord": self.origin_coord})
-        state.update({"last_move_err": self.last_move_err})
-        state.update({"multistar_cnt": self.multistar_cnt})
-        state.update({"calib_ra" : self.calibration[CALIIDX_RA] .get_json_obj(short = self.guide_state != GUIDESTATE_IDLE) if self.calibration[CALIIDX_RA]  is not None else None})
-        state.update({"calib_dec": self.calibration[CALIIDX_DEC].get_json_obj(short = self.guide_state != GUIDESTATE_IDLE) if self.calibration[CALIIDX_DEC] is not None else None})
-        if self.hotpixels is not None:
-            state.update({"hotpix"     : True})
-            state.update({"hotpix_used": self.settings["use_hotpixels"]})
-            state.update({"hotpix_cnt" : len(self.hotpixels)})
-            state.update({"hotpix_last": self.hotpixels_eff})
-        else:
-            state.update({"hotpix"     : False})
-        state.update({"logs"        : self.get_logs_obj()})
-        state.update({"hw_err"      : self.hw_err})
-        state.update({"analysis_dur": self.analysis_dur})
-        return state
-
-    def get_logs_obj(self):
-        obj = {}
-        i = 0
-        while i < LOG_BUFF_LEN:
-            msglog   = self.msglog_buff[i]
-            pulselog = self.pulselog_buff[i]
-            obj.update({("msg_tick_%u"   % i) : msglog[0]})
-            obj.update({("msg_time_%u"   % i) : msglog[1]})
-            obj.update({("msg_str_%u"    % i) : msglog[2]})
-            obj.update({("pulse_time_%u" % i) : pulselog[0]})
-            obj.update({("pulse_ra_%u"   % i) : pulselog[1]})
-            obj.update({("pulse_dec_%u"  % i) : pulselog[2]})
-            obj.update({("pulse_sum_%u"  % i) : pulselog[3]})
-            obj.update({("pulse_shutter_%u" % i) : pulselog[4]})
-            i += 1
-        return obj
+            return star_finder.EXPO_CAMERA_ERR
+        return self.expo_code
 
     def send_state(self):
         if self.websock is None:
             return
-        obj = self.get_state_obj()
-        self.send_websocket(obj)
-
-    def send_stars(self):
-        if self.websock is None:
-            return
-        estimated_len = len(self.stars) if self.stars is not None else 0
-        estimated_len *= 26 # worst-case length per star
-        headstr = "{\"pkt_type\":\"stars\",\"stars\":\""
-        endstr  = "\"}"
-        estimated_len += len(headstr) + len(endstr)
-        remaining = estimated_len
-
-        # this function sends websocket packet in chunks with an estimated length
-        # this avoids potential memory allocation errors inside ujson if the star list is too big
-
-        try:
-            self.portal.websocket_send_start(self.websock, remaining, 0x81)
-            self.websock.send(headstr)
-            remaining -= len(headstr)
-
-            for i in self.stars:
-                x = guidestar_to_str(i)
-                self.websock.send(x)
-                remaining -= len(x)
-            self.websock.send(endstr)
-            remaining -= len(endstr)
-            # pad the remaining with blank space
-            x = " " * remaining
-            self.websock.send(x)
-            self.portal.tickle()
-        except Exception as exc:
-            self.stream_sock_err += 1
-            if self.stream_sock_err > 5:
-                if self.debug:
-                    print("websock too many errors")
-                exclogger.log_exception(exc, to_file=False)
-                self.kill_websocket()
-            pass
+        # packed by guider_packet, the star list goes in the same packet no matter how long it is
+        extras = {}
+        extras.update({"registration": self.registration.to_jsonobj() if self.registration is not None else None})
+        extras.update({"calib_ra" : self.calibration[CALIIDX_RA] .get_json_obj(short = self.guide_state != GUIDESTATE_IDLE) if self.calibration[CALIIDX_RA]  is not None else None})
+        extras.update({"calib_dec": self.calibration[CALIIDX_DEC].get_json_obj(short = self.guide_state != GUIDESTATE_IDLE) if self.calibration[CALIIDX_DEC] is not None else None})
+        thresh = self.thresh_ctrl.thresh if self.settings["auto_thresh"] else self.settings["guidecam_thresh"]
+        self.packet.start(guider_packet.PKT_STATE, self.time_mgr.get_sec())
+        guider_packet.write_state(self.packet, self, self.get_expo_code(), thresh, guidepulser.shutter_remaining(), extras)
+        self.send_websocket(self.packet.get())
 
     def send_logs(self):
         if self.websock is None:
             return
-        obj = self.get_logs_obj()
-        obj.update({"pkt_type": "logs"})
-        self.send_websocket(obj)
+        self.packet.start(guider_packet.PKT_LOGS, self.time_mgr.get_sec())
+        guider_packet.write_logs(self.packet, self)
+        self.send_websocket(self.packet.get())
 
     def send_websocket(self, obj):
+        # obj is either a dict for JSON, or an already packed binary packet
         if self.websock is None:
             return
-        json_str = ujson.dumps(obj)
+        if type(obj) == dict:
+            obj = ujson.dumps(obj)
         try:
-            self.portal.websocket_send(self.websock, json_str)
+            self.portal.websocket_send(self.websock, obj)
             self.stream_sock_err = 0
             self.websock_millis = pyb.millis()
         except Exception as exc:
@@ -458,9 +383,33 @@ class AutoGuider(object):
             self.guide_state = GUIDESTATE_IDLE
             return decided_pulse
         if self.img is not None:
-            self.histogram = self.img.get_histogram()
-            self.img_stats = self.histogram.get_statistics()
-            latest_stars, code = star_finder.find_stars(self.img, hist = self.histogram, stats = self.img_stats, thresh = self.settings["guidecam_thresh"], force_solve = False, guider = True)
+            regions = self.get_roi_regions()
+            self.roi_active = regions is not None
+            if regions is None:
+                # full frame, the statistics are kept for the following frames that only search the regions
+                self.histogram = self.img.get_histogram()
+                self.img_stats = self.histogram.get_statistics()
+                self.roi_frm_cnt = 0
+            else:
+                self.roi_frm_cnt += 1
+            thresh = self.settings["guidecam_thresh"]
+            max_mean = star_finder.MAX_MEAN
+            max_stdev = star_finder.MAX_STDEV
+            if self.settings["auto_thresh"]:
+                # the setting becomes the lowest the controller is allowed to go
+                self.thresh_ctrl.target_cnt = self.settings["auto_thresh_target"]
+                thresh = self.thresh_ctrl.get_thresh(self.img_stats, user_thresh = thresh)
+                max_mean, max_stdev = self.thresh_ctrl.get_limits()
+            latest_stars, code = star_finder.find_stars(self.img, hist = self.histogram, stats = self.img_stats, thresh = thresh, force_solve = False, guider = True, regions = regions, max_mean = max_mean, max_stdev = max_stdev)
+            if self.settings["auto_thresh"] and regions is None:
+                # frames that only searched around the guide stars do not say anything about the star count
+                prev_suggestion = self.thresh_ctrl.suggestion
+                self.thresh_ctrl.update(self.img_stats, len(latest_stars), code, user_thresh = self.settings["guidecam_thresh"])
+                if self.thresh_ctrl.suggestion != prev_suggestion:
+                    if self.thresh_ctrl.suggestion == thresh_ctrl.SUGGEST_MORE:
+                        self.log_msg("WARN: too few stars, increase the gain or the shutter time")
+                    elif self.thresh_ctrl.suggestion == thresh_ctrl.SUGGEST_LESS:
+                        self.log_msg("WARN: image is too bright, decrease the gain or the shutter time")
             self.dbg_t1 = pyb.millis()
             if self.simulator is not None:
                 latest_stars = self.simulator.get_stars(self, latest_stars)
@@ -476,6 +425,7 @@ class AutoGuider(object):
 
             self.expo_code = code
             if code != star_finder.EXPO_JUST_RIGHT or len(latest_stars) <= 0:
+                self.roi_lost()
                 self.expo_err += 1
                 if self.debug:
                     print("exposure error %u %u" % (code, len(latest_stars)))
@@ -487,6 +437,9 @@ class AutoGuider(object):
             else:
                 # exposure is just right
                 self.expo_err = 0
+                if self.settings["centroid_refine"]:
+                    # the stars that the guiding actually depends on get a more accurate centroid
+                    star_finder.refine_stars(self.img, latest_stars, cnt = self.settings["multistar_cnt_max"], near = self.selected_star.coord() if self.selected_star is not None else None, win = self.settings["centroid_win"])
                 min_stars_cnt = len(latest_stars)
                 if self.prev_stars is not None:
                     prev_stars_cnt = len(self.prev_stars)
@@ -496,6 +449,7 @@ class AutoGuider(object):
                         self.prev_stars = None
                         gc.collect()
                 self.stars = latest_stars
+                self.star_grid = star_grid.StarGrid(latest_stars) # used for star selection
 
                 # motion can be detected if previous data is available
                 # if previous data is unavailable, then just populate it for no motion
@@ -515,6 +469,21 @@ class AutoGuider(object):
                 self.last_move_err = move_err
                 self.multistar_cnt = [res[4], res[5]]
 
+                self.registration = None
+                if self.settings["registration"] and real_star is not None and self.selected_star is not None and self.reg_prev_coords is not None:
+                    # fit the rotation and translation of the whole field, using every star that moved the same way as the selected star
+                    # prev_stars is not kept between frames to save memory, so only the coordinates of the previous frame's stars are remembered
+                    pairs = frame_registration.match_pairs(self.reg_prev_coords, self.star_grid, real_star.cxf() - self.selected_star.cxf(), real_star.cyf() - self.selected_star.cyf(), self.settings["starmove_tolerance"])
+                    self.registration = frame_registration.register(pairs)
+                    if self.registration is not None:
+                        # where all the stars agree the selected star should be, less noisy than the multi-star average
+                        virtual_star = list(self.registration.apply(self.selected_star.cxf(), self.selected_star.cyf()))
+                        self.field_rotation += self.registration.get_rotation()
+                        if self.debug:
+                            print("registration rot %.4f scale %.5f inliers %u/%u rms %.2f" % (self.registration.get_rotation(), self.registration.get_scale(), self.registration.inliers, self.registration.pairs, self.registration.rms))
+                # remembered together with the selected star, which also comes from this frame
+                self.reg_prev_coords = [i.coord() for i in latest_stars] if self.settings["registration"] else None
+
                 if self.queue_imgsave == 2:
                     self.save_image_meta(res)
 
@@ -544,6 +513,7 @@ class AutoGuider(object):
                         print("no star")
 
                 if move_err > self.settings["panicthresh_move_err"] or move_err < 0 or has_stars_required == False or lost:
+                    self.roi_lost()
                     self.panic_move_cnt += 1
                     if self.panic_move_cnt >= self.settings["panicthresh_move_cnt"]:
                         if lost:
@@ -555,6 +525,7 @@ class AutoGuider(object):
                 else:
                     self.panic_move_cnt = 0
                     self.prev_stars     = self.stars
+                    self.roi_expand     = 0
 
                 # passive guiding will cause the mount to autoguide even if not in a autoguiding state
                 # this is useful for simulation and headless operation
@@ -769,19 +740,20 @@ class AutoGuider(object):
 
         dx = self.target_coord[0] - self.virtual_star[0]
         dy = self.target_coord[1] - self.virtual_star[1]
-        mag = math.sqrt((dx * dx) + (dy * dy))
-        ang = math.degrees(math.atan2(dy, dx))
-        ang_ra  = comutils.ang_normalize(ang - self.calibration[CALIIDX_RA ].angle)
-        nx = mag * math.cos(math.radians(ang_ra))
+        # the error projected onto each calibrated axis, mag * cos(ang - axis) is the same as the dot product with the axis' unit vector
+        # so only the axis angles need sin and cos
+        cal_ra = math.radians(self.calibration[CALIIDX_RA].angle)
+        cos_ra = math.cos(cal_ra)
+        sin_ra = math.sin(cal_ra)
+        nx = (dx * cos_ra) + (dy * sin_ra)
         pulse_ra  = nx * self.calibration[CALIIDX_RA ].ms_per_pix
         if self.calibration[CALIIDX_DEC] is not None:
-            ang_dec = comutils.ang_normalize(ang - self.calibration[CALIIDX_DEC].angle)
-            ny = mag * math.cos(math.radians(ang_dec))
+            cal_dec = math.radians(self.calibration[CALIIDX_DEC].angle)
+            ny = (dx * math.cos(cal_dec)) + (dy * math.sin(cal_dec))
             pulse_dec = ny * self.calibration[CALIIDX_DEC].ms_per_pix
         else:
-            # declination not calibrated
-            ang_dec = 0
-            ny = mag * math.sin(math.radians(ang_ra))
+            # declination not calibrated, use the axis perpendicular to RA
+            ny = (dy * cos_ra) - (dx * sin_ra)
             pulse_dec = ny * self.calibration[CALIIDX_RA].ms_per_pix
 
         pulse_ra  *= self.settings["correction_scale_ra"]
@@ -904,7 +876,38 @@ class AutoGuider(object):
                 tstr = str(timestamp)
             print("msg[%s]: %s" % (tstr, msg))
 
+    def get_roi_regions(self):
+        # while guiding, only the areas around the selected star and the multi-star references are searched
+        # returns None when the whole frame needs to be searched
+        if self.settings["roi_mode"] == False or self.img_stats is None or self.selected_star is None or self.stars is None:
+            return None
+        if self.guide_state != GUIDESTATE_GUIDING and self.passive_guiding == False:
+            return None
+        if self.roi_frm_cnt >= self.settings["roi_full_interval"]:
+            return None # periodically search everything, in case the background changed or better stars showed up
+        if self.roi_expand > 2:
+            return None
+        # the windows grow every time the stars were not found where they were expected
+        win = self.settings["roi_size"] << self.roi_expand
+        centers = [(self.selected_star.cxf(), self.selected_star.cyf())]
+        ref_stars = sorted(self.stars, key = lambda x: x.star_rating(), reverse = True)
+        i = 0
+        while i < len(ref_stars) and len(centers) <= self.settings["multistar_cnt_max"]:
+            centers.append((ref_stars[i].cxf(), ref_stars[i].cyf()))
+            i += 1
+        return star_finder.make_regions(centers, win, self.img.width() - 150, self.img.height())
+
+    def roi_lost(self):
+        if self.roi_active:
+            self.roi_expand += 1
+            if self.debug:
+                print("ROI search lost stars, expanding %u" % self.roi_expand)
+
     def reset_guiding(self):
+        self.roi_expand = 0
+        self.registration = None
+        self.field_rotation = 0
+        self.reg_prev_coords = None
         self.backlash_ra.neutralize()
         self.backlash_dec.neutralize()
         self.advfilt_ra.neutralize()
@@ -941,14 +944,11 @@ class AutoGuider(object):
         if len(self.stars) <= 0:
             self.log_msg("ERR: no stars in the list for selection")
             return False
-        nearest = None
-        nearest_dist = 9999
-        for i in self.stars:
-            mag = comutils.vector_between([x, y], i.coord(), mag_only=True)
-            if mag < nearest_dist:
-                nearest_dist = mag
-                nearest = i
-        if nearest_dist <= tol:
+        grid = self.star_grid
+        if grid is None or grid.star_list is not self.stars:
+            grid = star_grid.StarGrid(self.stars)
+        nearest = grid.nearest_star(x, y, tol)
+        if nearest is not None:
             self.selected_star = nearest
             self.log_msg("SUCCESS: selected star at [%u , %u]" % (self.selected_star.cxf(), self.selected_star.cyf()))
             self.target_coord = self.selected_star.coord()
@@ -1036,10 +1036,11 @@ class AutoGuider(object):
             if self.debug:
                 print("analysis debug %s" % self.analysis_dur)
         self.send_state()
-        if self.need_send_stars:
-            self.send_stars()
+        if self.img_owned:
+            # the camera is busy with the next frame, so the JPG for the stream is made now instead of after it
+            self.stream_img()
         if self.snap_wait():
-            img = self.cam.snapshot_finish()
+            img, self.img_owned = self.snap_finish()
             #img_time = img.timestamp()
             tspan = self.cam.get_timespan()
             tspent = self.last_pulse_dur
@@ -1060,16 +1061,13 @@ class AutoGuider(object):
                 if self.snap_start():
                     if self.snap_wait():
                         self.preemp_pulse()
-                        self.img = self.cam.snapshot_finish()
+                        self.img, self.img_owned = self.snap_finish()
                     else:
                         self.log_msg("ERR: guidecam failed to read image during wait")
                         self.cam.snapshot_finish()
-            if self.imgstream_sock is not None and self.img_is_compressed == False:
-                if self.guide_state != GUIDESTATE_IDLE:
-                    print("warning: compressing JPG while autoguiding")
-                self.compress_img()
-                self.img_is_compressed = True
-                self.update_imgstream()
+            if self.img_owned == False:
+                # no second frame buffer, the image is the camera's, it can only be compressed before the next exposure starts
+                self.stream_img()
         else:
             self.log_msg("ERR: guidecam failed to read image")
             self.cam.snapshot_finish()
@@ -1569,8 +1567,7 @@ class AutoGuider(object):
     def handle_index(self, client_stream, req, headers, content):
         self.kill_imgstreamer()
         self.kill_websocket()
-        captive_portal.gen_page(client_stream, "autoguider.htm", add_files = ["web/autoguider_utils.js", "web/jquery-ui-1.12.1-darkness.css", "web/jquery-3.5.1.min.js", "web/jquery-ui-1.12.1.min.js", "web/chartist.min.js", "web/chartist.min.css", "web/divtable_basic.css", "web/toast.js", "web/websocketutils.js", "web/mathutils.js", "web/draw_guideerror.js", "web/draw_guidescope.js", "web/draw_starprofile.js"], debug = self.debug)
-        return True
+        return captive_portal.gen_page_iter("autoguider.htm", add_files = ["web/autoguider_utils.js", "web/jquery-ui-1.12.1-darkness.css", "web/jquery-3.5.1.min.js", "web/jquery-ui-1.12.1.min.js", "web/chartist.min.js", "web/chartist.min.css", "web/divtable_basic.css", "web/toast.js", "web/websocketutils.js", "web/mathutils.js", "web/draw_guideerror.js", "web/draw_guidescope.js", "web/draw_starprofile.js"], debug = self.debug)
 
     def update_imgstream(self):
         if self.imgstream_sock is None or self.img_compressed is None:
@@ -1616,8 +1613,6 @@ class AutoGuider(object):
             print("handle_websocket")
         self.kill_imgstreamer()
         self.kill_websocket()
-        # headers and content are empty at this point anyways
-        headers, content = captive_portal.get_all_headers(client_stream)
         is_websock = captive_portal.handle_websocket(client_stream, req, headers)
         if is_websock == False:
             print("error handling websocket")
@@ -1630,6 +1625,34 @@ class AutoGuider(object):
         self.websock_millis = pyb.millis()
         return False # won't kill the socket
 
+    def snap_finish(self):
+        # the copy of the frame only pays off while streaming, the JPG is then made during the next exposure
+        # decide() does nothing while streaming, so otherwise the copy would just hold 5 MB
+        copy = self.settings["double_buffer"] and self.imgstream_sock is not None
+        if copy == False and self.cam.analysis_fb is not None:
+            self.release_fbs()
+        return self.cam.snapshot_finish_copy(copy = copy)
+
+    def release_fbs(self):
+        # extra frame buffers are released newest first, so the JPG one goes too, compress_img() allocates it again when needed
+        # both images point into the released memory
+        if self.extra_fb is not None:
+            sensor.dealloc_extra_fb()
+            self.extra_fb = None
+            self.img_compressed = None
+        self.cam.release_copy()
+        if self.img_owned:
+            self.img = None
+            self.img_owned = False
+
+    def stream_img(self):
+        if self.imgstream_sock is not None and self.img_is_compressed == False:
+            if self.guide_state != GUIDESTATE_IDLE:
+                print("warning: compressing JPG while autoguiding")
+            self.compress_img()
+            self.img_is_compressed = True
+            self.update_imgstream()
+
     def compress_img(self):
         if self.img is None:
             self.img_compressed = None
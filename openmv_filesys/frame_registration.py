@@ -0,0 +1,186 @@
+import micropython
+micropython.opt_level(2)
+
+import math
+
+# fits a similarity transform (translation, rotation and scale) between the star lists of two frames
+# the stars are paired up using the movement already found by guidestar.get_multi_star_motion
+# RANSAC on the pairs throws away the stars that were mismatched or distorted by seeing, then all the good pairs are used for a least squares fit
+# the transform is:
+#   x' = (a * x) - (b * y) + tx
+#   y' = (b * x) + (a * y) + ty
+
+RANSAC_ITERATIONS = micropython.const(40)
+INLIER_TOLERANCE  = micropython.const(2)  # pixels
+MIN_SAMPLE_DIST   = micropython.const(20) # pixels, two stars closer than this do not tell much about rotation
+MAX_SCALE_ERR     = 0.05 # the guide scope cannot zoom, anything more than this is a bad sample
+MIN_INLIERS       = micropython.const(4)
+
+class Registration(object):
+
+    def __init__(self, a, b, tx, ty):
+        self.a = a
+        self.b = b
+        self.tx = tx
+        self.ty = ty
+        self.pairs = 0
+        self.inliers = 0
+        self.rms = 0
+
+    def apply(self, x, y):
+        return (self.a * x) - (self.b * y) + self.tx, (self.b * x) + (self.a * y) + self.ty
+
+    def get_rotation(self):
+        # degrees, positive is clockwise in image coordinates
+        return math.degrees(math.atan2(self.b, self.a))
+
+    def get_scale(self):
+        return math.sqrt((self.a * self.a) + (self.b * self.b))
+
+    def get_translation(self, x, y):
+        # how far a point moved, the rotation makes this different across the frame
+        nx, ny = self.apply(x, y)
+        return nx - x, ny - y
+
+    def residual(self, p):
+        nx, ny = self.apply(p[0], p[1])
+        dx = nx - p[2]
+        dy = ny - p[3]
+        return math.sqrt((dx * dx) + (dy * dy))
+
+    def to_jsonobj(self):
+        obj = {}
+        obj.update({"rot"    : self.get_rotation()})
+        obj.update({"scale"  : self.get_scale()})
+        obj.update({"tx"     : self.tx})
+        obj.update({"ty"     : self.ty})
+        obj.update({"inliers": self.inliers})
+        obj.update({"pairs"  : self.pairs})
+        obj.update({"rms"    : self.rms})
+        return obj
+
+def match_pairs(old_coords, grid, dx, dy, tol):
+    # pairs every old star, given as (x, y), with the nearest new star to where it should have moved, grid is a star_grid.StarGrid over the new list
+    # each new star is only used once, by the old star that landed closest to it
+    best = {}
+    for ox, oy in old_coords:
+        i, d = grid.nearest(ox + dx, oy + dy, tol)
+        if i < 0:
+            continue
+        if i not in best or d < best[i][0]:
+            best[i] = (d, ox, oy)
+    res = []
+    for i in sorted(best): # the order matters for register(), keep it the same every time
+        d, ox, oy = best[i]
+        res.append((ox, oy, grid.xs[i], grid.ys[i]))
+    return res
+
+def fit_two(p, q):
+    # exact similarity from two pairs, None if the two stars are too close together
+    dpx = q[0] - p[0]
+    dpy = q[1] - p[1]
+    dqx = q[2] - p[2]
+    dqy = q[3] - p[3]
+    den = (dpx * dpx) + (dpy * dpy)
+    if den < MIN_SAMPLE_DIST * MIN_SAMPLE_DIST:
+        return None
+    a = ((dpx * dqx) + (dpy * dqy)) / den
+    b = ((dpx * dqy) - (dpy * dqx)) / den
+    tx = p[2] - ((a * p[0]) - (b * p[1]))
+    ty = p[3] - ((b * p[0]) + (a * p[1]))
+    return Registration(a, b, tx, ty)
+
+def fit_all(pairs):
+    # least squares similarity over all the pairs
+    n = len(pairs)
+    if n < 2:
+        return None
+    mox = 0.0
+    moy = 0.0
+    mnx = 0.0
+    mny = 0.0
+    for p in pairs:
+        mox += p[0]
+        moy += p[1]
+        mnx += p[2]
+        mny += p[3]
+    mox /= n
+    moy /= n
+    mnx /= n
+    mny /= n
+    sa = 0.0
+    sb = 0.0
+    den = 0.0
+    for p in pairs:
+        ox = p[0] - mox
+        oy = p[1] - moy
+        nx = p[2] - mnx
+        ny = p[3] - mny
+        sa += (ox * nx) + (oy * ny)
+        sb += (ox * ny) - (oy * nx)
+        den += (ox * ox) + (oy * oy)
+    if den <= 0:
+        return None
+    a = sa / den
+    b = sb / den
+    return Registration(a, b, mnx - ((a * mox) - (b * moy)), mny - ((b * mox) + (a * moy)))
+
+def count_inliers(reg, pairs, tol):
+    cnt = 0
+    for p in pairs:
+        if reg.residual(p) < tol:
+            cnt += 1
+    return cnt
+
+def register(pairs, iterations = RANSAC_ITERATIONS, tol = INLIER_TOLERANCE, min_inliers = MIN_INLIERS):
+    # returns a Registration, or None if there are not enough stars that agree with each other
+    n = len(pairs)
+    if n < min_inliers or n < 2:
+        return None
+    best = None
+    best_cnt = 0
+    total = (n * (n - 1)) // 2
+    seed = n * 7919
+    k = 0
+    while k < iterations and k < total:
+        if total <= iterations:
+            # few stars, try every combination, in order, so that the result never changes between runs
+            i = 0
+            j = k
+            while j >= (n - 1 - i):
+                j -= n - 1 - i
+                i += 1
+            j += i + 1
+        else:
+            # simple LCG instead of pyb.rng() so that replaying the same frames gives the same result
+            seed = ((seed * 1103515245) + 12345) & 0x7FFFFFFF
+            i = seed % n
+            seed = ((seed * 1103515245) + 12345) & 0x7FFFFFFF
+            j = seed % n
+        k += 1
+        if i == j:
+            continue
+        reg = fit_two(pairs[i], pairs[j])
+        if reg is None or abs(reg.get_scale() - 1.0) > MAX_SCALE_ERR:
+            continue
+        cnt = count_inliers(reg, pairs, tol)
+        if cnt > best_cnt:
+            best = reg
+            best_cnt = cnt
+    if best is None or best_cnt < min_inliers:
+        return None
+    inliers = []
+    for p in pairs:
+        if best.residual(p) < tol:
+            inliers.append(p)
+    reg = fit_all(inliers)
+    if reg is None:
+        return None
+    reg.pairs = n
+    reg.inliers = len(inliers)
+    sq = 0.0
+    for p in inliers:
+        r = reg.residual(p)
+        sq += r * r
+    reg.rms = math.sqrt(sq / len(inliers))
+    return reg
@@ -0,0 +1,451 @@
+import micropython
+micropython.opt_level(2)
+
+import ustruct, ujson
+import captive_portal
+
+# binary websocket packets for the autoguider's state and logs, decoded by websock_decode_packet in web/websocketutils.js
+# the state used to be a JSON dict with dozens of keys made every frame, and the star list was sent as text in chunks when it got long
+# everything here is packed into one buffer that is allocated once, it only grows if a packet is bigger than all the ones before it
+#
+# header, 8 bytes, little endian:
+#   u8 magic, u8 version, u8 packet type, u8 fixed block length (STATE_LEN for a state packet, 0 for the others), u32 time (seconds)
+#   the page checks the version and the length against its own copy of them, a page and a camera that disagree about STATE_FMT show nothing instead of garbage
+# state packet:
+#   fixed block, see STATE_FMT, coordinates are int16 in tenths of a pixel
+#   u16 star count (0xFFFF means no list), then 7 bytes per star: u16 cx * 10, u16 cy * 10, u8 r, u8 max brightness, u8 rating
+#   u8 profile length and the profile of the selected star, only if there is a selected star
+#   the logs, same as the logs packet
+#   varint length and a JSON object with the things that are rarely sent or have no fixed shape (calibration and registration)
+# logs packet:
+#   u8 count, then per message: varint tick delta, varint time delta, varint length, UTF-8 string
+#   u8 count, then per pulse: varint time delta, f32 RA error, f32 DEC error, f32 pulse sum, u8 shutter
+#   the deltas are from the previous entry (the first one from 0) and zigzag encoded, entries are oldest first
+# integers that do not fit are clamped, a float16 would not hold a coordinate on a big frame to a tenth of a pixel
+
+PKT_MAGIC   = micropython.const(0xA7)
+PKT_VERSION = micropython.const(2)
+PKT_STATE   = micropython.const(1)
+PKT_LOGS    = micropython.const(2)
+
+HEADER_FMT = "<BBBBI"
+HEADER_LEN = micropython.const(8)
+
+# session id, websocket id, guide state, interval state, expo code, expo suggestion, flags, bulb remaining, dither counter,
+# image mean * 100, image stdev * 100, image max, image min, selected star, target, origin,
+# move error, multistar counts, field rotation, threshold, hot pixel count, hot pixels removed, hardware error, analysis durations
+# any change here has to be made to websock_decode_state and STATE_LEN in web/websocketutils.js too, and PKT_VERSION goes up
+STATE_FMT = "<HIBBbbHHHHHBBhhhhhhfHHfHHHBiiiii"
+STATE_LEN = micropython.const(73)
+
+STAR_FMT = "<HHBBB"
+STAR_LEN = micropython.const(7)
+STARS_NONE = micropython.const(0xFFFF)
+
+FLAG_IMG         = micropython.const(0x01)
+FLAG_SEL_STAR    = micropython.const(0x02)
+FLAG_TGT_COORD   = micropython.const(0x04)
+FLAG_ORI_COORD   = micropython.const(0x08)
+FLAG_HOTPIX      = micropython.const(0x10)
+FLAG_HOTPIX_USED = micropython.const(0x20)
+
+INIT_SIZE = micropython.const(2048)
+
+def clamp(x, lo, hi):
+    if x < lo:
+        return lo
+    if x > hi:
+        return hi
+    return x
+
+def fixed10(x):
+    # tenths of a pixel, as an int16
+    return clamp(int(round(x * 10)), -32768, 32767)
+
+class PacketWriter(object):
+
+    def __init__(self, size = INIT_SIZE):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.pos = 0
+
+    def reserve(self, n):
+        # makes room for n more bytes
+        need = self.pos + n
+        if need <= len(self.buf):
+            return
+        size = len(self.buf) * 2
+        while size < need:
+            size *= 2
+        nbuf = bytearray(size)
+        nbuf[0:self.pos] = self.mv[0:self.pos]
+        self.buf = nbuf
+        self.mv = memoryview(nbuf)
+
+    def start(self, pkt_type, time_sec):
+        self.pos = 0
+        ustruct.pack_into(HEADER_FMT, self.buf, 0, PKT_MAGIC, PKT_VERSION, pkt_type, STATE_LEN if pkt_type == PKT_STATE else 0, clamp(int(time_sec), 0, 0xFFFFFFFF))
+        self.pos = HEADER_LEN
+
+    def u8(self, x):
+        self.reserve(1)
+        self.buf[self.pos] = clamp(int(x), 0, 255)
+        self.pos += 1
+
+    def pack(self, fmt, n, *args):
+        self.reserve(n)
+        ustruct.pack_into(fmt, self.buf, self.pos, *args)
+        self.pos += n
+
+    def varint(self, x):
+        # zigzag, so that small negative numbers are short too, then 7 bits per byte
+        x = int(x)
+        x = (x * 2) if x >= 0 else ((-x * 2) - 1)
+        self.reserve(10)
+        buf = self.buf
+        while x >= 0x80:
+            buf[self.pos] = (x & 0x7F) | 0x80
+            x >>= 7
+            self.pos += 1
+        buf[self.pos] = x
+        self.pos += 1
+
+    def data(self, x):
+        # varint length and the bytes, a str is written as UTF-8
+        x = captive_portal.payload_buffer(x)
+        n = len(x)
+        self.varint(n)
+        self.reserve(n)
+        self.mv[self.pos:self.pos + n] = x
+        self.pos += n
+
+    def get(self):
+        return self.mv[0:self.pos]
+
+def write_logs(w, guider):
+    # both ring buffers are read oldest first, an entry that is not newer than the one before it is empty or already written
+    # the buffers are walked twice, once to count and once to write, so that nothing is allocated
+    bufs = guider.msglog_buff
+    start = guider.msglog_buff_idx
+    k = 0
+    while k < 2:
+        cnt = 0
+        last = 0
+        last_time = 0
+        i = 0
+        while i < len(bufs):
+            e = bufs[(start + i) % len(bufs)]
+            i += 1
+            if e[0] <= last or e[2] is None:
+                continue
+            if k == 1:
+                w.varint(e[0] - last)
+                w.varint(e[1] - last_time)
+                w.data(e[2])
+                last_time = e[1]
+            cnt += 1
+            last = e[0]
+        if k == 0:
+            w.u8(cnt)
+        k += 1
+
+    bufs = guider.pulselog_buff
+    start = guider.pulselog_buff_idx
+    k = 0
+    while k < 2:
+        cnt = 0
+        last = 0
+        i = 0
+        while i < len(bufs):
+            e = bufs[(start + i) % len(bufs)]
+            i += 1
+            if e[0] <= last:
+                continue
+            if k == 1:
+                w.varint(e[0] - last)
+                w.pack("<fffB", 13, e[1], e[2], e[3], 1 if e[4] else 0)
+            cnt += 1
+            last = e[0]
+        if k == 0:
+            w.u8(cnt)
+        k += 1
+
+def write_stars(w, stars):
+    if stars is None:
+        w.pack("<H", 2, STARS_NONE)
+        return
+    n = min(len(stars), STARS_NONE - 1)
+    w.pack("<H", 2, n)
+    w.reserve(n * STAR_LEN)
+    buf = w.buf
+    pos = w.pos
+    i = 0
+    while i < n:
+        s = stars[i]
+        ustruct.pack_into(STAR_FMT, buf, pos, clamp(int(round(s.cxf() * 10)), 0, 0xFFFF), clamp(int(round(s.cyf() * 10)), 0, 0xFFFF), clamp(s.r(), 0, 255), clamp(s.max_brightness(), 0, 255), clamp(s.star_rating(), 0, 255))
+        pos += STAR_LEN
+        i += 1
+    w.pos = pos
+
+def write_state(w, guider, expo_code, thresh, bulb_remaining, extras):
+    # the values that the guider works out while it makes the state are passed in
+    flags = 0
+    img_mean = 0
+    img_stdev = 0
+    img_max = 0
+    img_min = 0
+    if guider.img_stats is not None:
+        flags |= FLAG_IMG
+        img_mean  = clamp(int(round(guider.img_stats.mean()  * 100)), 0, 0xFFFF)
+        img_stdev = clamp(int(round(guider.img_stats.stdev() * 100)), 0, 0xFFFF)
+        img_max   = clamp(guider.img_stats.max(), 0, 255)
+        img_min   = clamp(guider.img_stats.min(), 0, 255)
+    sel = (0, 0)
+    if guider.selected_star is not None:
+        flags |= FLAG_SEL_STAR
+        sel = guider.selected_star.coord()
+    tgt = (0, 0)
+    if guider.target_coord is not None:
+        flags |= FLAG_TGT_COORD
+        tgt = guider.target_coord
+    ori = (0, 0)
+    if guider.origin_coord is not None:
+        flags |= FLAG_ORI_COORD
+        ori = guider.origin_coord
+    hotpix_cnt = 0
+    if guider.hotpixels is not None:
+        flags |= FLAG_HOTPIX
+        hotpix_cnt = len(guider.hotpixels)
+        if guider.settings["use_hotpixels"]:
+            flags |= FLAG_HOTPIX_USED
+    dur = guider.analysis_dur
+    w.pack(STATE_FMT, STATE_LEN,
+        guider.session_randid & 0xFFFF,
+        clamp(int(guider.websock_randid), 0, 0xFFFFFFFF),
+        guider.guide_state,
+        guider.intervalometer_state,
+        clamp(expo_code, -128, 127),
+        clamp(guider.thresh_ctrl.suggestion, -128, 127),
+        flags,
+        clamp(bulb_remaining, 0, 0xFFFF),
+        clamp(guider.dither_interval, 0, 0xFFFF),
+        img_mean, img_stdev, img_max, img_min,
+        fixed10(sel[0]), fixed10(sel[1]),
+        fixed10(tgt[0]), fixed10(tgt[1]),
+        fixed10(ori[0]), fixed10(ori[1]),
+        guider.last_move_err,
+        clamp(guider.multistar_cnt[0], 0, 0xFFFF),
+        clamp(guider.multistar_cnt[1], 0, 0xFFFF),
+        guider.field_rotation,
+        clamp(int(thresh), 0, 0xFFFF),
+        clamp(hotpix_cnt, 0, 0xFFFF),
+        clamp(guider.hotpixels_eff, 0, 0xFFFF),
+        clamp(guider.hw_err, 0, 255),
+        dur[0], dur[1], dur[2], dur[3], dur[4])
+    write_stars(w, guider.stars)
+    if guider.selected_star is not None:
+        profile = guider.selected_star.star_profile()
+        n = min(len(profile), 255)
+        w.u8(n)
+        w.reserve(n)
+        i = 0
+        while i < n:
+            w.buf[w.pos] = clamp(profile[i], 0, 255)
+            w.pos += 1
+            i += 1
+    write_logs(w, guider)
+    w.data(ujson.dumps(extras))
+
+def decode_packet(buf):
+    # the same steps as websock_decode_packet in web/websocketutils.js, for check_packets(), the camera never reads these
+    buf = bytes(buf)
+    st = {"pos": 0}
+    def rd(fmt, n):
+        x = ustruct.unpack_from(fmt, buf, st["pos"])
+        st["pos"] += n
+        return x
+    def varint():
+        x = 0
+        mul = 1
+        while True:
+            b = buf[st["pos"]]
+            st["pos"] += 1
+            x += (b & 0x7F) * mul
+            mul *= 128
+            if (b & 0x80) == 0:
+                break
+        return (x // 2) if (x % 2) == 0 else -((x + 1) // 2)
+    def data():
+        n = varint()
+        x = buf[st["pos"]:st["pos"] + n].decode("utf-8")
+        st["pos"] += n
+        return x
+    def logs():
+        msgs = []
+        last = 0
+        last_time = 0
+        n = rd("<B", 1)[0]
+        while len(msgs) < n:
+            last += varint()
+            last_time += varint()
+            msgs.append((last, last_time, data()))
+        pulses = []
+        last = 0
+        n = rd("<B", 1)[0]
+        while len(pulses) < n:
+            last += varint()
+            pulses.append((last,) + rd("<fffB", 13))
+        return msgs, pulses
+
+    magic, ver, typ, fixed_len, t = rd(HEADER_FMT, HEADER_LEN)
+    if magic != PKT_MAGIC or ver != PKT_VERSION:
+        return None
+    obj = {"type": typ, "time": t}
+    if typ == PKT_LOGS:
+        obj["logs"] = logs()
+        return obj
+    if fixed_len != STATE_LEN:
+        return None
+    obj["state"] = rd(STATE_FMT, STATE_LEN)
+    n = rd("<H", 2)[0]
+    stars = None
+    if n != STARS_NONE:
+        stars = []
+        while len(stars) < n:
+            stars.append(rd(STAR_FMT, STAR_LEN))
+    obj["stars"] = stars
+    if (obj["state"][6] & FLAG_SEL_STAR) != 0:
+        n = rd("<B", 1)[0]
+        obj["profile"] = list(buf[st["pos"]:st["pos"] + n])
+        st["pos"] += n
+    obj["logs"] = logs()
+    obj["extras"] = ujson.loads(data())
+    obj["left"] = len(buf) - st["pos"]
+    return obj
+
+def check_packets():
+    # writes made up states and logs and reads them back with decode_packet(), returns how many checks failed
+    # the log deltas go back and forth across the int16 limits, where a varint needs a third byte and a sign mistake would show
+    class FakeStar(object):
+        def __init__(self, x, y, r, brite, rating):
+            self.x = x
+            self.y = y
+            self.vals = (r, brite, rating)
+        def cxf(self):
+            return self.x
+        def cyf(self):
+            return self.y
+        def r(self):
+            return self.vals[0]
+        def max_brightness(self):
+            return self.vals[1]
+        def star_rating(self):
+            return self.vals[2]
+        def coord(self):
+            return (self.x, self.y)
+        def star_profile(self):
+            return [0, 10, 200, 300, 10]
+
+    class FakeStats(object):
+        def mean(self):
+            return 3.456
+        def stdev(self):
+            return 1.5
+        def max(self):
+            return 255
+        def min(self):
+            return 1
+
+    class FakeCtrl(object):
+        suggestion = -1
+
+    class FakeGuider(object):
+        pass
+
+    fails = 0
+    def check(cond, msg):
+        if cond:
+            return 0
+        print("packet check failed: " + msg)
+        return 1
+
+    fails += check(ustruct.calcsize(STATE_FMT) == STATE_LEN, "STATE_LEN %u but STATE_FMT packs %u bytes" % (STATE_LEN, ustruct.calcsize(STATE_FMT)))
+    fails += check(ustruct.calcsize(HEADER_FMT) == HEADER_LEN and ustruct.calcsize(STAR_FMT) == STAR_LEN, "header or star length")
+
+    g = FakeGuider()
+    g.img_stats = FakeStats()
+    g.selected_star = FakeStar(12.34, 3276.7, 3, 250, 90)
+    g.target_coord = (-3276.8, 0.06)
+    g.origin_coord = None
+    g.hotpixels = [(1, 2), (3, 4)]
+    g.settings = {"use_hotpixels": True}
+    g.analysis_dur = [1, -2, 2147483647, -2147483648, 0]
+    g.session_randid = 0x12345
+    g.websock_randid = 0xDEADBEEF
+    g.guide_state = 3
+    g.intervalometer_state = 2
+    g.thresh_ctrl = FakeCtrl()
+    g.dither_interval = 70000
+    g.last_move_err = 0.25
+    g.multistar_cnt = (4, 10)
+    g.field_rotation = -179.5
+    g.hotpixels_eff = 1
+    g.hw_err = 300
+    g.stars = [FakeStar(0, 0, 1, 2, 3), FakeStar(6553.5, 1944.04, 300, 17, 99)]
+    # deltas of exactly the int16 limits, one past them, zero, 64 (zigzag 0x80, the first two byte varint) and back down across zero
+    ticks = [32767, 32767 + 32768, 32767 + 32768 + 64, 100000, 100000 + 32767]
+    times = [-32768, 32767 - 32768, 32767 - 32768, 65535, 1]
+    g.msglog_buff = [[ticks[i], times[i], "msg %u °" % i] for i in range(len(ticks))]
+    g.msglog_buff.append([0, 0, None])
+    g.msglog_buff_idx = len(ticks)
+    pticks = [32767, 65534, 65535, 70000]
+    g.pulselog_buff = [[pticks[i], 0.5 * i, -0.5 * i, i, i % 2] for i in range(len(pticks))]
+    g.pulselog_buff.append([0, 0, 0, 0, 0]) # not used yet, skipped
+    g.pulselog_buff_idx = 0
+
+    w = PacketWriter(size = 16) # starts small so that it has to grow
+    w.start(PKT_STATE, 1234567890)
+    write_state(w, g, -3, 70000, 5, {"calibration": None, "x": [1.5, "y"]})
+    p = decode_packet(w.get())
+    fails += check(p is not None, "state packet not decoded")
+    if p is not None:
+        s = p["state"]
+        fails += check(p["type"] == PKT_STATE and p["time"] == 1234567890, "state header %s" % str((p["type"], p["time"])))
+        fails += check(s[0:9] == (0x2345, 0xDEADBEEF, 3, 2, -3, -1, FLAG_IMG | FLAG_SEL_STAR | FLAG_TGT_COORD | FLAG_HOTPIX | FLAG_HOTPIX_USED, 5, 0xFFFF), "state fields %s" % str(s[0:9]))
+        fails += check(s[9:13] == (346, 150, 255, 1), "image statistics %s" % str(s[9:13]))
+        fails += check(s[13:19] == (123, 32767, -32768, 1, 0, 0), "coordinates %s" % str(s[13:19]))
+        fails += check(abs(s[19] - 0.25) < 1e-6 and s[20:22] == (4, 10) and abs(s[22] + 179.5) < 1e-4, "move error, multistar or rotation %s" % str(s[19:23]))
+        fails += check(s[23:27] == (0xFFFF, 2, 1, 255), "threshold, hot pixels or hardware error %s" % str(s[23:27]))
+        fails += check(list(s[27:32]) == g.analysis_dur, "analysis durations %s" % str(s[27:32]))
+        fails += check(p["stars"] == [(0, 0, 1, 2, 3), (65535, 19440, 255, 17, 99)], "stars %s" % str(p["stars"]))
+        fails += check(p["profile"] == [0, 10, 200, 255, 10], "profile %s" % str(p.get("profile")))
+        msgs, pulses = p["logs"]
+        fails += check(msgs == [(ticks[i], times[i], "msg %u °" % i) for i in range(len(ticks))], "messages %s" % str(msgs))
+        fails += check([x[0] for x in pulses] == pticks and [x[4] for x in pulses] == [0, 1, 0, 1], "pulses %s" % str(pulses))
+        fails += check(p["extras"] == {"calibration": None, "x": [1.5, "y"]}, "extras %s" % str(p["extras"]))
+        fails += check(p["left"] == 0, "%d bytes left over" % p["left"])
+
+    # no star list and no selected star
+    g.stars = None
+    g.selected_star = None
+    w.start(PKT_STATE, 0)
+    write_state(w, g, 0, 0, 0, {})
+    p = decode_packet(w.get())
+    fails += check(p is not None and p["stars"] is None and "profile" not in p and p["left"] == 0, "state without stars %s" % str(p))
+
+    w.start(PKT_LOGS, 5)
+    write_logs(w, g)
+    p = decode_packet(w.get())
+    fails += check(p is not None and p["type"] == PKT_LOGS and len(p["logs"][0]) == len(ticks) and len(p["logs"][1]) == len(pticks), "logs packet %s" % str(p))
+
+    # a packet from a camera with a different state block is not read
+    w.start(PKT_STATE, 0)
+    write_state(w, g, 0, 0, 0, {})
+    w.buf[3] = STATE_LEN + 1
+    fails += check(decode_packet(w.get()) is None, "state block length mismatch accepted")
+
+    print("packet check, %u failed" % fails)
+    return fails
+
+if __name__ == "__main__":
+    check_packets()
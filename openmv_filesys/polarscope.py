@@ -2,7 +2,7 @@ import micropython
 micropython.opt_level(2)
 
 import comutils
-import blobstar, astro_sensor, time_location, captive_portal, pole_finder, star_finder, pole_movement
+import blobstar, astro_sensor, time_location, captive_portal, pole_finder, pole_filter, star_finder, pole_movement
 import exclogger
 import pyb, uos, uio, gc, sys
 import time, math, ujson, ubinascii
@@ -51,6 +51,7 @@ class PolarScope(object):
         self.settings.update({"use_refraction": False})
         self.settings.update({"force_solve": False})
         self.settings.update({"max_stars":   0})
+        self.settings.update({"double_buffer": True})
         self.load_settings()
         self.time_mgr.readiness = False
         exclogger.log_exception("Time Guessed (%u)" % pyb.millis(), time_str=comutils.fmt_time(self.time_mgr.get_time()))
@@ -58,6 +59,7 @@ class PolarScope(object):
         self.portal = captive_portal.CaptivePortal(debug = self.debug)
 
         self.img = None
+        self.img_owned = False # True if self.img is a copy that the camera won't overwrite
         self.img_compressed = None
         self.extra_fb = None
         self.expo_code = 0
@@ -72,6 +74,7 @@ class PolarScope(object):
         self.mem_errs = 0
         self.accel_sec = 0
         self.solution = None
+        self.pole_filter = pole_filter.PoleFilter()
         if self.portal is not None:
             self.register_http_handlers()
         while self.cam.check_init() == False:
@@ -187,13 +190,19 @@ class PolarScope(object):
             state.update({"rotation": stable_solution.get_rotation()})
             state.update({"polaris_ra": (stable_solution.polaris_ra_dec[0] * 360.0) / 24.0})
             state.update({"pix_per_deg": stable_solution.pix_per_deg})
+            state.update({"converged": self.pole_filter.is_converged()})
+            state.update({"outlier": self.pole_filter.outlier})
+            state.update({"spread": self.pole_filter.spread})
         else:
             state.update({"solution": False})
         if self.stars is not None:
-            star_list = self.stars
-            if len(star_list) > 50:
-                star_list = blobstar.sort_brightness(star_list)[0:50]
-            state.update({"stars": blobstar.to_jsonobj(star_list)})
+            # a blobstar.StarList, or an empty list if find_stars rejected the frame
+            if len(self.stars) > 50:
+                state.update({"stars": self.stars.to_jsonobj(self.stars.sort_brightness()[0:50])})
+            elif len(self.stars) > 0:
+                state.update({"stars": self.stars.to_jsonobj()})
+            else:
+                state.update({"stars": []})
         state.update({"polar_clock": self.time_mgr.get_angle()})
 
         state.update({"max_stars": self.max_stars})
@@ -384,8 +393,7 @@ class PolarScope(object):
         self.sleeping = False
         self.kill_imgstreamer()
         self.kill_websocket()
-        captive_portal.gen_page(client_stream, "polarscope.htm", add_files = ["web/jquery-ui-1.12.1-darkness.css", "web/jquery-3.5.1.min.js", "web/jquery-ui-1.12.1.min.js", "web/websocketutils.js", "web/magellan.js", "web/draw_polarscope.js", "web/circle_fit.js", "web/mathutils.js", "web/platesolver.js"], debug = self.debug)
-        return True
+        return captive_portal.gen_page_iter("polarscope.htm", add_files = ["web/jquery-ui-1.12.1-darkness.css", "web/jquery-3.5.1.min.js", "web/jquery-ui-1.12.1.min.js", "web/websocketutils.js", "web/magellan.js", "web/draw_polarscope.js", "web/circle_fit.js", "web/mathutils.js", "web/platesolver.js"], debug = self.debug)
 
     def update_imgstream(self):
         if self.imgstream_sock is None:
@@ -431,8 +439,6 @@ class PolarScope(object):
             print("handle_websocket")
         self.kill_imgstreamer()
         self.kill_websocket()
-        # headers and content are empty at this point anyways
-        headers, content = captive_portal.get_all_headers(client_stream)
         is_websock = captive_portal.handle_websocket(client_stream, req, headers)
         if is_websock == False:
             print("error handling websocket")
@@ -489,6 +495,25 @@ class PolarScope(object):
             pass
         return True
 
+    def snap_finish(self):
+        # the copy of the frame is only needed while there is a JPG to make, without one the solver already runs during the next exposure
+        copy = self.settings["double_buffer"] and (self.packjpeg or self.imgstream_sock is not None)
+        if copy == False and self.cam.analysis_fb is not None:
+            self.release_fbs()
+        return self.cam.snapshot_finish_copy(copy = copy)
+
+    def release_fbs(self):
+        # extra frame buffers are released newest first, so the JPG one goes too, compress_img() allocates it again when needed
+        # both images point into the released memory
+        if self.extra_fb is not None:
+            sensor.dealloc_extra_fb()
+            self.extra_fb = None
+            self.img_compressed = None
+        self.cam.release_copy()
+        if self.img_owned:
+            self.img = None
+            self.img_owned = False
+
     def compress_img(self):
         if self.img is None:
             self.img_compressed = None
@@ -553,6 +578,7 @@ class PolarScope(object):
 
     def invalidate_solutions(self):
         self.solution     = None
+        self.pole_filter.reset()
 
     def diag_tick(self, now, before, dur):
         dt = now - before
@@ -566,13 +592,21 @@ class PolarScope(object):
         prev_sol = self.stable_solution()
         if self.expo_code == star_finder.EXPO_JUST_RIGHT:
             self.solution = pole_finder.PoleSolution(self.stars, hot_pixels = self.hot_pixels)
-            if self.solution.solve(self.time_mgr.get_polaris()):
+            # while the mount is only being nudged, the previous solution can be tracked, which is much faster than a full solve
+            tracked = prev_sol is not None and self.solution.track(prev_sol, self.time_mgr.get_polaris())
+            if tracked or self.solution.solve(self.time_mgr.get_polaris()):
                 self.solu_dur = pyb.elapsed_millis(self.t) # debug solution speed
                 self.solution.accel_sec = self.accel_sec
                 self.solution.get_pole_coords() # this caches x and y
+                # the displayed solution is the median of the last few, a solution that jumps away is flagged and not used
+                if self.pole_filter.add(self.solution) == False and self.debug:
+                    print("outlier solution (%.1f , %.1f)" % (self.solution.x, self.solution.y))
+                self.pole_filter.apply(self.solution)
                 if self.stable_solution() is not None:
                     if self.debug and prev_sol is None:
                         print("new solution! matched %u, penalty %u" % (len(self.solution.stars_matched), self.solution.penalty))
+                    elif self.debug and tracked == False:
+                        print("tracking lost, re-solved, matched %u, penalty %u" % (len(self.solution.stars_matched), self.solution.penalty))
                 return True
             else:
                 # no solution means invalidate all solutions
@@ -639,7 +673,8 @@ class PolarScope(object):
 
         if self.cam.snapshot_check():
             # camera has finished an exposure
-            self.img = self.cam.snapshot_finish()
+            # with a copy of the frame, the next exposure can start before the solver and the JPG compression are done with this one
+            self.img, self.img_owned = self.snap_finish()
             if self.img is not None:
                 self.frm_cnt += 1
             else:
@@ -662,12 +697,15 @@ class PolarScope(object):
             if self.daymode:
                 self.cam.init(gain_db = -1, shutter_us = -1)
                 self.snap_millis = pyb.millis()
+                if self.img_owned:
+                    self.cam.snapshot_start()
                 if self.img is not None:
                     self.histogram = self.img.get_histogram()
                     self.img_stats = self.histogram.get_statistics()
                     if self.packjpeg:
                         self.compress_img()
-                self.cam.snapshot_start()
+                if self.img_owned == False:
+                    self.cam.snapshot_start()
                 if self.use_leds:
                     green_led.toggle()
                 return # this will skip solving
@@ -686,7 +724,8 @@ class PolarScope(object):
                 while self.cam.check_init() == False:
                     self.task_network()
 
-            if self.packjpeg == False and self.imgstream_sock is None:
+            need_img = self.img_owned == False and (self.packjpeg or self.imgstream_sock is not None)
+            if need_img == False:
                 self.cam.snapshot_start()
                 self.snap_millis = pyb.millis()
             if self.use_leds:
@@ -698,6 +737,8 @@ class PolarScope(object):
                     self.compress_img()
                     if self.imgstream_sock is not None:
                         self.update_imgstream()
+            if need_img:
+                # no copy, the frame buffer had to be compressed before the camera could use it again
                 self.cam.snapshot_start()
                 self.snap_millis = pyb.millis()
             self.cam_err = self.cam.has_error
@@ -0,0 +1,169 @@
+import micropython
+micropython.opt_level(2)
+
+import math
+import comutils
+from comutils import angle_diff, ang_normalize, SIDEREAL_DAY_SECONDS
+
+# smooths the pole solutions from frame to frame, so the overlay does not jitter
+# keeps the last few solutions and uses the median of the pole coordinates, rotation and scale
+# the rotation of each solution is brought forward to the time of the newest one before the median, the sky keeps turning
+# a solution far from the median is flagged as an outlier and not used, unless a few in a row agree with each other, which means the mount was moved
+
+FILTER_LEN    = micropython.const(5)
+OUTLIER_PX    = micropython.const(6)
+OUTLIER_RESET = micropython.const(2) # this many outliers in a row, start over from them
+CONVERGE_CNT  = micropython.const(4)
+CONVERGE_PX   = 2.0
+CONVERGE_DEG  = 0.5
+
+def median(lst):
+    s = sorted(lst)
+    n = len(s)
+    if (n % 2) == 1:
+        return s[n // 2]
+    return (s[(n // 2) - 1] + s[n // 2]) / 2
+
+class PoleFilter(object):
+
+    def __init__(self, length = FILTER_LEN):
+        self.length = length
+        self.reset()
+
+    def reset(self):
+        self.samples = []
+        self.pending = []
+        self.outlier = False
+        self.x = None
+        self.y = None
+        self.rotation = None
+        self.solu_time = 0
+        self.pix_per_deg = None
+        self.spread = 0
+        self.rot_spread = 0
+
+    def add(self, sol):
+        # sol must be solved, returns False if it was an outlier
+        x, y, r = sol.get_pole_coords()
+        sample = (x, y, sol.get_rotation(compensate = False), sol.solu_time, sol.pix_per_deg)
+        if len(self.samples) > 0 and comutils.vector_between([x, y], [self.x, self.y], mag_only = True) > OUTLIER_PX:
+            # the outliers only count as in a row if they agree with each other, scattered bad solutions start the count over
+            for p in self.pending:
+                if comutils.vector_between([x, y], [p[0], p[1]], mag_only = True) > OUTLIER_PX:
+                    self.pending = []
+                    break
+            self.pending.append(sample)
+            if len(self.pending) < OUTLIER_RESET:
+                self.outlier = True
+                return False
+            # the pole really did move, the mount is being adjusted
+            self.samples = self.pending
+            self.pending = []
+        else:
+            self.pending = []
+            self.samples.append(sample)
+            if len(self.samples) > self.length:
+                self.samples.pop(0)
+        self.outlier = False
+        self.estimate()
+        return True
+
+    def estimate(self):
+        self.x = median([s[0] for s in self.samples])
+        self.y = median([s[1] for s in self.samples])
+        self.pix_per_deg = median([s[4] for s in self.samples])
+        # rotation is taken at the time of the newest sample, the angles are median-ed as differences so that +/-180 does not matter
+        ref = self.samples[-1]
+        self.solu_time = ref[3]
+        diffs = []
+        for s in self.samples:
+            drift = (float(ref[3] - s[3]) * 360.0) / SIDEREAL_DAY_SECONDS
+            diffs.append(angle_diff(s[2] - drift, ref[2]))
+        d = median(diffs)
+        self.rotation = ang_normalize(ref[2] + d)
+        # RMS distance from the median, a single noisy frame does not decide convergence on its own
+        sq = 0.0
+        rsq = 0.0
+        i = 0
+        while i < len(self.samples):
+            s = self.samples[i]
+            dx = s[0] - self.x
+            dy = s[1] - self.y
+            sq += (dx * dx) + (dy * dy)
+            rsq += (diffs[i] - d) * (diffs[i] - d)
+            i += 1
+        self.spread = math.sqrt(sq / len(self.samples))
+        self.rot_spread = math.sqrt(rsq / len(self.samples))
+
+    def apply(self, sol):
+        # puts the smoothed values into a solution, everything that reads the solution afterwards gets them
+        if self.x is None:
+            return
+        sol.x = self.x
+        sol.y = self.y
+        sol.rotation = self.rotation
+        sol.solu_time = self.solu_time
+        sol.pix_per_deg = self.pix_per_deg
+
+    def is_converged(self):
+        # enough recent solutions, and they agree with each other
+        if len(self.samples) < CONVERGE_CNT:
+            return False
+        return self.spread <= CONVERGE_PX and self.rot_spread <= CONVERGE_DEG
+
+def check_filter():
+    # feeds made up solutions through the filter, returns how many checks failed
+    class FakeSolution(object):
+        def __init__(self, x, y, rotation, solu_time = 0, pix_per_deg = 100.0):
+            self.x = x
+            self.y = y
+            self.rotation = rotation
+            self.solu_time = solu_time
+            self.pix_per_deg = pix_per_deg
+        def get_pole_coords(self):
+            return self.x, self.y, self.rotation
+        def get_rotation(self, compensate = True):
+            return self.rotation
+
+    fails = 0
+    def check(cond, msg):
+        if cond:
+            return 0
+        print("pole filter check failed: " + msg)
+        return 1
+
+    # a single solution far from the rest is not used
+    f = PoleFilter()
+    i = 0
+    while i < FILTER_LEN:
+        f.add(FakeSolution(100.0 + (i % 2), 100.0, 10.0))
+        i += 1
+    fails += check(f.add(FakeSolution(100.0 + (OUTLIER_PX * 3), 100.0, 10.0)) == False and f.outlier, "outlier accepted")
+    fails += check(abs(f.x - 100.5) < 1.0, "outlier moved the pole")
+    # outliers that don't agree with each other are all rejected, the count starts over with each one
+    fails += check(f.add(FakeSolution(100.0, 100.0 + (OUTLIER_PX * 3), 10.0)) == False, "scattered outlier accepted")
+    fails += check(len(f.pending) == 1, "scattered outliers counted as in a row")
+    # OUTLIER_RESET agreeing outliers in a row, the mount was moved, start over from them
+    i = 0
+    while i < OUTLIER_RESET:
+        accepted = f.add(FakeSolution(150.0 + i, 150.0, 10.0))
+        i += 1
+        fails += check(accepted == (i >= OUTLIER_RESET), "outlier %u of %u in a row, accepted %s" % (i, OUTLIER_RESET, accepted))
+    fails += check(len(f.samples) == OUTLIER_RESET and abs(f.x - 150.0) <= OUTLIER_RESET and f.outlier == False, "no reset to the new position")
+
+    # rotation close to +/-180, brought forward to the newest sample while the sky turns about one degree every 240 seconds
+    f = PoleFilter()
+    step = (240.0 * 360.0) / SIDEREAL_DAY_SECONDS
+    i = 0
+    while i < FILTER_LEN:
+        f.add(FakeSolution(200.0, 200.0, ang_normalize(180.0 + (step * 2.5) - (step * i)), solu_time = i * 240))
+        i += 1
+    expected = ang_normalize(180.0 + (step * 2.5) - (step * (FILTER_LEN - 1)))
+    fails += check(abs(angle_diff(f.rotation, expected)) < 0.01, "rotation %.3f across +/-180, expected %.3f" % (f.rotation, expected))
+    fails += check(f.rot_spread < 0.01 and f.is_converged(), "rotation spread %.3f across +/-180" % f.rot_spread)
+
+    print("pole filter check, %u failed" % fails)
+    return fails
+
+if __name__ == "__main__":
+    check_filter()
@@ -2,8 +2,11 @@ import micropython
 micropython.opt_level(2)
 import time
 import math
+import array
 import pyb
 import blobstar
+import star_grid
+import frame_registration
 import ujson
 
 import comutils
@@ -45,18 +48,104 @@ STARS_NEAR_POLARIS = micropython.const([
 
 DIST_TOL = micropython.const(0.1)     # percentage
 SCORE_REQUIRED = micropython.const(4) # must have this many stars that match their estimated coordinates
+SCORE_CONFIDENT = micropython.const(12) # a guess that scores this high is taken without trying the rest
+SEARCH_LIMIT = micropython.const(6) # how many of the brightest stars are tried as Polaris
 ENABLE_PENALTY = micropython.const(True)
+ENABLE_REFINE = micropython.const(True)
+REFINE_REJECT_PX = micropython.const(5) # pixels, matched stars farther than this (and 2.5x the RMS) from the fit are left out of the next fit
+REFINE_PASSES = micropython.const(4)
+DIST_INDEX_STEP = math.log(1.0 + DIST_TOL)
+TRACK_WINDOW = micropython.const(40)  # pixels, how far Polaris is allowed to move between frames when tracking
+TRACK_MATCH_PX = micropython.const(15) # pixels, how far a star can be from its predicted location when tracking
+ANG_TOL_MAX = micropython.const(4) # degrees, solve() starts with this angle tolerance and tightens it to 1 as stars match
+
+# the table's angles as unit vectors, and the cosine of every angle tolerance, worked out once here
+# the solver compares directions with dot products instead of angle_match, so there is no trig for every star of every guess
+# angle_match(a, b, tol) is the same as the dot product of the unit vectors of a and b being at least cos(tol), check_unit_vectors() tests that
+STARS_NEAR_POLARIS_COS = [math.cos(math.radians(s[2])) for s in STARS_NEAR_POLARIS]
+STARS_NEAR_POLARIS_SIN = [math.sin(math.radians(s[2])) for s in STARS_NEAR_POLARIS]
+COS_TOL = [math.cos(math.radians(t)) for t in range(ANG_TOL_MAX + 1)]
+
+class Candidate(object):
+    # solver state for one guess of which star is Polaris
+    # the matched stars are indices into the StarList, the arrays are reused for every guess and every frame
+    __slots__ = ("idx", "score", "penalty", "rotation", "rot_angi_sum", "rot_angj_sum", "rot_dist_sum", "lam_umi", "cnt", "matches", "tbl", "pix_cal")
+
+    def __init__(self, capacity):
+        self.matches = array.array('H', [0] * capacity)
+        self.tbl     = array.array('B', [0] * capacity)
+        self.pix_cal = array.array('f', [0] * capacity)
+        self.reset(-1)
+
+    def reset(self, idx, rotation = 0):
+        self.idx = idx
+        self.score = 0
+        self.penalty = 0
+        self.rotation = rotation
+        self.rot_angi_sum = 0
+        self.rot_angj_sum = 0
+        self.rot_dist_sum = 0
+        self.lam_umi = -1
+        self.cnt = 0
+
+    def add_match(self, k, idx_tbl, pix_cal):
+        if self.cnt >= len(self.matches):
+            # the same star can match more than one table entry, so this can outgrow the star list, rarely
+            self.matches.extend(array.array('H', [0] * (self.cnt + 1)))
+            self.tbl.extend(array.array('B', [0] * (self.cnt + 1)))
+            self.pix_cal.extend(array.array('f', [0] * (self.cnt + 1)))
+        self.matches[self.cnt] = k
+        self.tbl[self.cnt] = idx_tbl
+        self.pix_cal[self.cnt] = pix_cal
+        self.cnt += 1
+
+    def add_rot(self, ux, uy, idx_tbl, k_dist):
+        # the star's angle minus the table entry's angle, as a unit vector, weighted by the distance
+        c = STARS_NEAR_POLARIS_COS[idx_tbl]
+        s = STARS_NEAR_POLARIS_SIN[idx_tbl]
+        self.rot_angi_sum += ((ux * c) + (uy * s)) * k_dist
+        self.rot_angj_sum += ((uy * c) - (ux * s)) * k_dist
+        self.rot_dist_sum += k_dist
+
+    def get_rot_vector(self):
+        # the weighted average of the rotation as a unit vector
+        mag = math.sqrt((self.rot_angi_sum * self.rot_angi_sum) + (self.rot_angj_sum * self.rot_angj_sum))
+        if mag <= 0:
+            return 1.0, 0.0
+        return self.rot_angi_sum / mag, self.rot_angj_sum / mag
+
+    def get_rot_angle(self):
+        return math.degrees(math.atan2(self.rot_angj_sum, self.rot_angi_sum))
+
+# scratch state shared by every solution, nothing in here is needed once a solution is found
+candidates = []
+
+def get_candidates(cnt, capacity):
+    while len(candidates) < cnt:
+        candidates.append(Candidate(capacity))
+    return candidates
 
 class PoleSolution(object):
-    def __init__(self, star_list, hot_pixels = [], search_limit = 3, debug = False):
+    # star_list is a blobstar.StarList, star_finder fills the same one again for the next frame, so it is only used until solve() or track() is done
+    def __init__(self, star_list, hot_pixels = [], search_limit = SEARCH_LIMIT, debug = False):
         self.solved = False
         self.star_list = star_list
         self.search_limit = search_limit
         self.hot_pixels = hot_pixels
+        self.hot_grid = None
+        if hot_pixels is not None and len(hot_pixels) > 0:
+            self.hot_grid = star_grid.StarGrid(hot_pixels, cell = 8)
         self.accel_sec = 0
         self.debug = debug
 
     def solve(self, polaris_ra_dec = (2.960856, 89.349278)):
+        # the star list is let go however this returns, it belongs to star_finder and gets filled again for the next frame
+        try:
+            return self._solve(polaris_ra_dec)
+        finally:
+            self.star_list = None
+
+    def _solve(self, polaris_ra_dec):
 
         # polaris_ra_dec default to values at Jan 1 2020
         # supply new values according to current date
@@ -70,178 +159,392 @@ class PoleSolution(object):
         if len(self.star_list) < SCORE_REQUIRED:
             return False # impossible to have a solution if not enough stars
 
+        sl = self.star_list
+        ref_dist = sl.ref_dist
+        ref_ux = sl.ref_ux
+        ref_uy = sl.ref_uy
+
         # Polaris is the brightest object in the potential field of view, so it's faster to start with it
-        brite_sorted = blobstar.sort_brightness(self.star_list)
+        brite_sorted = sl.sort_brightness()
         # limit the search for the first few possibilities
         if len(brite_sorted) > self.search_limit:
             brite_sorted = brite_sorted[0:self.search_limit]
+        cands = get_candidates(len(brite_sorted), len(sl))
 
         # iterate through all posibilities, brightest first
-        for i in brite_sorted:
-            # we are guessing "i" is Polaris for this iteration
-            i.score_list = []
-            i.score = 0
-            i.penalty = 0
-            i.rotation = 0
-            i.rot_angi_sum = 0
-            i.rot_angj_sum = 0
-            i.rot_dist_sum = 0
-            i.pix_calibration = []
-            i.lam_umi = None
-            ang_tol = 4
-
-            for j in self.star_list:
-                j.set_ref_star(i) # this is required for all entries in the list, so that sort_dist can work
-                # set_ref_star also computes the vector to the ref star and caches the result
-            dist_sorted = blobstar.sort_dist(self.star_list) # sorted closest-to-Polaris first
+        # a guess is dropped as soon as it can no longer beat the best one so far
+        # and the search ends as soon as one guess is good enough to be sure of
+        best = None
+        ci = 0
+        for idx_i in brite_sorted:
+            # we are guessing star "idx_i" is Polaris for this iteration
+            i = cands[ci]
+            ci += 1
+            i.reset(idx_i)
+            ang_tol = ANG_TOL_MAX
+
+            sl.set_ref(idx_i) # computes the vector from every star to the guessed Polaris, so that sort_dist can work
+            dist_sorted = sl.sort_dist() # sorted closest-to-Polaris first
 
             if self.debug:
-                print("center star (%.1f , %.1f)" % (i.cx, i.cy))
+                print("center star (%.1f , %.1f)" % (sl.cx[idx_i], sl.cy[idx_i]))
                 dbgi = 0
                 for dbg in dist_sorted:
-                    print("[%u]: (%.1f , %.1f) -> (%.1f , %.1f)" % (dbgi, dbg.cx, dbg.cy, dbg.ref_star_dist, dbg.ref_star_angle))
+                    print("[%u]: (%.1f , %.1f) -> (%.1f , %.1f)" % (dbgi, sl.cx[dbg], sl.cy[dbg], ref_dist[dbg], sl.get_ref_ang(dbg)))
                     dbgi += 1
 
-            rot_ang = None # without a known reference angle, use the first angle we encounter to establish a reference angle
-            # rot_ang is set after the match is made
+            has_rot = False # without a known reference angle, use the first angle we encounter to establish a reference angle
+            # the rotation (ru, rv) is set after the match is made, as a unit vector
+            ru = 1.0
+            rv = 0.0
 
             # these are used for the penalizing later
             max_dist = 0
             min_brite = -1
 
-            idx_tbl = 0
-            idx_blobs_start = 1 # start at [1] because [0] is supposed to be Polaris
-            len_tbl = len(STARS_NEAR_POLARIS)
+            # gather every (table entry, blob) pair that matches by distance, using the distance index
+            # the pair is packed into one integer so that sorting it gives the same order as scanning the table then the blobs
             len_blobs = len(dist_sorted)
-            while idx_tbl < len_tbl:
-
-                # skip stars that might have too similar of a vector distance if the reference angle is not established yet
-                # it is unlikely that this logic is actually useful in real life
-                if rot_ang is None and idx_tbl >= 1:
-                    if abs(STARS_NEAR_POLARIS[idx_tbl][1] - STARS_NEAR_POLARIS[idx_tbl - 1][1]) <= 2:
-                        idx_tbl += 1
-                        continue
-
-                idx_blobs = idx_blobs_start # previous blobs (closer-to-Polaris) will be ignored
-                while idx_blobs < len_blobs:
-                    k = dist_sorted[idx_blobs]
-                    match = False
-                    if dist_match(k.ref_star_dist, STARS_NEAR_POLARIS[idx_tbl][1]):
-
+            pairs = []
+            idx_blobs = 1 # start at [1] because [0] is supposed to be Polaris
+            while idx_blobs < len_blobs:
+                idx_tbl, tbl_end = find_dist_matches(ref_dist[dist_sorted[idx_blobs]])
+                while idx_tbl < tbl_end:
+                    pairs.append((idx_tbl * len_blobs) + idx_blobs)
+                    idx_tbl += 1
+                idx_blobs += 1
+            pairs.sort()
+
+            # every pair can add one match at most, and the penalty can only take some away
+            best_score = -1
+            if best is not None:
+                best_score = best.score
+            len_pairs = len(pairs)
+            if len_pairs <= best_score:
+                if self.debug:
+                    print("skipped, only %u pairs" % len_pairs)
+                continue
+
+            idx_blobs_start = 1
+            prev_tbl = -1
+            skip_tbl = False
+            idx_pair = 0
+            while idx_pair < len_pairs:
+                if i.cnt + (len_pairs - idx_pair) <= best_score:
+                    if self.debug:
+                        print("gave up, score %u, pairs left %u" % (i.cnt, len_pairs - idx_pair))
+                    break
+                p = pairs[idx_pair]
+                idx_pair += 1
+                idx_tbl = p // len_blobs
+                idx_blobs = p % len_blobs
+                if idx_tbl != prev_tbl:
+                    prev_tbl = idx_tbl
+                    tbl_blobs_start = idx_blobs_start # previous blobs (closer-to-Polaris) will be ignored
+                    # skip stars that might have too similar of a vector distance if the reference angle is not established yet
+                    # it is unlikely that this logic is actually useful in real life
+                    skip_tbl = False
+                    if has_rot == False and idx_tbl >= 1:
+                        if abs(STARS_NEAR_POLARIS[idx_tbl][1] - STARS_NEAR_POLARIS[idx_tbl - 1][1]) <= 2:
+                            skip_tbl = True
+                if skip_tbl or idx_blobs < tbl_blobs_start:
+                    continue
+
+                k = dist_sorted[idx_blobs]
+                k_dist = ref_dist[k]
+                ux = ref_ux[k]
+                uy = ref_uy[k]
+                match = False
+
+                if self.debug:
+                    print("dist matched [%s , %u] %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, STARS_NEAR_POLARIS[idx_tbl][1], k_dist, abs(k_dist - STARS_NEAR_POLARIS[idx_tbl][1])))
+
+                if has_rot == False:
+                    # without a known reference angle, use the first angle we encounter to establish a reference angle
+                    # the rotation is set after the match is made
+                    match = True
+                    if self.debug:
+                        k_ang = sl.get_ref_ang(k)
+                        print("first angle match [%s , %u] %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, STARS_NEAR_POLARIS[idx_tbl][2], k_ang, angle_diff(k_ang, STARS_NEAR_POLARIS[idx_tbl][2])))
+                else:
+                    if dir_match(ux, uy, idx_tbl, ru, rv, COS_TOL[ang_tol]):
+                        match = True
+                        if ang_tol > 1:
+                            ang_tol -= 1
                         if self.debug:
-                            print("dist matched [%s , %u] %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, STARS_NEAR_POLARIS[idx_tbl][1], k.ref_star_dist, abs(k.ref_star_dist - STARS_NEAR_POLARIS[idx_tbl][1])))
-
-                        if rot_ang is None:
-                            # without a known reference angle, use the first angle we encounter to establish a reference angle
-                            # rot_ang is set after the match is made
-                            match = True
-                            if self.debug:
-                                print("first angle match [%s , %u] %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, STARS_NEAR_POLARIS[idx_tbl][2], k.ref_star_angle, angle_diff(k.ref_star_angle, STARS_NEAR_POLARIS[idx_tbl][2])))
-                        else:
-                            adj_ang = ang_normalize(STARS_NEAR_POLARIS[idx_tbl][2] + rot_ang)
-                            if angle_match(k.ref_star_angle, adj_ang, tol = ang_tol):
-                                match = True
-                                if ang_tol > 1:
-                                    ang_tol -= 1
-                                if self.debug:
-                                    print("angle matched ", end="")
-                            else:
-                                if self.debug:
-                                    print("angle match failed ", end="")
-                            if self.debug:
-                                print("[%s , %u] %.1f %.1f %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, STARS_NEAR_POLARIS[idx_tbl][2], k.ref_star_angle, angle_diff(k.ref_star_angle, adj_ang), rot_ang, adj_ang))
-                    if match:
-                        # each match is a further star, which means more precise angle
-                        # compute (and update) the weighted average of the angle offset
-                        rot_ang = angle_diff(k.ref_star_angle, STARS_NEAR_POLARIS[idx_tbl][2])
-                        unitvector = [math.cos(math.radians(rot_ang)), math.sin(math.radians(rot_ang))]
-                        i.rot_angi_sum += unitvector[0] * k.ref_star_dist
-                        i.rot_angj_sum += unitvector[1] * k.ref_star_dist
-                        i.rot_dist_sum += k.ref_star_dist
-                        rot_ang = math.degrees(math.atan2(i.rot_angj_sum / i.rot_dist_sum, i.rot_angi_sum / i.rot_dist_sum))
-                        i.rotation = rot_ang
-
-                        if STARS_NEAR_POLARIS[idx_tbl][0] == "* lam UMi":
-                            i.lam_umi = k
-
-                        if k.ref_star_dist > max_dist:
-                            max_dist = k.ref_star_dist # establishes maximum matching area
-                        if k.brightness < min_brite or min_brite < 0:
-                            min_brite = k.brightness # establishes minimum matching brightness
-
-                        # measured vs supposed distances may be different, track the differences
-                        # this will account for distortion and focus-breathing
-                        i.pix_calibration.append(k.ref_star_dist / STARS_NEAR_POLARIS[idx_tbl][1])
-
-                        # all previous (closer-to-Polaris) entries to be ignored on the next loop
-                        idx_blobs_start = idx_blobs # doing this will prevent potential out-of-order matches
-
-                        #i.score_list.append(STARS_NEAR_POLARIS[idx_tbl][0]) # save the name to the list of matches (score)
-                        i.score_list.append(k)
-
+                            print("angle matched ", end="")
+                    else:
                         if self.debug:
-                            print("score %u , new rotation %.1f" % (len(i.score_list), rot_ang))
-
-                    idx_blobs += 1
-                idx_tbl += 1
+                            print("angle match failed ", end="")
+                    if self.debug:
+                        k_ang = sl.get_ref_ang(k)
+                        rot_ang = i.get_rot_angle()
+                        adj_ang = ang_normalize(STARS_NEAR_POLARIS[idx_tbl][2] + rot_ang)
+                        print("[%s , %u] %.1f %.1f %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, STARS_NEAR_POLARIS[idx_tbl][2], k_ang, angle_diff(k_ang, adj_ang), rot_ang, adj_ang))
+                if match:
+                    # each match is a further star, which means more precise angle
+                    # compute (and update) the weighted average of the angle offset
+                    i.add_rot(ux, uy, idx_tbl, k_dist)
+                    ru, rv = i.get_rot_vector()
+                    has_rot = True
+
+                    if STARS_NEAR_POLARIS[idx_tbl][0] == "* lam UMi":
+                        i.lam_umi = k
+
+                    if k_dist > max_dist:
+                        max_dist = k_dist # establishes maximum matching area
+                    if sl.brightness[k] < min_brite or min_brite < 0:
+                        min_brite = sl.brightness[k] # establishes minimum matching brightness
+
+                    # measured vs supposed distances may be different, track the differences
+                    # this will account for distortion and focus-breathing
+                    i.add_match(k, idx_tbl, k_dist / STARS_NEAR_POLARIS[idx_tbl][1])
+
+                    # all previous (closer-to-Polaris) entries to be ignored on the next loop
+                    idx_blobs_start = idx_blobs # doing this will prevent potential out-of-order matches
+
+                    if self.debug:
+                        print("score %u , new rotation %.1f" % (i.cnt, i.get_rot_angle()))
+
+            if i.cnt <= best_score:
+                continue # it gave up, or it just cannot win
+            if has_rot:
+                i.rotation = i.get_rot_angle()
 
             # penalty function is optional
             if ENABLE_PENALTY:
-                # go through all blobs again to see if we should penalize for mystery stars
-                # if a star is brighter than some of the stars we've been able to match against
-                # then it's a mystery star, and makes the solution less confident
-                idx_blobs = 1
-                while idx_blobs < len_blobs:
-                    k = dist_sorted[idx_blobs]
-                    if k.ref_star_dist < max_dist and k.brightness > min_brite:
-                        # within the area and also brighter than expected
-                        # does it match an entry in the table? (some of the table entries were ignored previously, so we have to do the whole check again)
-                        in_database = False
-                        idx_tbl = 0
-                        len_tbl = len(STARS_NEAR_POLARIS)
-                        while idx_tbl < len_tbl:
-                            if dist_match(k.ref_star_dist, STARS_NEAR_POLARIS[idx_tbl][1]) and angle_match(k.ref_star_angle, ang_normalize(STARS_NEAR_POLARIS[idx_tbl][2] + rot_ang)):
-                                in_database = True
-                                break
-                            idx_tbl += 1
-
-                        if in_database == False:
-                            is_hot = False
-                            # check if it's a hot pixel
-                            for hp in self.hot_pixels:
-                                d = math.sqrt(((k.cx - hp[0]) ** 2) + ((k.cy - hp[1]) ** 2))
-                                if d < 2.0:
-                                    is_hot = True
-                                    break
-                            if is_hot == False:
-                                i.penalty += 1
-                                if self.debug:
-                                    print("penalty (%.1f , %.1f)" % (k.cx, k.cy))
-                    idx_blobs += 1
-                # calculate score accounting for penalty
-                i.score = len(i.score_list) - i.penalty
+                self.apply_penalty(i, dist_sorted, ru, rv, max_dist, min_brite, give_up = best_score)
+
+            # on a tie, the brighter guess wins
+            if best is None or i.score > best.score:
+                best = i
+            if best.score >= SCORE_CONFIDENT:
+                break
 
         # end of the for loop that goes from brightest to dimmest
-        # each entry of that list will now have a "score" (number of matches)
-        # find the one that has the most matches
-        score_sorted = sorted(brite_sorted, key = sort_score_func, reverse = True)
-        self.star_list = None # garbage collect
-        if score_sorted[0].score < SCORE_REQUIRED:
+        # best is the one that has the most matches
+        if best is None or best.score < SCORE_REQUIRED:
             return False # not enough matches, no solution
 
+        self.set_solution(best)
+        return True
+
+    def track(self, prev, polaris_ra_dec = None):
+        # re-uses a previous solution instead of solving from scratch
+        # Polaris should be close to where it was, and the rotation is predicted from the previous solution
+        # only stars that land on their predicted spot are accepted, returns False if the solution can't be verified
+        # and then a full solve() should be done
+        if prev is None or prev.solved == False:
+            return False
+        if polaris_ra_dec is None:
+            polaris_ra_dec = prev.polaris_ra_dec
+        self.polaris_ra_dec = polaris_ra_dec
+        self.x = None
+        self.y = None
+        self.lam_umi = None
+        self.solu_time = int(round(pyb.millis() // 1000))
+
+        if len(self.star_list) < SCORE_REQUIRED:
+            return False
+
+        sl = self.star_list
+        ref_dist = sl.ref_dist
+        ref_ux = sl.ref_ux
+        ref_uy = sl.ref_uy
+
+        # Polaris is the brightest star near its previous location
+        px = prev.Polaris.cx
+        py = prev.Polaris.cy
+        idx_i = -1
+        j = 0
+        while j < sl.n:
+            if abs(sl.cx[j] - px) < TRACK_WINDOW and abs(sl.cy[j] - py) < TRACK_WINDOW:
+                if idx_i < 0 or sl.brightness[j] > sl.brightness[idx_i]:
+                    idx_i = j
+            j += 1
+        if idx_i < 0:
+            return False
+
+        # undo the flip, and account for the sky rotating since the previous solution
+        rot_ang = ang_normalize(prev.get_rotation() - 180.0)
+        i = get_candidates(1, len(sl))[0]
+        i.reset(idx_i, rotation = rot_ang)
+        ru = math.cos(math.radians(rot_ang))
+        rv = math.sin(math.radians(rot_ang))
+
+        sl.set_ref(idx_i)
+        dist_sorted = sl.sort_dist()
+
+        # for each table entry, find the star that lands closest to its predicted location
+        pix_cal = prev.pix_per_deg / PIXELS_PER_DEGREE
+        len_tbl = len(STARS_NEAR_POLARIS)
+        tbl_match = [-1] * len_tbl
+        tbl_err = [TRACK_MATCH_PX * TRACK_MATCH_PX] * len_tbl
+        len_blobs = len(dist_sorted)
+        idx_blobs = 1
+        while idx_blobs < len_blobs:
+            k = dist_sorted[idx_blobs]
+            k_dist = ref_dist[k]
+            ux = ref_ux[k]
+            uy = ref_uy[k]
+            idx_tbl, tbl_end = find_dist_matches(k_dist)
+            while idx_tbl < tbl_end:
+                # the predicted direction is the table entry's, rotated by (ru, rv)
+                c = STARS_NEAR_POLARIS_COS[idx_tbl]
+                s = STARS_NEAR_POLARIS_SIN[idx_tbl]
+                tx = (c * ru) - (s * rv)
+                ty = (s * ru) + (c * rv)
+                if (ux * tx) + (uy * ty) <= 0:
+                    idx_tbl += 1
+                    continue # more than 90 degrees off, nowhere near
+                pd = STARS_NEAR_POLARIS[idx_tbl][1] * pix_cal
+                dd = k_dist - pd
+                # sideways error, the sine of the angle between the two directions is close enough to the angle within TRACK_MATCH_PX
+                da = ((uy * tx) - (ux * ty)) * pd
+                err = (dd * dd) + (da * da)
+                if err <= tbl_err[idx_tbl]:
+                    tbl_err[idx_tbl] = err
+                    tbl_match[idx_tbl] = k
+                idx_tbl += 1
+            idx_blobs += 1
+
+        max_dist = 0
+        min_brite = -1
+        idx_tbl = 0
+        while idx_tbl < len_tbl:
+            k = tbl_match[idx_tbl]
+            if k >= 0:
+                # weighted average of the angle offset, same as solve()
+                k_dist = ref_dist[k]
+                i.add_rot(ref_ux[k], ref_uy[k], idx_tbl, k_dist)
+                if STARS_NEAR_POLARIS[idx_tbl][0] == "* lam UMi":
+                    i.lam_umi = k
+                if k_dist > max_dist:
+                    max_dist = k_dist
+                if sl.brightness[k] < min_brite or min_brite < 0:
+                    min_brite = sl.brightness[k]
+                i.add_match(k, idx_tbl, k_dist / STARS_NEAR_POLARIS[idx_tbl][1])
+                if self.debug:
+                    print("track matched [%s] %.1f %.1f err %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], k_dist, sl.get_ref_ang(k), math.sqrt(tbl_err[idx_tbl])))
+            idx_tbl += 1
+
+        if i.cnt < SCORE_REQUIRED:
+            return False
+        i.rotation = i.get_rot_angle()
+        i.score = i.cnt
+        if ENABLE_PENALTY:
+            ru, rv = i.get_rot_vector()
+            self.apply_penalty(i, dist_sorted, ru, rv, max_dist, min_brite)
+        if i.score < SCORE_REQUIRED:
+            return False # star_list is kept so solve() can still be called
+
+        self.set_solution(i)
+        self.star_list = None # garbage collect
+        return True
+
+    def apply_penalty(self, i, dist_sorted, ru, rv, max_dist, min_brite, give_up = -1):
+        # go through all blobs again to see if we should penalize for mystery stars
+        # if a star is brighter than some of the stars we've been able to match against
+        # then it's a mystery star, and makes the solution less confident
+        # stops counting once the score drops to give_up, it has lost to another guess by then
+        sl = self.star_list
+        ref_dist = sl.ref_dist
+        ref_ux = sl.ref_ux
+        ref_uy = sl.ref_uy
+        len_blobs = len(dist_sorted)
+        idx_blobs = 1
+        while idx_blobs < len_blobs:
+            k = dist_sorted[idx_blobs]
+            if ref_dist[k] < max_dist and sl.brightness[k] > min_brite:
+                # within the area and also brighter than expected
+                # does it match an entry in the table? (some of the table entries were ignored previously, so we have to do the whole check again)
+                in_database = False
+                idx_tbl, tbl_end = find_dist_matches(ref_dist[k])
+                while idx_tbl < tbl_end:
+                    if dir_match(ref_ux[k], ref_uy[k], idx_tbl, ru, rv):
+                        in_database = True
+                        break
+                    idx_tbl += 1
+
+                if in_database == False:
+                    is_hot = False
+                    # check if it's a hot pixel
+                    if self.hot_grid is not None:
+                        is_hot = self.hot_grid.any_within(sl.cx[k], sl.cy[k], 2.0)
+                    if is_hot == False:
+                        i.penalty += 1
+                        if self.debug:
+                            print("penalty (%.1f , %.1f)" % (sl.cx[k], sl.cy[k]))
+                        if i.cnt - i.penalty <= give_up:
+                            break
+            idx_blobs += 1
+        # calculate score accounting for penalty
+        i.score = i.cnt - i.penalty
+
+    def set_solution(self, best):
+        # copies what is needed out of the scratch state, star objects are only made for the stars the solution keeps
+        sl = self.star_list
         self.solved = True
         # store the solution states
-        self.Polaris = score_sorted[0]
-        self.rotation = score_sorted[0].rotation
+        self.Polaris = sl.get_star(best.idx)
+        self.rotation = best.rotation
         self.rotation = ang_normalize(self.rotation + 180.0) # everything needs to be flipped
-        self.stars_matched = score_sorted[0].score_list # for debug purposes
-        self.penalty = score_sorted[0].penalty
-        self.lam_umi = score_sorted[0].lam_umi
+        self.stars_matched = [None] * best.cnt # for debug purposes
         dist_calibration = 0
-        for i in score_sorted[0].pix_calibration:
-            dist_calibration += i
-        dist_calibration /= len(score_sorted[0].pix_calibration)
+        j = 0
+        while j < best.cnt:
+            self.stars_matched[j] = sl.get_star(best.matches[j])
+            dist_calibration += best.pix_cal[j]
+            j += 1
+        self.penalty = best.penalty
+        self.lam_umi = None
+        if best.lam_umi >= 0:
+            self.lam_umi = sl.get_star(best.lam_umi)
+        dist_calibration /= best.cnt
         self.pix_per_deg = PIXELS_PER_DEGREE * dist_calibration
+        self.center = (self.Polaris.cx, self.Polaris.cy)
+        self.residual_rms = None
+        self.residual_max = None
+        if ENABLE_REFINE:
+            self.refine(best)
+
+    def refine(self, best):
+        # the rotation and scale above come from averages over the matched stars, and the pole is placed relative to Polaris alone
+        # this fits rotation, scale and Polaris' position together, by least squares over Polaris and all the matched stars
+        # the table holds the vector from each star to Polaris, so a star's position in "table space" is the negative of that vector, and Polaris is at (0, 0)
+        # a star can be matched to two table entries that are close together, the wrong one lands far off the fit, so it is left out and the fit is done again
+        # the residuals of the final fit tell how well the stars agree with the solution, in pixels
+        sl = self.star_list
+        pairs = [(0.0, 0.0, sl.cx[best.idx], sl.cy[best.idx])]
+        j = 0
+        while j < best.cnt:
+            k = best.matches[j]
+            tbl = STARS_NEAR_POLARIS[best.tbl[j]]
+            pairs.append((-tbl[1] * STARS_NEAR_POLARIS_COS[best.tbl[j]], -tbl[1] * STARS_NEAR_POLARIS_SIN[best.tbl[j]], sl.cx[k], sl.cy[k]))
+            j += 1
+        fit = frame_registration.fit_all(pairs)
+        passes = 0
+        while fit is not None:
+            rms, worst = fit_residuals(fit, pairs)
+            limit = max(REFINE_REJECT_PX, rms * 2.5)
+            if worst <= limit or passes >= REFINE_PASSES:
+                break
+            good = []
+            for p in pairs:
+                if fit.residual(p) <= limit:
+                    good.append(p)
+            if len(good) < SCORE_REQUIRED + 1:
+                return False
+            pairs = good
+            fit = frame_registration.fit_all(pairs)
+            passes += 1
+        if fit is None:
+            return False
+        self.rotation = ang_normalize(fit.get_rotation() + 180.0) # everything needs to be flipped, same as above
+        self.pix_per_deg = PIXELS_PER_DEGREE * fit.get_scale()
+        self.center = (fit.tx, fit.ty) # where Polaris is according to the fit, the table's origin
+        self.residual_rms = rms
+        self.residual_max = worst
         return True
 
     def get_rotation(self, compensate = True, offset = 0):
@@ -261,12 +564,13 @@ class PoleSolution(object):
             raise Exception("no solution")
         if self.x is not None:
             return self.x, self.y, self.get_rotation()
-        x, y, r = self.get_pole_coords_for(self.Polaris)
+        x, y, r = self.get_pole_coords_for(self.center)
         self.x = x
         self.y = y
         return self.x, self.y, self.get_rotation()
 
     def get_pole_coords_for(self, star):
+        # star can be a star or a (x, y) pair
         if self.solved == False:
             raise Exception("no solution")
         rahr  = self.polaris_ra_dec[0]
@@ -277,18 +581,11 @@ class PoleSolution(object):
         phi = math.radians(ra_adj + 180.0)
         dx = rho * math.cos(phi)
         dy = rho * math.sin(phi)
-        x = star.cx + dx
-        y = star.cy + dy # y is flipped!
+        sx, sy = star_grid.star_xy(star)
+        x = sx + dx
+        y = sy + dy # y is flipped!
         return x, y, self.get_rotation()
 
-    def compare(self, tgt):
-        if tgt.solved == False:
-            return False
-        x, y, r = self.get_pole_coords()
-        if abs(tgt.x - x) < 1.0 and abs(tgt.y - y) < 1.0 and abs(angle_diff(tgt.rotation, r)) < 1.0:
-            return True
-        return False
-
     def to_jsonobj(self):
         x, y, r = self.get_pole_coords()
         obj = {}
@@ -301,12 +598,72 @@ class PoleSolution(object):
         obj.update({"py": self.Polaris.cy})
         obj.update({"matches": blobstar.to_jsonobj(self.stars_matched)})
         obj.update({"penalty": self.penalty})
+        obj.update({"rms": self.residual_rms})
+        obj.update({"res_max": self.residual_max})
         #if self.lam_umi is not None:
         #    obj.update({"lam_umi": self.lam_umi.to_jsonobj()})
         #else:
         #    obj.update({"lam_umi": None})
         return obj
 
+def fit_residuals(fit, pairs):
+    # RMS and worst residual of a fit, in pixels
+    sq = 0.0
+    worst = 0.0
+    for p in pairs:
+        r = fit.residual(p)
+        sq += r * r
+        if r > worst:
+            worst = r
+    return math.sqrt(sq / len(pairs)), worst
+
+def build_dist_index(tbl):
+    # the table is sorted by distance, so all entries that can match a measured distance are next to each other
+    # bucket the table by log(distance), each bucket being DIST_TOL wide, and remember where each bucket starts
+    # the list covers every bucket from the closest to the furthest entry, plus one extra at the end
+    key_first = int(math.log(tbl[0][1]) / DIST_INDEX_STEP)
+    key_last  = int(math.log(tbl[-1][1]) / DIST_INDEX_STEP)
+    index = [0] * (key_last - key_first + 2)
+    idx_tbl = 0
+    len_tbl = len(tbl)
+    k = 0
+    while k < len(index):
+        while idx_tbl < len_tbl and int(math.log(tbl[idx_tbl][1]) / DIST_INDEX_STEP) < key_first + k:
+            idx_tbl += 1
+        index[k] = idx_tbl
+        k += 1
+    return key_first, index
+
+def find_dist_matches(dist, tbl = STARS_NEAR_POLARIS, index = None):
+    # returns the range (start, end) of table entries that pass dist_match
+    if index is None:
+        index = STARS_NEAR_POLARIS_INDEX
+    key_first, starts = index
+    if dist <= 0:
+        return 0, 0
+    len_tbl = len(tbl)
+    len_idx = len(starts)
+    k = int(math.log(dist * (1.0 - DIST_TOL)) / DIST_INDEX_STEP) - key_first
+    if k < 0:
+        start = 0
+    elif k >= len_idx:
+        return 0, 0
+    else:
+        start = starts[k]
+    k = int(math.log(dist * (1.0 + DIST_TOL)) / DIST_INDEX_STEP) - key_first + 1
+    if k < 0:
+        return 0, 0
+    elif k >= len_idx:
+        end = len_tbl
+    else:
+        end = starts[k]
+    # trim the ends of the range, only the entries in the edge buckets need checking
+    while start < end and dist_match(dist, tbl[start][1]) == False and tbl[start][1] < dist:
+        start += 1
+    while end > start and dist_match(dist, tbl[end - 1][1]) == False and tbl[end - 1][1] > dist:
+        end -= 1
+    return start, end
+
 def dist_match(x, y):
     err_tol = x * DIST_TOL
     abs_err = abs(x - y)
@@ -316,9 +673,62 @@ def angle_match(x, y, tol = 1.0):
     d = abs(angle_diff(x, y))
     return d <= tol
 
-def sort_score_func(x):
-    return x.score
+def dir_match(ux, uy, idx_tbl, ru, rv, cos_tol = COS_TOL[1]):
+    # same as angle_match(star's angle, table entry's angle + rotation, tol) with every angle as a unit vector
+    c = STARS_NEAR_POLARIS_COS[idx_tbl]
+    s = STARS_NEAR_POLARIS_SIN[idx_tbl]
+    return (ux * ((c * ru) - (s * rv))) + (uy * ((s * ru) + (c * rv))) >= cos_tol
+
+def check_unit_vectors(cnt = 2000):
+    # the solver uses dir_match and Candidate.add_rot instead of angle_match and trig on angles, this checks that they give the same answers
+    # random star angles and rotations against random table entries and every tolerance solve() uses, mostly close to the tolerance
+    # an angle within a hundredth of a degree of the tolerance can go either way with single precision floats, those are not counted
+    # returns how many checks failed
+    import random
+    fails = 0
+    n = 0
+    while n < cnt:
+        n += 1
+        idx_tbl = random.randint(0, len(STARS_NEAR_POLARIS) - 1)
+        tol = random.randint(1, ANG_TOL_MAX)
+        rot = random.uniform(-180.0, 180.0)
+        adj_ang = ang_normalize(STARS_NEAR_POLARIS[idx_tbl][2] + rot)
+        ang = ang_normalize(adj_ang + random.uniform(-2.0 * tol, 2.0 * tol))
+        if abs(abs(angle_diff(ang, adj_ang)) - tol) < 0.01:
+            continue
+        m = dir_match(math.cos(math.radians(ang)), math.sin(math.radians(ang)), idx_tbl, math.cos(math.radians(rot)), math.sin(math.radians(rot)), COS_TOL[tol])
+        if m != angle_match(ang, adj_ang, tol = tol):
+            fails += 1
+            print("dir_match wrong: table %u, angle %.3f, rotation %.3f, tolerance %u" % (idx_tbl, ang, rot, tol))
+    # the weighted average of the rotation, same way as solve() used to do it with angles
+    cand = Candidate(1)
+    n = 0
+    while n < cnt // 10:
+        n += 1
+        cand.reset(-1)
+        rot = random.uniform(-180.0, 180.0)
+        sum_i = 0
+        sum_j = 0
+        j = 0
+        while j < 8:
+            j += 1
+            idx_tbl = random.randint(0, len(STARS_NEAR_POLARIS) - 1)
+            k_dist = random.uniform(50.0, 1300.0)
+            ang = ang_normalize(STARS_NEAR_POLARIS[idx_tbl][2] + rot + random.uniform(-1.0, 1.0))
+            cand.add_rot(math.cos(math.radians(ang)), math.sin(math.radians(ang)), idx_tbl, k_dist)
+            a = angle_diff(ang, STARS_NEAR_POLARIS[idx_tbl][2])
+            sum_i += math.cos(math.radians(a)) * k_dist
+            sum_j += math.sin(math.radians(a)) * k_dist
+        err = abs(angle_diff(cand.get_rot_angle(), math.degrees(math.atan2(sum_j, sum_i))))
+        if err > 0.001:
+            fails += 1
+            print("add_rot wrong: rotation %.3f, error %.5f" % (rot, err))
+    print("unit vector check, %u failed" % fails)
+    return fails
+
+STARS_NEAR_POLARIS_INDEX = build_dist_index(STARS_NEAR_POLARIS)
 
 if __name__ == "__main__":
+    check_unit_vectors()
     import test_bench
     test_bench.test()
@@ -15,8 +15,7 @@ def test():
 
     i = 0
     while i < len(stars):
-        s = stars[i]
-        print("[%u]: [%.1f, %.1f, %.1f, %.1f]" %(i, s.cx, s.cx, s.r, s.brightness))
+        print("[%u]: [%.1f, %.1f, %.1f, %.1f]" %(i, stars.cx[i], stars.cy[i], stars.r[i], stars.brightness[i]))
         i += 1
 
     solution = pole_finder.PoleSolution(stars, search_limit = 1, debug = True)
@@ -50,7 +50,7 @@ function test_guidescope(vis)
     ori_coord = [0,0];
 
     star_list = null;
-    var stars_str = "";
+    var stars = [];
     var i;
     for (i = 0; i < num_stars; i++)
     {
@@ -59,8 +59,7 @@ function test_guidescope(vis)
         var x = parseInt(Math.round(Math.random() * sensor_width));
         var y = parseInt(Math.round(Math.random() * sensor_height));
         var rating = parseInt(Math.round(Math.random() * 100));
-        var s = x.toString() + "," + y.toString() + "," + r.toString() + "," + b.toString() + "," + rating.toString() + ";";
-        stars_str += s;
+        stars.push({"cx": x, "cy": y, "r": r, "max_brite": b, "rating": rating});
         if (i == sel_i)
         {
             selected_star[0] = x;
@@ -72,7 +71,7 @@ function test_guidescope(vis)
         }
     }
 
-    obj["stars"] = stars_str;
+    obj["stars"] = stars;
 
     var angle = Math.random() * 360.0;
 
@@ -80,32 +80,6 @@ function fmtDate(x)
     return da + "-" + mo + "-" + ye;
 }
 
-function parseStarsStr(x)
-{
-    var stars = [];
-    var chunks = x.split(";");
-    var i;
-    for (i = 0; i < chunks.length; i++)
-    {
-        var chunk = chunks[i];
-        if (chunk.includes(","))
-        {
-            var data = chunk.split(",");
-            var star = {};
-            star["cx"] = parseFloat(data[0]);
-            star["cy"] = parseFloat(data[1]);
-            if (data.length > 2)
-            {
-                star["r"]  = parseInt(data[2]);
-                star["max_brite"] = parseInt(data[3]);
-                star["rating"]    = parseInt(data[4]);
-            }
-            stars.push(star);
-        }
-    }
-    return stars;
-}
-
 var ui_list = {};
 var autopopulate_func_list = {};
 var autopopulate_dict_list = {};
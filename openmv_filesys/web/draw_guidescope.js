@@ -90,7 +90,7 @@ function draw_guidescope(obj)
 
     if (need_parse_stars && obj != null) {
         if (obj["stars"] != null && obj["stars"] != false) {
-            star_list = parseStarsStr(obj["stars"]);
+            star_list = obj["stars"];
         }
     }
 
@@ -15,6 +15,7 @@ function websocket_init(page)
     var sock_url = "ws://" + domain + "/" + page;
     console.log("websocket init to " + sock_url);
     socket = new WebSocket(sock_url);
+    socket.binaryType = "arraybuffer";
     socket_state = 1;
 
     socket.onopen = function (evt) {
@@ -73,7 +74,11 @@ function websocket_init(page)
         }
         else
         {
-            if (typeof websock_onmessage_data === "function") {
+            var pkt = websock_decode_packet(d);
+            if (pkt != null && typeof websock_onmessage_jsonobj === "function") {
+                websock_onmessage_jsonobj(pkt);
+            }
+            else if (typeof websock_onmessage_data === "function") {
                 websock_onmessage_data(evt.data);
             }
             else {
@@ -153,3 +158,199 @@ function websock_tryclose()
         socket = null;
     }
 }
+
+// binary packets from the camera, see guider_packet.py for the layout
+// they are turned back into the same objects that used to be sent as JSON
+
+const PKT_MAGIC   = 0xA7;
+const PKT_VERSION = 2;
+const PKT_STATE   = 1;
+const PKT_LOGS    = 2;
+const HEADER_LEN  = 8;
+const STATE_LEN   = 73; // length of STATE_FMT in guider_packet.py, the fields read before the star list
+
+function PacketReader(buf)
+{
+    this.view = new DataView(buf);
+    this.bytes = new Uint8Array(buf);
+    this.pos = 0;
+}
+
+PacketReader.prototype.u8  = function() { var x = this.view.getUint8 (this.pos);       this.pos += 1; return x; };
+PacketReader.prototype.i8  = function() { var x = this.view.getInt8  (this.pos);       this.pos += 1; return x; };
+PacketReader.prototype.u16 = function() { var x = this.view.getUint16(this.pos, true); this.pos += 2; return x; };
+PacketReader.prototype.i16 = function() { var x = this.view.getInt16 (this.pos, true); this.pos += 2; return x; };
+PacketReader.prototype.u32 = function() { var x = this.view.getUint32(this.pos, true); this.pos += 4; return x; };
+PacketReader.prototype.i32 = function() { var x = this.view.getInt32 (this.pos, true); this.pos += 4; return x; };
+PacketReader.prototype.f32 = function() { var x = this.view.getFloat32(this.pos, true); this.pos += 4; return x; };
+
+PacketReader.prototype.varint = function()
+{
+    // zigzag encoded, 7 bits per byte, multiplication instead of shifts so that it works past 31 bits
+    var x = 0;
+    var mul = 1;
+    var b;
+    do {
+        b = this.u8();
+        x += (b & 0x7F) * mul;
+        mul *= 128;
+    } while ((b & 0x80) != 0);
+    return (x % 2 == 0) ? (x / 2) : (-(x + 1) / 2);
+};
+
+PacketReader.prototype.str = function()
+{
+    var n = this.varint();
+    var x = new TextDecoder("utf-8").decode(this.bytes.subarray(this.pos, this.pos + n));
+    this.pos += n;
+    return x;
+};
+
+function websock_decode_logs(rd, obj)
+{
+    var n, i, last, last_time;
+    n = rd.u8();
+    last = 0;
+    last_time = 0;
+    for (i = 0; i < n; i++)
+    {
+        last += rd.varint();
+        last_time += rd.varint();
+        obj["msg_tick_" + i] = last;
+        obj["msg_time_" + i] = last_time;
+        obj["msg_str_"  + i] = rd.str();
+    }
+    n = rd.u8();
+    last = 0;
+    for (i = 0; i < n; i++)
+    {
+        last += rd.varint();
+        obj["pulse_time_"    + i] = last;
+        obj["pulse_ra_"      + i] = rd.f32();
+        obj["pulse_dec_"     + i] = rd.f32();
+        obj["pulse_sum_"     + i] = rd.f32();
+        obj["pulse_shutter_" + i] = rd.u8();
+    }
+    return obj;
+}
+
+function websock_decode_state(rd, obj)
+{
+    obj["session_rand_id"] = rd.u16();
+    obj["ws_rand_id"]      = rd.u32();
+    obj["guide_state"]     = rd.u8();
+    obj["interval_state"]  = rd.u8();
+    obj["expo_code"]       = rd.i8();
+    obj["expo_suggest"]    = rd.i8();
+    var flags = rd.u16();
+    obj["blub_remaining"]  = rd.u16();
+    obj["dither_interval"] = rd.u16();
+    var img_mean  = rd.u16() / 100;
+    var img_stdev = rd.u16() / 100;
+    var img_max   = rd.u8();
+    var img_min   = rd.u8();
+    obj["img"] = (flags & 0x01) != 0;
+    if (obj["img"]) {
+        obj["img_mean"]  = img_mean;
+        obj["img_stdev"] = img_stdev;
+        obj["img_max"]   = img_max;
+        obj["img_min"]   = img_min;
+    }
+    var sel = [rd.i16() / 10, rd.i16() / 10];
+    var tgt = [rd.i16() / 10, rd.i16() / 10];
+    var ori = [rd.i16() / 10, rd.i16() / 10];
+    obj["sel_star"]  = ((flags & 0x02) != 0) ? sel : null;
+    obj["tgt_coord"] = ((flags & 0x04) != 0) ? tgt : null;
+    obj["ori_coord"] = ((flags & 0x08) != 0) ? ori : null;
+    obj["last_move_err"] = rd.f32();
+    obj["multistar_cnt"] = [rd.u16(), rd.u16()];
+    obj["field_rot"]     = rd.f32();
+    obj["thresh"]        = rd.u16();
+    var hotpix_cnt  = rd.u16();
+    var hotpix_last = rd.u16();
+    obj["hotpix"] = (flags & 0x10) != 0;
+    if (obj["hotpix"]) {
+        obj["hotpix_used"] = (flags & 0x20) != 0;
+        obj["hotpix_cnt"]  = hotpix_cnt;
+        obj["hotpix_last"] = hotpix_last;
+    }
+    obj["hw_err"] = rd.u8();
+    obj["analysis_dur"] = [rd.i32(), rd.i32(), rd.i32(), rd.i32(), rd.i32()];
+    if (rd.pos != HEADER_LEN + STATE_LEN) {
+        throw "state block read " + (rd.pos - HEADER_LEN).toString() + " bytes instead of " + STATE_LEN.toString();
+    }
+
+    var n = rd.u16();
+    if (n == 0xFFFF) {
+        obj["stars"] = null;
+    }
+    else {
+        var stars = [];
+        var i;
+        for (i = 0; i < n; i++)
+        {
+            var star = {};
+            star["cx"]        = rd.u16() / 10;
+            star["cy"]        = rd.u16() / 10;
+            star["r"]         = rd.u8();
+            star["max_brite"] = rd.u8();
+            star["rating"]    = rd.u8();
+            stars.push(star);
+        }
+        obj["stars"] = stars;
+    }
+    if (obj["sel_star"] != null) {
+        n = rd.u8();
+        obj["sel_star_profile"] = Array.from(rd.bytes.subarray(rd.pos, rd.pos + n));
+        rd.pos += n;
+    }
+    obj["logs"] = websock_decode_logs(rd, {});
+    var extras = JSON.parse(rd.str());
+    var k;
+    for (k in extras) {
+        obj[k] = extras[k];
+    }
+    return obj;
+}
+
+function websock_decode_packet(buf)
+{
+    // returns null if this is not one of our packets
+    if ((buf instanceof ArrayBuffer) == false || buf.byteLength < 8) {
+        return null;
+    }
+    var rd = new PacketReader(buf);
+    if (rd.u8() != PKT_MAGIC) {
+        return null;
+    }
+    var ver = rd.u8();
+    if (ver != PKT_VERSION) {
+        console.log("websocket packet version " + ver.toString() + " is not supported");
+        return null;
+    }
+    var typ = rd.u8();
+    var fixed_len = rd.u8();
+    if (typ == PKT_STATE && fixed_len != STATE_LEN) {
+        console.log("websocket state packet has a " + fixed_len.toString() + " byte state block, this page expects " + STATE_LEN.toString());
+        return null;
+    }
+    var obj = {};
+    obj["time"] = rd.u32();
+    try
+    {
+        if (typ == PKT_STATE) {
+            obj["pkt_type"] = "state";
+            return websock_decode_state(rd, obj);
+        }
+        else if (typ == PKT_LOGS) {
+            obj["pkt_type"] = "logs";
+            return websock_decode_logs(rd, obj);
+        }
+    }
+    catch (e) {
+        console.log("websocket packet cannot be decoded: " + e);
+        return null;
+    }
+    console.log("websocket packet type " + typ.toString() + " is unknown");
+    return null;
+}
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# host side stand-in for the custom firmware's "guidepulser" module (py_guidepulser.c)
+# nothing is connected, the pulses are only timed and remembered in "moves" so that tools can look at them
+
+import pyb
+
+move_start = 0
+move_end = 0
+moving = False
+shutter_time = 0
+shutter_flag = False
+panic_state = 0
+flip_ra = 1
+flip_dec = 1
+led_enable = True
+hw_err = 0
+moves = [] # (start millis, ra, dec), ra and dec already flipped
+
+def init():
+    global moves
+    stop()
+    halt_shutter()
+    moves = []
+
+def write(x):
+    pass
+
+def move(ra, dec, grace):
+    global move_start, move_end, moving
+    ra = int(ra) * flip_ra
+    dec = int(dec) * flip_dec
+    t = pyb.millis()
+    move_start = t
+    moving = ra != 0 or dec != 0
+    move_end = t + max(abs(ra), abs(dec)) + int(grace)
+    moves.append((t, ra, dec))
+    return move_end
+
+def stop():
+    global move_end, moving
+    move_end = 0
+    moving = False
+
+def task():
+    global shutter_flag
+    if shutter_flag and pyb.millis() >= shutter_time:
+        shutter_flag = False
+
+def panic(sts):
+    global panic_state
+    panic_state = int(sts)
+    if panic_state != 0:
+        stop()
+
+def shutter(tspan):
+    global shutter_time, shutter_flag
+    shutter_flag = True
+    shutter_time = pyb.millis() + (int(tspan) * 1000)
+
+def halt_shutter():
+    global shutter_flag
+    shutter_flag = False
+
+def is_moving():
+    return pyb.millis() < move_end and moving
+
+def get_stop_time():
+    return move_end
+
+def get_start_time():
+    return move_start
+
+def get_flip_ra():
+    return flip_ra
+
+def get_flip_dec():
+    return flip_dec
+
+def set_flip_ra(x):
+    global flip_ra
+    flip_ra = -1 if x <= 0 else 1
+
+def set_flip_dec(x):
+    global flip_dec
+    flip_dec = -1 if x <= 0 else 1
+
+def get_hw_err():
+    return hw_err
+
+def is_shutter_open():
+    task()
+    return shutter_flag
+
+def shutter_remaining():
+    if shutter_flag == False:
+        return 0
+    return max(0, shutter_time - pyb.millis()) // 1000
+
+def is_panicking():
+    return panic_state != 0
+
+def enable_led():
+    global led_enable
+    led_enable = True
+
+def disable_led():
+    global led_enable
+    led_enable = False
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+
+# host side stand-in for the custom firmware's "guidestar" module (py_guidestar.c)
+# the firmware does its math with 32 bit floats, here it is done with Python floats, results can differ in the last digits
+# the star against star searches are done with numpy arrays and a grid hash instead of the nested loops, the results are the same as the loops would give
+
+import math
+import numpy as np
+
+SENSOR_WIDTH  = 2592
+SENSOR_HEIGHT = 1944
+SENSOR_DIAG   = 3240
+
+BEST_MAXBRIGHT = 256 - 64
+
+class CGuideStar(object):
+
+    def __init__(self, blob):
+        self.blob = blob
+        self._star_rating = 0
+        self._clustered = 0
+
+    def __repr__(self):
+        return "{\"obj_type\":\"CGuideStar\",\"cx\":%0.1f,\"cy\":%0.1f}" % (self.blob.cxf(), self.blob.cyf())
+
+    def cxf(self):
+        return self.blob.cxf()
+
+    def cyf(self):
+        return self.blob.cyf()
+
+    def r(self):
+        return (self.blob.w() + self.blob.h()) // 3
+
+    def pixels(self):
+        return self.blob.pixels()
+
+    def max_brightness(self):
+        return self.blob.max_brightness()
+
+    def brightness_sum(self):
+        return self.blob.brightness_sum()
+
+    def star_pointiness(self):
+        return self.blob.star_pointiness()
+
+    def star_profile(self):
+        return self.blob.star_profile()
+
+    def clustered(self):
+        return self._clustered
+
+    def star_rating(self):
+        return self._star_rating
+
+    def eval(self):
+        b = self.blob.max_brightness()
+        if b >= BEST_MAXBRIGHT and b != 254:
+            score_maxbright = 100
+        elif b < BEST_MAXBRIGHT:
+            score_maxbright = map_val_int(b, 0, BEST_MAXBRIGHT, 0, 100)
+        else:
+            score_maxbright = 75
+
+        satcnt = self.blob.saturation_cnt()
+        score_saturation = 100
+        if satcnt > 1:
+            score_saturation -= map_val_int(satcnt, 0, self.blob.pixels(), 0, 100)
+
+        total = (self.blob.star_pointiness() * 66) + (score_maxbright * 17) + (score_saturation * 17)
+        if self._clustered > 0:
+            total = c_div(total, 4)
+        if satcnt >= 9:
+            total = c_div(total, 2)
+        total = c_div(total + 50, 100)
+        self._star_rating = total
+        return total
+
+    def coord(self):
+        return (float(self.blob.cxf()), float(self.blob.cyf()))
+
+    def clone(self):
+        b = self.blob
+        nb = b.__class__.__new__(b.__class__)
+        nb.__dict__.update(b.__dict__)
+        o = CGuideStar(nb)
+        o._star_rating = self._star_rating
+        o._clustered = self._clustered
+        return o
+
+    def move_coord(self, x, y):
+        self.blob.move_coord(x, y)
+
+def blob2guidestar(blob):
+    return CGuideStar(blob)
+
+def blobs2guidestars(blob_list):
+    return [CGuideStar(b) for b in blob_list]
+
+def c_div(a, b):
+    # integer division that truncates towards zero like C does
+    if b == 0:
+        return 0 # the Cortex-M7 returns zero instead of faulting
+    q = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        return -q
+    return q
+
+def map_val_int(x, in_min, in_max, out_min, out_max):
+    y = (x - in_min) * (out_max - out_min)
+    div = in_max - in_min
+    y += c_div(div, 2)
+    y = c_div(y, div)
+    return y + out_min
+
+def calc_dist_float(x1, y1, x2, y2):
+    dx = x1 - x2
+    dy = y1 - y2
+    return math.sqrt((dx * dx) + (dy * dy))
+
+def fast_roundf(x):
+    # vcvtr rounds half to even, same as Python
+    return int(round(x))
+
+def guidestar_sort(star_list):
+    # the firmware uses qsort, which is not stable, so stars with the same rating might be in a different order
+    star_list.sort(key = lambda x: x._star_rating, reverse = True)
+
+def _coords(star_list):
+    return np.array([i.cxf() for i in star_list], dtype = np.float64), np.array([i.cyf() for i in star_list], dtype = np.float64)
+
+def _dist_matrix(x1, y1, x2, y2):
+    # every point of the first set against every point of the second, same arithmetic as calc_dist_float
+    dx = x1[:, None] - x2[None, :]
+    dy = y1[:, None] - y2[None, :]
+    return np.sqrt((dx * dx) + (dy * dy))
+
+class _StarGrid(object):
+    # grid hash over the star centroids, every cell lists the stars inside it in their original order
+    # a search only looks at the 3x3 cells around a point, so it finds every star closer than the cell size
+    # same idea as openmv_mpy/star_grid.py, but all the points are searched at once with numpy
+
+    def __init__(self, x, y, cell):
+        self.x = x
+        self.y = y
+        self.cell = float(max(1, cell))
+        cx = np.floor(x / self.cell).astype(np.int64)
+        cy = np.floor(y / self.cell).astype(np.int64)
+        self.x0 = int(cx.min())
+        self.y0 = int(cy.min())
+        self.cols = int(cx.max()) - self.x0 + 1
+        self.rows = int(cy.max()) - self.y0 + 1
+        key = ((cy - self.y0) * self.cols) + (cx - self.x0)
+        self.order = np.argsort(key, kind = "stable")
+        key = key[self.order]
+        cells = np.arange(self.rows * self.cols)
+        self.start = np.searchsorted(key, cells, side = "left")
+        self.count = np.searchsorted(key, cells, side = "right") - self.start
+        self.occupancy = int(self.count.max())
+
+    def width(self):
+        # number of candidates returned per point by candidates()
+        return 9 * self.occupancy
+
+    def candidates(self, qx, qy):
+        # indices of the stars in the 3x3 cells around every point, padded with -1
+        qcx = np.floor(qx / self.cell).astype(np.int64) - self.x0
+        qcy = np.floor(qy / self.cell).astype(np.int64) - self.y0
+        slot = np.arange(self.occupancy)
+        res = np.full((len(qx), 9, self.occupancy), -1, dtype = np.int64)
+        k = 0
+        for oy in (-1, 0, 1):
+            for ox in (-1, 0, 1):
+                ncx = qcx + ox
+                ncy = qcy + oy
+                inside = (ncx >= 0) & (ncx < self.cols) & (ncy >= 0) & (ncy < self.rows)
+                c = np.where(inside, (ncy * self.cols) + ncx, 0)
+                pos = self.start[c][:, None] + slot[None, :]
+                ok = inside[:, None] & (slot[None, :] < self.count[c][:, None])
+                res[:, k, :] = np.where(ok, self.order[np.minimum(pos, len(self.order) - 1)], -1)
+                k += 1
+        return res.reshape(len(qx), -1)
+
+    def nearest(self, qx, qy):
+        # nearest star to every point, only stars within the cell size are found
+        # returns (index, distance), the index is -1 and the distance is SENSOR_DIAG if there is none
+        # when two stars are just as far, the one earlier in the list wins, like the firmware's loops
+        cand = self.candidates(qx, qy)
+        ci = np.maximum(cand, 0)
+        ex = qx[:, None] - self.x[ci]
+        ey = qy[:, None] - self.y[ci]
+        dist = np.where(cand >= 0, np.sqrt((ex * ex) + (ey * ey)), np.inf)
+        min_dist = dist.min(axis = 1)
+        tie = np.where((dist == min_dist[:, None]) & (cand >= 0), cand, len(self.x))
+        idx = tie.min(axis = 1)
+        found = np.isfinite(min_dist) & (min_dist < SENSOR_DIAG)
+        return np.where(found, idx, -1), np.where(found, min_dist, SENSOR_DIAG)
+
+def mark_clusters(star_list, tol):
+    lim = len(star_list)
+    if lim < 2:
+        return
+    x, y = _coords(star_list)
+    cand = _StarGrid(x, y, tol).candidates(x, y)
+    ci = np.maximum(cand, 0)
+    ex = x[:, None] - x[ci]
+    ey = y[:, None] - y[ci]
+    close = (cand >= 0) & (cand != np.arange(lim)[:, None]) & (np.rint(np.sqrt((ex * ex) + (ey * ey))) < tol)
+    for i in np.flatnonzero(close.any(axis = 1)):
+        star_list[i]._clustered = tol
+
+def filter_hotpixels(star_list, hotpixels, tol = None):
+    # removes stars that are on a hot pixel, the list is modified in place
+    if hotpixels is None:
+        return None
+    if tol is None:
+        raise TypeError("can't convert NoneType to int")
+    tol = 2 # the firmware ignores the tolerance argument
+    if len(star_list) <= 0 or len(hotpixels) <= 0:
+        return None
+    x, y = _coords(star_list)
+    hp = np.array(hotpixels, dtype = np.float64).reshape(-1, 2)
+    idx, dist = _StarGrid(hp[:, 0], hp[:, 1], tol + 1).nearest(x, y)
+    hot = (idx >= 0) & (np.rint(dist) <= tol)
+    if hot.any():
+        star_list[:] = [star_list[i] for i in np.flatnonzero(~hot)]
+    return None
+
+def stars2hotpixels(star_list):
+    return [(fast_roundf(i.cxf()), fast_roundf(i.cyf())) for i in star_list]
+
+def process_list(star_list, cluster_tol = None, hotpixels = None, hotpixel_tol = None, min_rating = None):
+    # filters hot pixels, marks clusters, rates every star from 0 to 100 relative to the best one, then sorts by rating
+    # returns (list, length before filtering, length after filtering, number of stars rated at least min_rating)
+    b4len = len(star_list)
+    if hotpixels is not None:
+        filter_hotpixels(star_list, hotpixels, hotpixel_tol)
+    if cluster_tol is not None:
+        mark_clusters(star_list, cluster_tol)
+    max_score = 0
+    for star in star_list:
+        score = star.eval()
+        if score > max_score:
+            max_score = score
+    if min_rating is None:
+        min_rating = 0
+    good_enough = 0
+    for star in star_list:
+        score = star._star_rating * 100
+        score += max_score // 2
+        score = c_div(score, max_score)
+        star._star_rating = score
+        if score >= min_rating:
+            good_enough += 1
+    guidestar_sort(star_list)
+    return (star_list, b4len, len(star_list), good_enough)
+
+def select_first(star_list, boundary = 50):
+    # the first (best rated) star that is not close to the edges of the frame
+    # the firmware keeps widening and narrowing the region forever if nothing is found, here None is returned instead
+    tried = 0
+    while tried < 2:
+        b = 100 - boundary
+        region = (SENSOR_HEIGHT * b) // 200
+        left   = region
+        right  = SENSOR_WIDTH - region
+        top    = region
+        bottom = SENSOR_HEIGHT - region
+        for star in star_list:
+            x = fast_roundf(star.cxf())
+            y = fast_roundf(star.cyf())
+            if x >= left and x <= right and y >= top and y <= bottom:
+                return star
+        boundary = b + 10
+        tried += 1
+    return None
+
+MOVE_EVAL_CHUNK = 1 << 20 # limits the size of the temporary arrays in _eval_moves
+
+def _eval_moves(dx, dy, tolerance, old_x, old_y, grid):
+    # for every possible movement (dx[k], dy[k]), shift all the old stars and find the nearest new star to each of them
+    # returns arrays of (nearby, err_avg), nearby counts the old stars that landed within the tolerance
+    # the grid cells are as big as the tolerance, so a star the grid cannot see would not have counted anyways
+    nx = (old_x[None, :] + dx[:, None]).ravel()
+    ny = (old_y[None, :] + dy[:, None]).ravel()
+    min_dist = grid.nearest(nx, ny)[1].reshape(len(dx), len(old_x))
+    near = np.rint(min_dist) < tolerance
+    nearby = near.sum(axis = 1)
+    err_sum = np.where(near, np.floor(min_dist), 0).sum(axis = 1) # err_sum is an int in the firmware, so every distance is truncated
+    err_avg = np.zeros(len(dx))
+    np.divide(err_sum, nearby, out = err_avg, where = nearby > 0)
+    return nearby, err_avg
+
+def _c_div_arr(a, b):
+    # c_div for an array of numerators
+    if b == 0:
+        return np.zeros_like(a)
+    q = np.abs(a) // abs(b)
+    return np.where((a < 0) != (b < 0), -q, q)
+
+def _map_val_int_arr(x, in_min, in_max, out_min, out_max):
+    y = (x - in_min) * (out_max - out_min)
+    div = in_max - in_min
+    y += c_div(div, 2)
+    y = _c_div_arr(y, div)
+    return y + out_min
+
+def get_single_star_motion(old_list, new_list, selected_star, tolerance, fast_mode):
+    # finds the star in new_list that selected_star has moved to, by checking which movement makes the most old stars land on new stars
+    # returns (star, average error, number of stars that agree)
+    return _single_star_motion(old_list, new_list, selected_star, tolerance, fast_mode)[0]
+
+def _single_star_motion(old_list, new_list, selected_star, tolerance, fast_mode):
+    # also returns the grid built over new_list, or None, so that get_multi_star_motion can use it again
+    if old_list is None or new_list is None or selected_star is None:
+        return (None, SENSOR_DIAG, 0), None
+    new_list_len = len(new_list)
+    if new_list_len < 1:
+        return (None, SENSOR_DIAG - 1, 0), None
+    elif new_list_len == 1:
+        return (new_list[0], 0, 1), None
+    fast_mode = int(fast_mode)
+    quick_match_required = (new_list_len * fast_mode) // 100
+    tolerance = int(tolerance)
+
+    new_x, new_y = _coords(new_list)
+    old_x, old_y = _coords(old_list)
+    dx = new_x - selected_star.cxf()
+    dy = new_y - selected_star.cyf()
+    mag = np.sqrt((dx * dx) + (dy * dy))
+    grid = _StarGrid(new_x, new_y, tolerance)
+    step = max(1, MOVE_EVAL_CHUNK // max(1, len(old_list) * grid.width()))
+
+    nearby = np.zeros(new_list_len, dtype = np.int64)
+    err_avg = np.zeros(new_list_len)
+    if fast_mode > 0:
+        # the firmware takes the first movement that is good enough, so the movements are evaluated a few at a time, in order
+        i = 0
+        while i < new_list_len:
+            j = min(new_list_len, i + step)
+            nearby[i:j], err_avg[i:j] = _eval_moves(dx[i:j], dy[i:j], tolerance, old_x, old_y, grid)
+            err_r = np.rint(err_avg[i:j])
+            quick = np.flatnonzero((err_r < tolerance) & (nearby[i:j] >= quick_match_required))
+            if len(quick) > 0:
+                k = int(quick[0])
+                return (new_list[i + k], int(err_r[k]), int(nearby[i + k])), grid
+            i = j
+
+    if len(old_list) <= 1:
+        k = int(np.argmin(mag))
+        if mag[k] < SENSOR_DIAG:
+            return (new_list[k], 0, 1), grid
+
+    if fast_mode <= 0:
+        i = 0
+        while i < new_list_len:
+            j = min(new_list_len, i + step)
+            nearby[i:j], err_avg[i:j] = _eval_moves(dx[i:j], dy[i:j], tolerance, old_x, old_y, grid)
+            i = j
+
+    best_nearby = max(quick_match_required, int(nearby.max()))
+    err_r = np.rint(err_avg).astype(np.int64)
+    score_nearby = _map_val_int_arr(nearby, 0, best_nearby, 0, 100) * 50
+    score_erravg = (100 - _map_val_int_arr(err_r, 0, tolerance, 0, 100)) * 50
+    score_total = np.where(err_r < tolerance, _c_div_arr(score_nearby + score_erravg, 100), 0)
+    k = int(np.argmax(score_total)) # the first of the best, like the firmware's loop
+    if score_total[k] > 0 and nearby[k] > 0:
+        return (new_list[k], int(err_r[k]), int(nearby[k])), grid
+    return (None, SENSOR_DIAG - 2, 0), grid
+
+def get_multi_star_motion(old_list, new_list, selected_star, tolerance, fast_mode, rating_thresh, mstarcnt_min, mstarcnt_max):
+    # same as get_single_star_motion, but the movement is averaged over the other stars, weighted by how close they are to selected_star
+    # returns (star, x, y, average error, number of stars that agree, number of stars averaged)
+    single_res, grid = _single_star_motion(old_list, new_list, selected_star, tolerance, fast_mode)
+    star = single_res[0]
+    if star is None:
+        return (None, -1.0, -1.0, SENSOR_DIAG, 0, 0)
+    if mstarcnt_max <= 1 or len(new_list) <= 1:
+        return (star, star.cxf(), star.cyf(), single_res[1], single_res[2], 1)
+    tolerance = int(tolerance)
+    nsx = star.cxf()
+    nsy = star.cyf()
+    ssx = selected_star.cxf()
+    ssy = selected_star.cyf()
+    dx = nsx - ssx
+    dy = nsy - ssy
+    dx_sum = 0.0
+    dy_sum = 0.0
+    avg_cnt = 0
+    avg_weight = 0.0
+    old_x, old_y = _coords(old_list)
+    if grid is None:
+        grid = _StarGrid(*_coords(new_list), tolerance)
+    new_x = grid.x
+    new_y = grid.y
+    # nearest new star to where every old star should have moved to, the ones farther than the tolerance are not used anyways
+    nearest, nearest_mag = grid.nearest(old_x + dx, old_y + dy)
+    candidates = np.flatnonzero((nearest >= 0) & (np.rint(nearest_mag) < tolerance))
+    for i in candidates:
+        old_star = old_list[i]
+        j = nearest[i]
+        if avg_cnt < mstarcnt_min or (old_star._star_rating >= rating_thresh and new_list[j]._star_rating >= rating_thresh):
+            ox = old_x[i]
+            oy = old_y[i]
+            ssdistx = ssx - ox
+            ssdisty = ssy - oy
+            dist_ori = math.sqrt((ssdistx * ssdistx) + (ssdisty * ssdisty))
+            dist_weight = SENSOR_DIAG - dist_ori
+            dx_sum += (new_x[j] - (ox + dx)) * dist_weight
+            dy_sum += (new_y[j] - (oy + dy)) * dist_weight
+            avg_cnt += 1
+            avg_weight += dist_weight
+            if avg_cnt >= mstarcnt_max:
+                break
+    if avg_cnt <= 0:
+        dx_avg = dx
+        dy_avg = dy
+    else:
+        dx_avg = dx_sum / avg_weight
+        dy_avg = dy_sum / avg_weight
+    return (star, float(nsx + dx_avg), float(nsy + dy_avg), single_res[1], single_res[2], avg_cnt)
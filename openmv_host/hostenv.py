@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+
+# puts the host stand-in modules ahead of the firmware code on the import path
+# usage from a script in this repo:
+#   sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "openmv_host"))
+#   import hostenv
+#   hostenv.setup()
+
+import os, sys
+
+HOST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(HOST_DIR)
+
+def setup():
+    paths = [HOST_DIR, os.path.join(REPO_DIR, "openmv_mpy"), os.path.join(REPO_DIR, "openmv_filesys")]
+    for p in reversed(paths):
+        if p in sys.path:
+            sys.path.remove(p)
+        sys.path.insert(0, p)
@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+
+# host side stand-in for OpenMV's "image" module
+# only the grayscale subset used by star_finder and the apps is implemented
+# find_blobs follows the ASTROPHOTOGEAR branch of the custom firmware (blob.c and py_image.c)
+# but the connected component labelling is done on pixel runs with numpy, no per-pixel Python loops
+
+import numpy as np
+
+GRAYSCALE_MAX = 255
+
+class Image(object):
+
+    def __init__(self, arg, copy_to_fb = False):
+        if isinstance(arg, Image):
+            self.arr = arg.arr.copy()
+        elif isinstance(arg, np.ndarray):
+            self.arr = arg
+        else:
+            # assume it is a file path, PIL is only needed here
+            from PIL import Image as PILImage
+            self.arr = np.asarray(PILImage.open(arg).convert("L"))
+        if self.arr.ndim == 3:
+            self.arr = self.arr.mean(axis = 2)
+        if self.arr.dtype != np.uint8:
+            self.arr = np.clip(np.round(self.arr), 0, GRAYSCALE_MAX).astype(np.uint8)
+        self.ts = 0
+
+    def width(self):
+        return self.arr.shape[1]
+
+    def height(self):
+        return self.arr.shape[0]
+
+    def size(self):
+        return self.arr.size
+
+    def format(self):
+        return 2 # sensor.GRAYSCALE
+
+    def get_pixel(self, x, y):
+        if x < 0 or y < 0 or x >= self.width() or y >= self.height():
+            return None
+        return int(self.arr[y, x])
+
+    def set_pixel(self, x, y, c):
+        if x < 0 or y < 0 or x >= self.width() or y >= self.height():
+            return self
+        self.arr[y, x] = c
+        return self
+
+    def copy(self, copy_to_fb = False):
+        return Image(self.arr.copy())
+
+    def set_timestamp(self, t):
+        self.ts = t
+
+    def get_timestamp(self):
+        return self.ts
+
+    def timestamp(self):
+        return self.ts
+
+    def to_grayscale(self, copy = False):
+        if copy:
+            return self.copy()
+        return self
+
+    def save(self, path, quality = 50):
+        from PIL import Image as PILImage
+        if path.lower().endswith(".jpg") or path.lower().endswith(".jpeg"):
+            PILImage.fromarray(self.arr).save(path, quality = quality)
+        else:
+            PILImage.fromarray(self.arr).save(path)
+        return self
+
+    def get_histogram(self, thresholds = None, invert = False, roi = None, bins = 256, l_bins = None):
+        if l_bins is None:
+            l_bins = bins
+        sub = self.arr[_roi_slice(self, roi)].ravel()
+        if thresholds is not None and len(thresholds) > 0:
+            sel = np.zeros(sub.shape, dtype = bool)
+            for t in thresholds:
+                lo, hi = _threshold_limits(t)
+                sel |= (sub >= lo) & (sub <= hi)
+            if invert:
+                sel = ~sel
+            sub = sub[sel]
+        cnts = np.bincount(sub, minlength = GRAYSCALE_MAX + 1).astype(np.float64)
+        if l_bins != GRAYSCALE_MAX + 1:
+            # same binning as imlib, value * (bins - 1) / 255 rounded
+            idx = np.round(np.arange(GRAYSCALE_MAX + 1) * (l_bins - 1) / float(GRAYSCALE_MAX)).astype(np.int64)
+            cnts = np.bincount(idx, weights = cnts, minlength = l_bins)
+        total = cnts.sum()
+        if total > 0:
+            cnts /= total
+        return Histogram(cnts)
+
+    def get_statistics(self, thresholds = None, invert = False, roi = None, bins = 256, l_bins = None):
+        return self.get_histogram(thresholds = thresholds, invert = invert, roi = roi, bins = bins, l_bins = l_bins).get_statistics()
+
+    def find_blobs(self, thresholds, invert = False, roi = None, x_stride = 2, y_stride = 1, area_threshold = 10, pixels_threshold = 10, width_threshold = 0, height_threshold = 0, merge = False, margin = 0, guidestarmode = False, **kwargs):
+        # like the firmware, keywords that are not recognized are silently ignored
+        # merging is never used by this project so it is not implemented
+        if x_stride <= 0:
+            raise ValueError("x_stride must not be zero.")
+        if y_stride <= 0:
+            raise ValueError("y_stride must not be zero.")
+        if thresholds is None or len(thresholds) <= 0:
+            return []
+        rx, ry, rw, rh = _clip_roi(self, roi)
+        if rw <= 0 or rh <= 0:
+            return []
+        sub = self.arr[ry:ry + rh, rx:rx + rw]
+        claimed = None
+        if len(thresholds) > 1:
+            claimed = np.zeros(sub.shape, dtype = bool)
+
+        blobs = []
+        for t in thresholds:
+            lo, hi = _threshold_limits(t)
+            mask = (sub >= lo) & (sub <= hi)
+            if invert:
+                mask = ~mask
+            if claimed is not None:
+                mask &= ~claimed
+            comps = _find_components(mask, rx, ry, x_stride, y_stride)
+            if comps is None:
+                continue
+            comp_x0, comp_y0, comp_x1, comp_y1, comp_pixels, run_comp, runs = comps
+            if claimed is not None:
+                # pixels belonging to a seeded component are marked even if the blob gets rejected later
+                keep_runs = run_comp >= 0
+                for y, x0, x1 in zip(runs[0][keep_runs], runs[1][keep_runs], runs[2][keep_runs]):
+                    claimed[y - ry, x0 - rx:x1 - rx + 1] = True
+
+            comp_w = comp_x1 - comp_x0 + 1
+            comp_h = comp_y1 - comp_y0 + 1
+            comp_area = comp_w * comp_h
+            ok = _thresh_check(comp_area, area_threshold) & _thresh_check(comp_pixels, pixels_threshold) & _thresh_check(comp_w, width_threshold) & _thresh_check(comp_h, height_threshold)
+            for i in np.flatnonzero(ok):
+                b = self._make_blob(int(comp_x0[i]), int(comp_y0[i]), int(comp_w[i]), int(comp_h[i]), int(comp_pixels[i]), lo, hi, invert)
+                if guidestarmode:
+                    b._analyze_guidestar(self)
+                blobs.append(b)
+        return blobs
+
+    def _make_blob(self, x, y, w, h, pixels, lo, hi, invert):
+        # same as the "better centroid based on brightness" block in blob.c
+        # every thresholded pixel inside the bounding rectangle is used, even if it belongs to a different blob
+        # the integer widths used by the firmware are mimicked so the results match bit-for-bit
+        sub = self.arr[y:y + h, x:x + w].astype(np.int64)
+        sel = (sub >= lo) & (sub <= hi)
+        if invert:
+            sel = ~sel
+        vals = np.where(sel, sub, 0)
+        row_sums = vals.sum(axis = 0) & 0xFFFF
+        col_sums = vals.sum(axis = 1) & 0xFFFF
+        britesum = int(vals.sum()) & 0xFFFFFFFF
+        brightest = int(sub.max())
+        satcnt = int(np.count_nonzero(sub >= 254)) & 0xFF
+
+        sumd = int(row_sums.sum()) & 0xFFFF
+        if sumd > 0:
+            buc_sum = int((row_sums * np.arange(x, x + w)).sum()) & 0xFFFFFFFF
+            cx = float(np.float32(buc_sum) / np.float32(sumd))
+        else:
+            # fallback is the plain pixel average, only reachable when the brightness sums wrap around
+            cx = float(np.float32((sel.sum(axis = 0) * np.arange(x, x + w)).sum()) / np.float32(np.count_nonzero(sel)))
+        sumd = int(col_sums.sum()) & 0xFFFF
+        if sumd > 0:
+            buc_sum = int((col_sums * np.arange(y, y + h)).sum()) & 0xFFFFFFFF
+            cy = float(np.float32(buc_sum) / np.float32(sumd))
+        else:
+            cy = float(np.float32((sel.sum(axis = 1) * np.arange(y, y + h)).sum()) / np.float32(np.count_nonzero(sel)))
+
+        return Blob(x, y, w, h, pixels, cx, cy, brightest, britesum, satcnt)
+
+class Blob(object):
+
+    def __init__(self, x, y, w, h, pixels, cx, cy, maxbrightness, brightness, saturation_cnt):
+        self._x = x
+        self._y = y
+        self._w = w
+        self._h = h
+        self._pixels = pixels
+        self._cx = cx
+        self._cy = cy
+        self._maxbrightness = maxbrightness
+        self._brightness = brightness
+        self._saturation_cnt = saturation_cnt
+        self._star_pointiness = 0
+        self._star_profile = []
+
+    def x(self):
+        return self._x
+
+    def y(self):
+        return self._y
+
+    def w(self):
+        return self._w
+
+    def h(self):
+        return self._h
+
+    def rect(self):
+        return (self._x, self._y, self._w, self._h)
+
+    def pixels(self):
+        return self._pixels
+
+    def area(self):
+        return self._w * self._h
+
+    def density(self):
+        return float(self._pixels) / float(self.area())
+
+    def cx(self):
+        return int(round(self._cx))
+
+    def cy(self):
+        return int(round(self._cy))
+
+    def cxf(self):
+        return self._cx
+
+    def cyf(self):
+        return self._cy
+
+    def move_coord(self, x, y):
+        self._cx = float(x)
+        self._cy = float(y)
+
+    def max_brightness(self):
+        return self._maxbrightness
+
+    def brightness_sum(self):
+        return self._brightness
+
+    def saturation_cnt(self):
+        return self._saturation_cnt
+
+    def star_pointiness(self):
+        return self._star_pointiness
+
+    def star_profile(self):
+        return self._star_profile
+
+    def _analyze_guidestar(self, img):
+        # see imlib_analyze_guidestar in blob.c
+        radius = (self._w + self._h) // 3
+        if radius <= 0:
+            self._star_profile = []
+            self._star_pointiness = 0
+            return
+        arr = img.arr
+        xlim = img.width()
+        ylim = img.height()
+        cxi = int(round(self._cx))
+        cyi = int(round(self._cy))
+        i = np.arange(1, radius)
+        total = np.zeros(radius - 1, dtype = np.int64)
+        cnt = np.zeros(radius - 1, dtype = np.int64)
+        for ok, xs, ys in ((cxi - i >= 0, cxi - i, cyi), (cxi + i < xlim, cxi + i, cyi), (cyi + i < ylim, cxi, cyi + i), (cyi - i >= 0, cxi, cyi - i)):
+            xs = np.broadcast_to(xs, i.shape)[ok]
+            ys = np.broadcast_to(ys, i.shape)[ok]
+            total[ok] += arr[ys, xs]
+            cnt[ok] += 1
+        profile = [int(arr[cyi, cxi])] + [int(v) for v in ((total + (cnt // 2)) // cnt)]
+
+        max_brite = profile[0]
+        pointiness = 0.0
+        rsum = 0
+        j = radius
+        px = -1
+        k = 0
+        while k < radius:
+            v = profile[k]
+            if k != 0 and j > 0:
+                dx = px - v
+                if dx < 0 or (dx <= 0 and px >= 254):
+                    dx -= 2
+                dx *= j
+                rsum += j
+                if dx < 0:
+                    dx *= 2
+                pointiness += dx
+                j -= 1
+            px = v
+            k += 1
+        if rsum > 0 and max_brite > 0:
+            pointiness = int(round((pointiness * 100) / max_brite / rsum))
+        else:
+            pointiness = 0 # the firmware divides by zero here, tiny blobs are meaningless anyways
+        self._star_profile = profile
+        self._star_pointiness = pointiness
+
+class Histogram(object):
+
+    def __init__(self, bins):
+        self._bins = bins
+
+    def bins(self):
+        return self._bins.tolist()
+
+    def l_bins(self):
+        return self._bins.tolist()
+
+    def get_statistics(self):
+        # same as imlib_get_statistics for grayscale, all results are integers
+        cnt = len(self._bins)
+        values = np.arange(cnt) * (GRAYSCALE_MAX / float(cnt - 1))
+        avg = float((values * self._bins).sum())
+        sq = float((values * values * self._bins).sum())
+        nz = np.flatnonzero(self._bins > 0)
+        cum = np.cumsum(self._bins)
+        def quantile(q):
+            idx = int(np.searchsorted(cum, q - 1e-9))
+            return int(np.floor(values[min(idx, cnt - 1)]))
+        st = Statistics()
+        st._mean   = int(np.floor(avg))
+        st._stdev  = int(np.floor(np.sqrt(max(0.0, sq - (avg * avg)))))
+        st._median = quantile(0.5)
+        st._lq     = quantile(0.25)
+        st._uq     = quantile(0.75)
+        st._mode   = int(np.floor(values[int(np.argmax(self._bins))]))
+        st._min    = int(np.floor(values[nz[0]])) if len(nz) > 0 else 0
+        st._max    = int(np.floor(values[nz[-1]])) if len(nz) > 0 else 0
+        return st
+
+    def get_stats(self):
+        return self.get_statistics()
+
+    def statistics(self):
+        return self.get_statistics()
+
+class Statistics(object):
+
+    def mean(self):
+        return self._mean
+
+    def median(self):
+        return self._median
+
+    def mode(self):
+        return self._mode
+
+    def stdev(self):
+        return self._stdev
+
+    def min(self):
+        return self._min
+
+    def max(self):
+        return self._max
+
+    def lq(self):
+        return self._lq
+
+    def uq(self):
+        return self._uq
+
+def _threshold_limits(t):
+    lo = int(t[0])
+    hi = int(t[1]) if len(t) > 1 else GRAYSCALE_MAX
+    if lo > hi:
+        lo, hi = hi, lo
+    return max(lo, 0), min(hi, GRAYSCALE_MAX)
+
+def _clip_roi(img, roi):
+    if roi is None:
+        return 0, 0, img.width(), img.height()
+    x, y, w, h = [int(v) for v in roi]
+    x0 = max(x, 0)
+    y0 = max(y, 0)
+    x1 = min(x + w, img.width())
+    y1 = min(y + h, img.height())
+    return x0, y0, x1 - x0, y1 - y0
+
+def _roi_slice(img, roi):
+    x, y, w, h = _clip_roi(img, roi)
+    return (slice(y, y + h), slice(x, x + w))
+
+def _thresh_check(v, t):
+    # custom firmware supports negative thresholds meaning "less than or equal to"
+    if t >= 0:
+        return v >= t
+    return v <= -t
+
+def _find_components(mask, rx, ry, x_stride, y_stride):
+    # 4-connected labelling on horizontal runs of thresholded pixels
+    # only components that contain a pixel visited by the strided scan are returned, same as the firmware's seeding
+    h, w = mask.shape
+    idx = np.flatnonzero(mask)
+    if len(idx) <= 0:
+        return None
+    ys = idx // w
+    xs = idx - (ys * w)
+    new_run = np.ones(len(idx), dtype = bool)
+    new_run[1:] = (idx[1:] != idx[:-1] + 1) | (xs[1:] == 0)
+    starts = np.flatnonzero(new_run)
+    ends = np.append(starts[1:], len(idx)) - 1
+    run_y  = ys[starts]
+    run_x0 = xs[starts]
+    run_x1 = xs[ends]
+    run_n  = run_x1 - run_x0 + 1
+    nruns = len(starts)
+
+    # find overlapping runs on the next row, runs are sorted so the candidates are contiguous
+    key_start = (run_y * (w + 1)) + run_x0
+    key_end   = (run_y * (w + 1)) + run_x1
+    lo = np.searchsorted(key_end, ((run_y + 1) * (w + 1)) + run_x0, side = "left")
+    hi = np.searchsorted(key_start, ((run_y + 1) * (w + 1)) + run_x1, side = "right")
+    n = np.maximum(hi - lo, 0)
+    a = np.repeat(np.arange(nruns), n)
+    b = np.repeat(lo - np.cumsum(n) + n, n) + np.arange(int(n.sum()))
+    parent = _union_runs(nruns, a, b)
+    roots, run_comp = np.unique(parent, return_inverse = True)
+    ncomp = len(roots)
+
+    # strided seeds, x starts at roi.x + (y % x_stride)
+    abs_y  = run_y + ry
+    abs_x0 = run_x0 + rx
+    abs_x1 = run_x1 + rx
+    off = rx + (abs_y % x_stride)
+    first = abs_x0 + ((off - abs_x0) % x_stride)
+    hit = ((run_y % y_stride) == 0) & (first <= abs_x1)
+    big = np.iinfo(np.int64).max
+    seed_key = np.where(hit, (abs_y.astype(np.int64) * (rx + w + 1)) + first, big)
+    comp_seed = np.full(ncomp, big, dtype = np.int64)
+    np.minimum.at(comp_seed, run_comp, seed_key)
+
+    # blobs are reported in the order they are found by the raster scan
+    order = np.argsort(comp_seed, kind = "stable")
+    order = order[comp_seed[order] != big]
+    remap = np.full(ncomp, -1, dtype = np.int64)
+    remap[order] = np.arange(len(order))
+    run_comp = remap[run_comp]
+    valid = run_comp >= 0
+    nvalid = len(order)
+
+    comp_x0 = np.full(nvalid, big, dtype = np.int64)
+    comp_y0 = np.full(nvalid, big, dtype = np.int64)
+    comp_x1 = np.full(nvalid, -1, dtype = np.int64)
+    comp_y1 = np.full(nvalid, -1, dtype = np.int64)
+    rc = run_comp[valid]
+    np.minimum.at(comp_x0, rc, abs_x0[valid])
+    np.minimum.at(comp_y0, rc, abs_y[valid])
+    np.maximum.at(comp_x1, rc, abs_x1[valid])
+    np.maximum.at(comp_y1, rc, abs_y[valid])
+    comp_pixels = np.bincount(rc, weights = run_n[valid], minlength = nvalid).astype(np.int64)
+    return comp_x0, comp_y0, comp_x1, comp_y1, comp_pixels, run_comp, (abs_y, abs_x0, abs_x1)
+
+def _union_runs(n, a, b):
+    # vectorized union-find, hook the larger root onto the smaller one then pointer-jump until flat
+    parent = np.arange(n)
+    if len(a) <= 0:
+        return parent
+    while True:
+        pa = parent[a]
+        pb = parent[b]
+        diff = pa != pb
+        if not diff.any():
+            break
+        pa = pa[diff]
+        pb = pb[diff]
+        np.minimum.at(parent, np.maximum(pa, pb), np.minimum(pa, pb))
+        while True:
+            nxt = parent[parent]
+            if np.array_equal(nxt, parent):
+                break
+            parent = nxt
+    return parent
@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+
+# host side stand-in for the MicroPython "machine" module
+
+import sys
+
+def reset():
+    sys.exit(0)
+
+def soft_reset():
+    sys.exit(0)
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+
+# host side stand-in for the MicroPython "micropython" module
+
+def const(x):
+    return x
+
+def opt_level(level = None):
+    return 3
+
+def mem_info(verbose = False):
+    pass
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+def schedule(func, arg):
+    func(arg)
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+
+# host side stand-in for the "network" module
+# there is no WINC1500 on the host, constructing one fails the same way as when the WiFi shield is missing
+
+class WINC(object):
+    MODE_STA = 0
+    MODE_AP  = 1
+    MODE_P2P = 2
+    MODE_FIRMWARE = 3
+    OPEN     = 0
+    WPA_PSK  = 1
+    WEP      = 2
+
+    def __init__(self, mode = MODE_STA):
+        raise OSError("no WiFi hardware on the host")
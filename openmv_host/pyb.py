@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+# host side stand-in for the "pyb" module, only what the apps use
+
+import time, random, sys
+
+_t_start = time.monotonic()
+
+def millis():
+    return int((time.monotonic() - _t_start) * 1000)
+
+def micros():
+    return int((time.monotonic() - _t_start) * 1000000)
+
+def elapsed_millis(start):
+    return millis() - start
+
+def elapsed_micros(start):
+    return micros() - start
+
+def delay(ms):
+    time.sleep(ms / 1000.0)
+
+def udelay(us):
+    time.sleep(us / 1000000.0)
+
+def rng():
+    return random.getrandbits(30)
+
+def unique_id():
+    return b"\x00" * 12
+
+def hard_reset():
+    sys.exit(0)
+
+class LED(object):
+    def __init__(self, idx):
+        self.idx = idx
+        self.state = False
+
+    def on(self):
+        self.state = True
+
+    def off(self):
+        self.state = False
+
+    def toggle(self):
+        self.state = not self.state
+
+    def intensity(self, value = None):
+        if value is None:
+            return 255 if self.state else 0
+        self.state = value > 0
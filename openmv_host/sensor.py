@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+
+# host side stand-in for the "sensor" module
+# there is no camera on the host, frames are loaded from files with image.Image(path)
+# only the constants are provided so that modules importing "sensor" can be loaded
+
+BINARY    = 1
+GRAYSCALE = 2
+RGB565    = 3
+JPEG      = 5
+
+QQCIF     = 14
+QVGA      = 10
+WQXGA2    = 47
@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+
+# host side stand-in for the MicroPython "ubinascii" module
+
+from binascii import hexlify, unhexlify, a2b_base64, b2a_base64
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+
+# host side stand-in for the MicroPython "uctypes" module
+# only what is needed to look at the same memory two ways, such as the bytes of an array.array
+
+import ctypes
+
+def addressof(obj):
+    return obj.buffer_info()[0] # only array.array on the host
+
+def bytearray_at(addr, size):
+    return memoryview((ctypes.c_ubyte * size).from_address(addr)).cast("B")
@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+
+# host side stand-in for the MicroPython "uerrno" module
+
+from errno import *
@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+
+# host side stand-in for the MicroPython "uhashlib" module
+
+from hashlib import sha1, sha256
@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+
+# host side stand-in for the MicroPython "uio" module
+
+from io import StringIO, BytesIO, open
@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+
+# host side stand-in for the MicroPython "ujson" module
+
+from json import dump, dumps, load, loads
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+
+# host side stand-in for the MicroPython "uos" module
+
+from os import listdir, mkdir, remove, rename, stat, getcwd, chdir, rmdir
+
+def sync():
+    pass
+
+def urandom(n):
+    import os
+    return os.urandom(n)
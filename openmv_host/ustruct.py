@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+
+# host side stand-in for the MicroPython "ustruct" module
+
+from struct import calcsize, pack, pack_into, unpack, unpack_from
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+# host side stand-in for the MicroPython "utime" module
+
+import time as _t
+
+_t_start = _t.monotonic()
+
+def localtime(secs = None):
+    if secs is None:
+        secs = _t.time()
+    t = _t.gmtime(secs)
+    return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday)
+
+def mktime(t):
+    # MicroPython takes a 8-tuple and treats it as UTC, the host takes 9 and treats it as local time
+    t = tuple(t) + ((0, ) * (8 - len(t)))
+    return int(_t.mktime(t[0:8] + (0, ))) - _t.timezone
+
+def time():
+    return int(_t.time())
+
+def sleep(s):
+    _t.sleep(s)
+
+def sleep_ms(ms):
+    _t.sleep(ms / 1000.0)
+
+def sleep_us(us):
+    _t.sleep(us / 1000000.0)
+
+def ticks_ms():
+    return int((_t.monotonic() - _t_start) * 1000)
+
+def ticks_us():
+    return int((_t.monotonic() - _t_start) * 1000000)
+
+def ticks_diff(a, b):
+    return a - b
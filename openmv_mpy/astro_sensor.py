@@ -21,6 +21,8 @@ class AstroCam(object):
         self.has_error = False
         self.wait_init = 0
         self.snap_started = False
+        self.analysis_fb = None
+        self.can_copy = True
 
         self.simulate = False
         if simulate is not None:
@@ -161,6 +163,47 @@ class AstroCam(object):
         self.snap_started = False
         return self.img
 
+    def snapshot_finish_copy(self, copy = True):
+        # double buffering, the camera always captures into the main frame buffer, so the frame is copied out into a second buffer
+        # that way the next exposure can be started right away, while this frame is analysed
+        # ownership:
+        #   the main frame buffer belongs to the camera from snapshot_start until snapshot_finish
+        #   the copy belongs to the caller until the next call to this function, which overwrites it
+        # returns the image and True if it is safe to start the next exposure before the caller is done with it
+        # with copy = False, or if the second buffer can't be allocated, the image is the main frame buffer, and the caller has to finish with it first
+        img = self.snapshot_finish()
+        if img is None:
+            return None, False
+        if self.simulate:
+            return img, True # the simulated image is never overwritten
+        if copy == False or self.can_copy == False:
+            return img, False
+        try:
+            if self.analysis_fb is None:
+                # a full frame, 5 MB at WQXGA2 in grayscale, kept until release_copy()
+                self.analysis_fb = sensor.alloc_extra_fb(img.width(), img.height(), self.pixfmt)
+            if self.analysis_fb.width() != img.width() or self.analysis_fb.height() != img.height():
+                self.can_copy = False # the frame size changed, not worth the trouble
+                return img, False
+            self.analysis_fb.replace(img)
+            self.analysis_fb.set_timestamp(img.timestamp())
+        except MemoryError as exc:
+            exclogger.log_exception(exc, to_file = False)
+            self.can_copy = False
+            return img, False
+        return self.analysis_fb, True
+
+    def release_copy(self):
+        # gives the second frame buffer back, the next snapshot_finish_copy() allocates it again
+        # extra frame buffers are a stack, anything the caller allocated after it has to be released first
+        # returns False if there was nothing to release
+        if self.analysis_fb is None:
+            return False
+        sensor.dealloc_extra_fb()
+        self.analysis_fb = None
+        self.can_copy = True # worth another try, the frame size or the free memory might be different now
+        return True
+
     def get_timespan(self):
         if self.shutter > 500000:
             x = self.shutter * 4 / 3000
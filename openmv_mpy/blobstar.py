@@ -4,8 +4,11 @@ import comutils
 from comutils import SENSOR_WIDTH, SENSOR_HEIGHT
 import math
 import ujson
+import array
 
 class BlobStar(object):
+    # the solver keeps its own state in StarList and pole_finder.Candidate, nothing else gets attached to a star
+    __slots__ = ("cx", "cy", "r", "brightness", "score", "penalty")
 
     def __init__(self, cx, cy, r, brightness):
         self.cx = cx
@@ -15,12 +18,6 @@ class BlobStar(object):
         self.score = 0
         self.penalty = 0
 
-    def set_ref_star(self, ref_star):
-        self.ref_star = ref_star
-        mag, ang = comutils.vector_between([self.cx, self.cy], [ref_star.cx, ref_star.cy])
-        self.ref_star_dist = mag
-        self.ref_star_angle = ang
-
     def reset_score(self):
         self.score = 0
 
@@ -32,6 +29,113 @@ class BlobStar(object):
         obj.update({"brightness": self.brightness})
         return obj
 
+class StarList(object):
+    # the stars of one frame as parallel arrays, allocated once and filled in place every frame
+    # find_stars adds the blobs straight into it, when it is full a new blob replaces the dimmest one only if it is brighter, so only the brightest are kept
+    # the solver's inner loops work on the arrays, a BlobStar is only made by get_star() for the few stars that a solution keeps
+    # ref_dist, ref_ux and ref_uy hold the vector from every star to the one currently being guessed as Polaris, as a length and a unit vector
+    # the solver compares directions with dot products of unit vectors, so no angle (and no atan2) is needed for every star of every guess
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.cx         = array.array('f', [0] * capacity)
+        self.cy         = array.array('f', [0] * capacity)
+        self.r          = array.array('f', [0] * capacity)
+        self.brightness = array.array('f', [0] * capacity)
+        self.ref_dist   = array.array('f', [0] * capacity)
+        self.ref_ux     = array.array('f', [0] * capacity)
+        self.ref_uy     = array.array('f', [0] * capacity)
+        self.clear()
+
+    def clear(self):
+        self.n = 0
+        self.total = 0 # every blob that was offered, kept or not
+        self.min_idx = -1
+
+    def __len__(self):
+        return self.n
+
+    def _find_min(self):
+        brightness = self.brightness
+        idx = 0
+        i = 1
+        while i < self.n:
+            if brightness[i] < brightness[idx]:
+                idx = i
+            i += 1
+        self.min_idx = idx
+
+    def add(self, cx, cy, r, brightness):
+        self.total += 1
+        if self.n < self.capacity:
+            i = self.n
+            self.n += 1
+            if self.min_idx < 0 or brightness < self.brightness[self.min_idx]:
+                self.min_idx = i
+        else:
+            i = self.min_idx
+            if brightness <= self.brightness[i]:
+                return False
+        self.cx[i] = cx
+        self.cy[i] = cy
+        self.r[i] = r
+        self.brightness[i] = brightness
+        if self.n >= self.capacity and i == self.min_idx:
+            self._find_min()
+        return True
+
+    def get_star(self, i):
+        # a new object, solutions hold on to their stars after the list is filled again for the next frame
+        return BlobStar(self.cx[i], self.cy[i], self.r[i], self.brightness[i])
+
+    def set_ref(self, idx):
+        # same as comutils.vector_between from each star to the reference star, with the angle given as (cos, sin)
+        cx = self.cx
+        cy = self.cy
+        ref_dist = self.ref_dist
+        ref_ux = self.ref_ux
+        ref_uy = self.ref_uy
+        sqrt = math.sqrt
+        rx = cx[idx]
+        ry = cy[idx]
+        i = 0
+        while i < self.n:
+            dx = rx - cx[i]
+            dy = ry - cy[i]
+            d = sqrt((dx * dx) + (dy * dy))
+            ref_dist[i] = d
+            if d > 0:
+                ref_ux[i] = dx / d
+                ref_uy[i] = dy / d
+            else:
+                # the reference star itself, atan2(0, 0) is 0 degrees
+                ref_ux[i] = 1.0
+                ref_uy[i] = 0.0
+            i += 1
+
+    def get_ref_ang(self, i):
+        # the angle in degrees, only for printing
+        return math.degrees(math.atan2(self.ref_uy[i], self.ref_ux[i]))
+
+    def sort_brightness(self):
+        # indices, brightest first, same order as sort_brightness()
+        brightness = self.brightness
+        r = self.r
+        return sorted(range(self.n), key = lambda i: brightness[i] if brightness[i] > 0 else r[i], reverse = True)
+
+    def sort_dist(self):
+        # indices, closest to the reference star first
+        ref_dist = self.ref_dist
+        return sorted(range(self.n), key = lambda i: ref_dist[i])
+
+    def to_jsonobj(self, indices = None):
+        if indices is None:
+            indices = range(self.n)
+        x = []
+        for i in indices:
+            x.append({"cx": self.cx[i], "cy": self.cy[i], "r": self.r[i], "brightness": self.brightness[i]})
+        return x
+
 def round_num(x):
     return round(x * 10.0)/10.0
 
@@ -46,13 +150,6 @@ def sort_brightness_func(star):
         return star.brightness
     return star.r
 
-def sort_dist_func(star):
-    return star.ref_star_dist
-
 def sort_brightness(star_list):
     res_list = sorted(star_list, key = sort_brightness_func, reverse = True)
     return res_list
-
-def sort_dist(star_list):
-    res_list = sorted(star_list, key = sort_dist_func)
-    return res_list
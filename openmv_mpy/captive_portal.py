@@ -3,14 +3,229 @@ micropython.opt_level(2)
 
 import pyb, uos, uio, time, gc
 import ubinascii, uhashlib, ujson
+import array, uctypes
 import network
 import usocket as socket
+import uerrno
 import exclogger
 
 STS_IDLE     = micropython.const(0)
 STS_SERVED   = micropython.const(1)
 STS_KICKED   = micropython.const(-1)
 
+# the WINC1500 sockets can't be used with uselect (their ioctl always fails), so every connection is polled instead
+# a connection is either still receiving its request, or sending its reply one chunk at a time
+# nothing here waits on a client, a phone that connects and goes quiet can't hold up the camera loop
+CONN_REQUEST = micropython.const(0)
+CONN_SENDING = micropython.const(1)
+
+MAX_CLIENTS  = micropython.const(4)
+REQ_TIMEOUT  = micropython.const(3000) # milliseconds to receive the whole request, otherwise the connection is dropped
+SEND_SLICE   = micropython.const(30)   # milliseconds spent sending replies in each call to task()
+SEND_TIMEOUT = 2                       # seconds, for the handlers that reply straight away, their replies are small
+SEND_STALL   = micropython.const(5000) # milliseconds, a reply that the client has not taken any of for this long is dropped
+RX_BUF_SIZE  = micropython.const(1024) # per connection, a request line plus headers from a phone fit easily
+WS_RX_SIZE   = micropython.const(2048) # a websocket frame bigger than this is read in one go
+WS_TX_SIZE   = micropython.const(1024) # a websocket message smaller than this is sent with its header in one send()
+WS_MAX_MSG   = micropython.const(16384) # a fragmented websocket message bigger than this is thrown away
+
+# a handler can return a generator instead of sending the whole reply at once, it yields the reply a piece at a time
+# the portal sends each piece without waiting, what the socket did not take is kept and sent on a later call, and only then is the next piece asked for
+GeneratorType = type((lambda: (yield))())
+
+def would_block(exc):
+    # a socket with a timeout of 0 raises this when it has nothing for us or can't take more right now, it is not an error
+    return len(exc.args) > 0 and (exc.args[0] == uerrno.EAGAIN or exc.args[0] == uerrno.ETIMEDOUT)
+
+def word_buffer(size):
+    # a byte buffer that can also be used 16 bits at a time, the words have to stay referenced for as long as the bytes are used
+    # 16 bits and not 32, anything above 30 bits is not a small int in MicroPython and every XOR would allocate
+    words = array.array('H', bytes(((size + 1) // 2) * 2)) # the bytes are taken as the raw contents
+    return words, uctypes.bytearray_at(uctypes.addressof(words), len(words) * 2)
+
+def unmask(words, buf, start, n, mask):
+    # XORs n bytes of buf, starting at start, with the 4 websocket masking bytes, two bytes at a time where it can
+    end = start + n
+    i = start
+    if (i & 1) != 0 and i < end:
+        buf[i] ^= mask[0]
+        i += 1
+    # the mask repeats every 4 bytes, so there are two different halfwords, little endian
+    k = i - start
+    m0 = mask[k & 3] | (mask[(k + 1) & 3] << 8)
+    m1 = mask[(k + 2) & 3] | (mask[(k + 3) & 3] << 8)
+    w = i >> 1
+    wend = end >> 1
+    while w + 1 < wend:
+        words[w] ^= m0
+        words[w + 1] ^= m1
+        w += 2
+    if w < wend:
+        words[w] ^= m0
+        w += 1
+    i = max(i, w << 1)
+    while i < end:
+        buf[i] ^= mask[(i - start) & 3]
+        i += 1
+
+def payload_buffer(data):
+    # MicroPython strings can be sent without encoding them first, they are already UTF-8 in memory
+    if type(data) == str:
+        try:
+            return memoryview(data)
+        except TypeError:
+            return data.encode("utf-8") # on the host
+    return data
+
+class RxBuffer(object):
+    # receive buffer for one connection, allocated once
+    # data is read in with readinto() as big as it arrives, lines and frames are taken out of it without copying the rest around
+    # the bytes between start and end are the ones not used yet
+    def __init__(self, size = RX_BUF_SIZE):
+        self.words, self.buf = word_buffer(size)
+        self.mv = memoryview(self.buf)
+        self.reset()
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+        self.scanned = 0 # how far readline() has already looked for a newline
+
+    def available(self):
+        return self.end - self.start
+
+    def fill(self, sock):
+        # reads whatever is waiting, never waits for more, returns the number of bytes read
+        if self.start == self.end:
+            self.reset()
+        elif self.end >= len(self.buf) and self.start > 0:
+            # out of room at the end, move what's left to the front
+            # the two ranges can overlap, so it's copied a byte at a time from the front, this is rare
+            n = self.end - self.start
+            i = 0
+            while i < n:
+                self.buf[i] = self.buf[self.start + i]
+                i += 1
+            self.scanned -= self.start
+            self.start = 0
+            self.end = n
+        if self.end >= len(self.buf):
+            return 0
+        try:
+            sock.settimeout(0)
+            n = sock.readinto(self.mv[self.end:])
+        except OSError:
+            n = 0
+        if n is None:
+            n = 0
+        self.end += n
+        return n
+
+    def readline(self):
+        # returns a line without the line ending, or None if there's no whole line yet
+        i = max(self.scanned, self.start)
+        buf = self.buf
+        end = self.end
+        while i < end:
+            if buf[i] == 0x0A:
+                line = bytes(self.mv[self.start:i]).decode("utf-8").rstrip()
+                self.start = i + 1
+                self.scanned = self.start
+                return line
+            i += 1
+        self.scanned = i
+        if self.start == 0 and end >= len(buf):
+            raise ValueError("line too long")
+        return None
+
+    def peek(self, i):
+        return self.buf[self.start + i]
+
+    def take(self, n):
+        # the next n bytes, as a memoryview into the buffer, only valid until the next fill()
+        x = self.mv[self.start:self.start + n]
+        self.start += n
+        return x
+
+class HttpClient(object):
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.state = CONN_REQUEST
+        self.t = pyb.millis()
+        self.rx = RxBuffer()
+        self.req = None
+        self.headers = {}
+        self.content = ""
+        self.content_len = -1
+        self.job = None
+        self.tx = None # the piece of the reply being sent, and how much of it is gone
+        self.tx_pos = 0
+
+    def poll_request(self):
+        # takes whatever has arrived without waiting for more, returns True once the request line, headers and content are all in
+        self.rx.fill(self.sock)
+        while self.content_len < 0:
+            line = self.rx.readline()
+            if line is None:
+                return False
+            if self.req is None:
+                if len(line) > 0:
+                    self.req = line
+            elif len(line) <= 0:
+                # blank line ends the headers
+                self.content_len = 0
+                if "content-length" in self.headers:
+                    self.content_len = int(self.headers["content-length"])
+                if self.content_len > len(self.rx.buf):
+                    raise ValueError("request too large")
+            elif ':' in line:
+                header_key = line[0:line.index(':')].lower()
+                header_value = line[line.index(':') + 1:].lstrip()
+                self.headers.update({header_key: header_value})
+        if self.rx.available() < self.content_len:
+            return False
+        self.content = bytes(self.rx.take(self.content_len)).decode("utf-8")
+        return True
+
+    def queue(self, data):
+        # the next piece of the reply, the previous one must be all sent
+        if data is None or len(data) <= 0:
+            return
+        self.tx = memoryview(payload_buffer(data))
+        self.tx_pos = 0
+
+    def send_pending(self):
+        # sends as much as the socket takes right now, returns True once there is nothing left
+        if self.tx is None:
+            return True
+        try:
+            n = self.sock.send(self.tx[self.tx_pos:])
+        except OSError as e:
+            if would_block(e) == False:
+                raise
+            n = 0
+        if n is not None and n > 0:
+            self.tx_pos += n
+            self.t = pyb.millis()
+        if self.tx_pos >= len(self.tx):
+            self.tx = None
+            self.tx_pos = 0
+            return True
+        return False
+
+    def close(self):
+        if self.job is not None:
+            try:
+                self.job.close()
+            except Exception as exc:
+                exclogger.log_exception(exc, to_print = False, to_file = False)
+            self.job = None
+        try:
+            self.sock.close()
+        except Exception as exc:
+            exclogger.log_exception(exc, to_print = False, to_file = False)
+
 class CaptivePortal(object):
     def __init__(self, debug = False, enable_dns = False):
         self.debug = debug
@@ -25,6 +240,7 @@ class CaptivePortal(object):
 
         self.udps = None
         self.s = None
+        self.clients = []
         self.handlers = {}
         self.list_files()
 
@@ -193,7 +409,7 @@ class CaptivePortal(object):
         try:
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # TCP
             self.s.bind(('', 80))
-            self.s.listen(1)
+            self.s.listen(MAX_CLIENTS)
             self.s.settimeout(0.1)
             self.need_kill = False
         except OSError as e:
@@ -266,28 +482,18 @@ class CaptivePortal(object):
 
         if f is not None:
             if self.debug:
-                print(", file \"%s\" as \"%s\" size %u ..." % (fname, content_type, fsize), end="")
-            try:
-                client_stream.write("HTTP/1.0 200 OK\r\ncontent-type: %s\r\ncache-control: no-cache\r\ncontent-length: %u\r\n\r\n" % (content_type, fsize))
-                stream_file(client_stream, f)
-            except Exception as exc:
-                exclogger.log_exception(exc)
+                print(", file \"%s\" as \"%s\" size %u" % (fname, content_type, fsize))
+            return send_file(f, content_type, fsize)
 
-            try:
-                f.close()
-            except Exception as exc:
-                exclogger.log_exception(exc, to_print = False, to_file = False)
-            if self.debug:
-                print(" done")
-        else:
-            if self.debug:
-                print(", error 404 \"%s\"" % request_page)
-            client_stream.write("HTTP/1.0 404\r\ncontent-type: text/html\r\ncache-control: no-cache\r\n\r\n<html><h1>Error 404</h1><br /><h3>File Not Found</h3><br />%s</html>" % request_page)
+        if self.debug:
+            print(", error 404 \"%s\"" % request_page)
+        client_stream.write("HTTP/1.0 404\r\ncontent-type: text/html\r\ncache-control: no-cache\r\n\r\n<html><h1>Error 404</h1><br /><h3>File Not Found</h3><br />%s</html>" % request_page)
 
         try:
             client_stream.close()
         except Exception as exc:
             exclogger.log_exception(exc, to_print = False, to_file = False)
+        return True
 
     def update_imgstream(self, client, img):
         client.send("\r\n--openmv\r\n" \
@@ -297,42 +503,11 @@ class CaptivePortal(object):
         self.tickle()
 
     def websocket_send(self, sock, data):
-        dlen = int(len(data))
-        opcode = 0x81 if type(data) == str else 0x80
-        self.websocket_send_start(sock, dlen, opcode)
-        sock.send(data)
+        websock_codec.send(sock, data)
         self.tickle()
 
     def websocket_send_start(self, sock, dlen, opcode, timeout = 0.5):
-        if dlen <= 125:
-            header = bytearray(2)
-            paylen = dlen
-            header[1] = paylen
-        elif dlen <= 65535:
-            header = bytearray(4)
-            paylen = 126
-            header[1] = paylen
-            header[2] = (dlen & 0xFF00) >> 8
-            header[3] = (dlen & 0x00FF) >> 0
-        else:
-            header = bytearray(10)
-            paylen = 127
-            header[1] = paylen
-            # I'm not going to deal with a 64 bit data length
-            # there's just no way a packet is that big
-            header[2] = 0
-            header[3] = 0
-            header[4] = 0
-            header[5] = 0
-            header[6] = (dlen & 0xFF000000) >> 24
-            header[7] = (dlen & 0x00FF0000) >> 16
-            header[8] = (dlen & 0x0000FF00) >> 8
-            header[9] = (dlen & 0x000000FF) >> 0
-        header[0] = opcode
-        if timeout is not None:
-            if timeout >= 0:
-                sock.settimeout(timeout)
-        sock.send(header)
+        websock_codec.send_start(sock, dlen, opcode, timeout = timeout)
 
     def tickle(self):
         self.last_http_time = pyb.millis()
@@ -394,73 +569,109 @@ class CaptivePortal(object):
             self.start_http()
         if self.s is None:
             return STS_IDLE # this only happens if the WiFi hardware is missing
-        res = None
+        self.accept_client()
+        served = False
+        t = pyb.millis()
+        remaining = []
+        for c in self.clients:
+            keep = True
+            try:
+                if c.state == CONN_REQUEST:
+                    if c.poll_request():
+                        served = True
+                        keep = self.dispatch(c)
+                    elif pyb.elapsed_millis(c.t) > REQ_TIMEOUT:
+                        if self.debug:
+                            print("http req[%s] timeout" % str(c.addr))
+                        c.close()
+                        keep = False
+                if c.state == CONN_SENDING and keep:
+                    while pyb.elapsed_millis(t) < SEND_SLICE:
+                        if c.send_pending() == False:
+                            break # the client is not keeping up, the rest goes on a later call
+                        if c.job is None:
+                            # all of it is sent
+                            c.close()
+                            keep = False
+                            break
+                        try:
+                            c.queue(next(c.job))
+                        except StopIteration:
+                            c.job = None
+                    if keep and pyb.elapsed_millis(c.t) > SEND_STALL:
+                        if self.debug:
+                            print("http send[%s] stalled" % str(c.addr))
+                        c.close()
+                        keep = False
+                    self.tickle()
+            except KeyboardInterrupt:
+                raise
+            except OSError as e:
+                print("http serve OSError " + str(e))
+                c.close()
+                keep = False
+            except Exception as e:
+                exclogger.log_exception(e)
+                c.close()
+                keep = False
+            if keep:
+                remaining.append(c)
+        self.clients = remaining
+        if served:
+            return STS_SERVED
+        return STS_IDLE
+
+    def accept_client(self):
+        # only wait for a new connection when there's nothing else to do
+        self.s.settimeout(0 if len(self.clients) > 0 else 0.1)
         try:
             res = self.s.accept()
-            self.need_kill = True
-            self.s.settimeout(10000)
         except OSError as e:
-            #if self.need_kill:
+            if would_block(e):
+                return # nobody is waiting to connect
+            # anything else means the listening socket is broken, it has to be opened again
+            print("http accept OSError " + str(e))
             self.s.close()
             self.s = None
             self.start_http()
-            return STS_IDLE
+            return
         if res is None:
-            return STS_IDLE
-        try:
-            if self.debug:
-                print("http req[%s]: " % str(res[1]), end="")
-            self.last_http_time = pyb.millis()
-            self.full_reboot_timer = self.last_http_time
-            client_sock = res[0]
-            client_addr = res[1]
-            client_sock.settimeout(10)
-            can_drop = True
-            client_stream = client_sock
-            req = socket_readline(client_stream, blocking = True)
-            if req is None:
-                if self.debug:
-                    print("None")
-                raise OSError("socket no data")
-            if self.debug:
-                print(req)
-            req_split = req.split(' ')
-            request_page, request_urlparams = split_get_request(req)
-            headers = []
-            content = ""
-            if req_split[0] == "GET":
-                if request_page in self.handlers:
-                    can_drop = self.handlers[request_page](client_stream, req, headers, content)
-                else:
-                    self.handle_default(client_stream, req, headers, content)
-            elif req_split[0] == "POST":
-                # WARNING: POST requests are not used or tested right now
-                # note: we have full control as to what the webpages will send, POST requests are not used for our applications
-                headers, content = get_all_headers(client_stream)
-                client_sock.settimeout(10) # needs to be re-established
-                if request_page in self.handlers:
-                    can_drop = self.handlers[request_page](client_stream, req, headers, content)
-                else:
-                    self.handle_default(client_stream, req, headers, content)
-            self.last_http_time = pyb.millis()
-            self.full_reboot_timer = self.last_http_time
-            self.s.settimeout(0.3)
-            if can_drop:
-                try:
-                    client_sock.settimeout(0.3) # might be closed by request
-                except Exception as exc:
-                    exclogger.log_exception(exc, to_print = False, to_file = False)
-            return STS_SERVED
-        except KeyboardInterrupt:
-            raise
-        except OSError as e:
-            print("http serve OSError " + str(e) + " " + str(e.args[0]))
-            self.s.close()
-            self.s = None
-        except Exception as e:
-            exclogger.log_exception(e)
-            pass
-        return STS_IDLE
+            return
+        if len(self.clients) >= MAX_CLIENTS:
+            # the oldest one is most likely the one that went quiet
+            self.clients[0].close()
+            self.clients.pop(0)
+        self.clients.append(HttpClient(res[0], res[1]))
+        self.tickle()
+
+    def dispatch(self, c):
+        # the whole request is in, runs the handler, returns True if the portal still has work to do with this connection
+        req = c.req
+        if self.debug:
+            print("http req[%s]: %s" % (str(c.addr), req))
+        self.tickle()
+        req_split = req.split(' ')
+        request_page, request_urlparams = split_get_request(req)
+        c.sock.settimeout(SEND_TIMEOUT)
+        res = True
+        if req_split[0] == "GET" or req_split[0] == "POST":
+            # note: we have full control as to what the webpages will send, POST requests are not used for our applications
+            if request_page in self.handlers:
+                res = self.handlers[request_page](c.sock, req, c.headers, c.content)
+            else:
+                res = self.handle_default(c.sock, req, c.headers, c.content)
+        self.tickle()
+        if isinstance(res, GeneratorType):
+            # from here on nothing waits on this client
+            c.sock.settimeout(0)
+            c.job = res
+            c.state = CONN_SENDING
+            c.t = pyb.millis()
+            return True
+        if res != False:
+            c.close()
+        # returning False means the handler kept the socket for itself, such as a websocket
+        return False
 
     def task(self, allow_kick = True):
         self.task_conn()
@@ -487,6 +698,9 @@ class CaptivePortal(object):
         self.last_http_time = -1
         if self.debug:
             print("server being kicked")
+        for c in self.clients:
+            c.close()
+        self.clients = []
         if self.s is not None:
             try:
                 self.s.close()
@@ -521,114 +735,192 @@ class CaptivePortal(object):
         self.start_wifi_hw()
         self.full_reboot_timer = pyb.millis()
 
-# usocket implementation is missing readline
-def socket_readline(sock, blocking = False):
-    if blocking == False:
-        sock.settimeout(0)
-    res = ""
-    while True:
-        try:
-            x = sock.recv(1)
-            if x is None:
-                if len(res) > 0:
-                    return res
-                else:
-                    return None
-            if len(x) <= 0:
-                if len(res) > 0:
-                    return res
-                else:
+class WebSocketCodec(object):
+    # reads and writes the frames of one websocket, the buffers are allocated once and reused for every frame
+    # payloads are unmasked where they are in the receive buffer, and a small message goes out with its header in a single send()
+
+    def __init__(self, rx_size = WS_RX_SIZE, tx_size = WS_TX_SIZE):
+        self.rx = RxBuffer(rx_size)
+        self.tx = bytearray(tx_size)
+        self.tx_mv = memoryview(self.tx)
+        self.mask = bytearray(4)
+        self.reset()
+
+    def reset(self):
+        self.rx.reset()
+        self.frag = None # the message so far, when it is sent in several frames
+        self.frag_op = 0
+
+    def put_header(self, dlen, opcode):
+        # writes the frame header to the start of the transmit buffer, returns its length
+        tx = self.tx
+        tx[0] = opcode
+        if dlen <= 125:
+            tx[1] = dlen
+            return 2
+        elif dlen <= 65535:
+            tx[1] = 126
+            tx[2] = (dlen & 0xFF00) >> 8
+            tx[3] = (dlen & 0x00FF) >> 0
+            return 4
+        # I'm not going to deal with a 64 bit data length
+        # there's just no way a packet is that big
+        tx[1] = 127
+        tx[2] = 0
+        tx[3] = 0
+        tx[4] = 0
+        tx[5] = 0
+        tx[6] = (dlen & 0xFF000000) >> 24
+        tx[7] = (dlen & 0x00FF0000) >> 16
+        tx[8] = (dlen & 0x0000FF00) >> 8
+        tx[9] = (dlen & 0x000000FF) >> 0
+        return 10
+
+    def send_start(self, sock, dlen, opcode, timeout = 0.5):
+        # only the header, the caller sends the payload itself
+        n = self.put_header(dlen, opcode)
+        if timeout is not None:
+            if timeout >= 0:
+                sock.settimeout(timeout)
+        sock.send(self.tx_mv[0:n])
+
+    def send(self, sock, data, timeout = 0.5):
+        opcode = 0x81 if type(data) == str else 0x82
+        data = payload_buffer(data)
+        dlen = len(data)
+        n = self.put_header(dlen, opcode)
+        if timeout is not None:
+            if timeout >= 0:
+                sock.settimeout(timeout)
+        if n + dlen <= len(self.tx):
+            self.tx_mv[n:n + dlen] = data
+            sock.send(self.tx_mv[0:n + dlen])
+        else:
+            sock.send(self.tx_mv[0:n])
+            sock.send(data)
+
+    def readmsg(self, sock):
+        # returns one message, or None if a whole one hasn't arrived yet
+        # a partial frame stays in the buffer, the rest of it is picked up by the next call
+        # a message sent in several frames is put back together, control frames in between are returned as they arrive
+        rx = self.rx
+        rx.fill(sock)
+        while True:
+            n = rx.available()
+            if n < 2:
+                return None
+            opcode0 = rx.peek(0)
+            opcode1 = rx.peek(1)
+            masked = (opcode1 & 0x80) != 0
+            paylen = opcode1 & 0x7F
+            hdlen = 2
+            datalen = paylen
+            if paylen == 126:
+                hdlen = 4
+                if n < hdlen:
                     return None
-            y = x.decode('utf-8')
-            if y == "\n":
-                if len(res) > 0:
-                    if res[-1] == "\r":
-                        res = res[:-1]
-                return res
-            res += y
-        except:
-            break
-    return res
-
-# usocket implementation is missing readall
-def socket_readall(sock, blocking = False):
-    if blocking == False:
-        sock.settimeout(0)
-    chunk = 1024
-    res = ""
-    while True:
-        try:
-            x = sock.recv(chunk)
-            if x is None:
-                if len(res) > 0:
-                    return res
-                else:
+                datalen = (rx.peek(2) << 8) + rx.peek(3)
+            elif paylen == 127:
+                hdlen = 10
+                if n < hdlen:
                     return None
-            if len(x) <= 0:
-                if len(res) > 0:
-                    return res
-                else:
+                datalen = 0
+                i = 2
+                while i < 10:
+                    datalen = (datalen << 8) + rx.peek(i)
+                    i += 1
+            masklen = 4 if masked else 0
+            if n < hdlen + masklen:
+                return None
+            big = hdlen + masklen + datalen > len(rx.buf)
+            if n < hdlen + masklen + datalen and big == False:
+                return None
+            rx.take(hdlen)
+            if masked:
+                i = 0
+                while i < 4:
+                    self.mask[i] = rx.peek(i)
+                    i += 1
+                rx.take(4)
+            opcode = opcode0 & 0x0F
+            fin = (opcode0 & 0x80) != 0
+            if big:
+                data = self.readbig(sock, datalen, masked)
+                if data is None:
                     return None
-            res += x.decode('utf-8')
-            if len(x) < chunk:
-                return res
-        except:
-            return res
-    return res
-
-def websocket_readmsg(sock):
-    sock.settimeout(0)
-    try:
-        hd1 = sock.recv(2)
-        sock.settimeout(0.1)
-        if len(hd1) != 2:
-            if len(hd1) != 0:
-                print("incomplete websocket reply")
+            else:
+                if masked:
+                    unmask(rx.words, rx.buf, rx.start, datalen, self.mask)
+                data = rx.take(datalen)
+
+            if opcode >= 0x08:
+                return bytearray(data) # control frame
+            if opcode == 0x00:
+                if self.frag is None:
+                    continue # nothing to continue from
+                if len(self.frag) + datalen > WS_MAX_MSG:
+                    print("websocket message too long")
+                    self.frag = None
+                    continue
+                self.frag.extend(data)
+                if fin == False:
+                    continue
+                data = self.frag
+                opcode = self.frag_op
+                self.frag = None
+            elif fin == False:
+                self.frag = bytearray(data)
+                self.frag_op = opcode
+                continue
+            if opcode == 0x01:
+                return str(data, "utf-8")
+            return bytearray(data)
+
+    def readbig(self, sock, datalen, masked):
+        # the frame does not fit in the buffer, the rest of it is waited for, like before the buffer was used
+        rx = self.rx
+        try:
+            words, data = word_buffer(datalen)
+            mv = memoryview(data)
+            got = min(rx.available(), datalen)
+            mv[0:got] = rx.take(got)
+            sock.settimeout(0.5)
+            while got < datalen:
+                x = sock.readinto(mv[got:datalen])
+                if x is None or x <= 0:
+                    raise OSError("websocket frame timeout")
+                got += x
+            if masked:
+                unmask(words, data, 0, datalen, self.mask)
+            return bytes(mv[0:datalen]) # a copy, the words are not referenced anymore after this
+        except Exception as exc:
+            print("incomplete websocket reply")
+            exclogger.log_exception(exc, to_file=False)
+            self.reset()
             return None
-        sock.settimeout(0.5)
-    except:
-        return None
-    try:
-        # assume no fragmentation
-        mask = False
-        opcode0 = hd1[0]
-        opcode1 = hd1[1]
-        if (opcode1 & 0x80) != 0:
-            mask = True
-            opcode1 &= 0x7F
-        paylen = opcode1
-        datalen = 0
-        if paylen <= 125:
-            datalen = paylen
-        elif paylen == 126:
-            hd2 = sock.recv(2)
-            datalen = hd2[0] << 8
-            datalen += hd2[1]
-        elif paylen == 127:
-            hd2 = sock.recv(8)
-            i = 0
-            while i < 8:
-                datalen += hd2[i] << (8 * (7 - i))
-                i += 1
-        if mask:
-            mask = sock.recv(4)
 
-        data = sock.recv(datalen)
-        data = bytearray(data)
-        if mask != False:
-            i = 0
-            while i < datalen:
-                data[i] = data[i] ^ mask[i % 4]
-                i += 1
-        if (opcode0 & 0x0F) == 0x01:
-            return data.decode('utf-8')
-        return data
+# used when a websocket function isn't given a codec, handle_websocket starts it over for every new websocket
+websock_codec = WebSocketCodec()
+
+def websocket_readmsg(sock, codec = None):
+    if codec is None:
+        codec = websock_codec
+    try:
+        return codec.readmsg(sock)
     except Exception as exc:
         print("incomplete websocket reply")
         exclogger.log_exception(exc, to_file=False)
+        codec.reset()
         return None
 
 def gen_page(conn, main_file, add_files = [], add_dir = None, debug = False):
+    for x in gen_page_iter(main_file, add_files = add_files, add_dir = add_dir, debug = debug):
+        conn.write(x)
+    conn.close()
+
+def gen_page_iter(main_file, add_files = [], add_dir = None, debug = False):
+    # same as gen_page, but yields every piece of the page instead of sending it
+    # a handler returns this to the portal, which sends the pieces as fast as the client takes them
     total_size = 0
     total_size += uos.stat(main_file)[6]
     flist = []
@@ -653,7 +945,7 @@ def gen_page(conn, main_file, add_files = [], add_dir = None, debug = False):
     if debug:
         print("gen_page \"%s\" sz %u files %u ..." % (main_file, total_size, len(flist)), end="")
 
-    conn.write(default_reply_header(content_length = total_size))
+    yield default_reply_header(content_length = total_size)
 
     sent = 0
     seekpos = 0
@@ -663,8 +955,8 @@ def gen_page(conn, main_file, add_files = [], add_dir = None, debug = False):
             headstr += f.read(1).decode("ascii")
             seekpos += 1
             sent += 1
-        conn.write(headstr + "\r\n")
-        sent += 2
+    yield headstr + "\r\n"
+    sent += 2
     if debug:
         print("-", end="")
 
@@ -675,19 +967,23 @@ def gen_page(conn, main_file, add_files = [], add_dir = None, debug = False):
                 if fn.lower().endswith(".js"):
                     s = "\r\n<script type=\"text/javascript\">\r\n"
                     sent += len(s)
-                    conn.write(s)
-                    sent += stream_file(conn, f)
+                    yield s
+                    for x in stream_file_iter(f):
+                        sent += len(x)
+                        yield x
                     s = "\r\n</script>\r\n"
                     sent += len(s)
-                    conn.write(s)
+                    yield s
                 elif fn.lower().endswith(".css"):
                     s = "\r\n<style type=\"text/css\">\r\n"
                     sent += len(s)
-                    conn.write(s)
-                    sent += stream_file(conn, f)
+                    yield s
+                    for x in stream_file_iter(f):
+                        sent += len(x)
+                        yield x
                     s = "\r\n</style>\r\n"
                     sent += len(s)
-                    conn.write(s)
+                    yield s
                 else:
                     raise Exception("unsupported file type")
                 if debug:
@@ -698,25 +994,34 @@ def gen_page(conn, main_file, add_files = [], add_dir = None, debug = False):
     # send the rest of the file
     with open(main_file, "rb") as f:
         f.seek(seekpos)
-        sent += stream_html_to_body(conn, f)
-        sent += stream_file(conn, f)
+        for x in stream_html_to_body_iter(f):
+            sent += len(x)
+            yield x
+        for x in stream_file_iter(f):
+            sent += len(x)
+            yield x
         if debug:
             print("+", end="")
 
     # pad the end
-    while sent < total_size - 2:
-        conn.write(" ")
-        sent += 1
+    if sent < total_size - 2:
+        yield " " * (total_size - 2 - sent)
 
     if debug:
         print(" done!")
 
-    conn.close()
-
 def stream_html_to_body(dest, f):
+    sent = 0
+    for x in stream_html_to_body_iter(f):
+        dest.write(x)
+        sent += len(x)
+    return sent
+
+def stream_html_to_body_iter(f):
+    # yields the file a line at a time, up to the body tag, the lines between the ignore markers are dropped
+    # the markers are checked only at the end of the buffer, after every character, and long lines are given in pieces
     strbuf = ""
     ignoring = False
-    sent = 0
     while True:
         x = f.read(1).decode("ascii")
         if x is None:
@@ -724,26 +1029,42 @@ def stream_html_to_body(dest, f):
         if len(x) <= 0:
             break
         strbuf += x
-        if "<body" in strbuf:
-            sent += len(strbuf)
-            dest.write(strbuf)
+        if strbuf.endswith("<body"):
+            yield strbuf
             break
-        elif "<!-- ignore -->" in strbuf:
-            sent += len(strbuf)
-            dest.write(strbuf)
+        elif strbuf.endswith("<!-- ignore -->"):
+            yield strbuf
             strbuf = ""
             ignoring = True
-        elif "<!-- end ignore -->" in strbuf:
+        elif strbuf.endswith("<!-- end ignore -->"):
             strbuf = ""
             ignoring = False
             break
-        elif "\n" in strbuf and ignoring == False:
-            sent += len(strbuf)
-            dest.write(strbuf)
+        elif x == "\n":
+            if ignoring:
+                yield "" # the ignored lines are dropped as they are read, nothing to send
+            else:
+                yield strbuf
             strbuf = ""
-    return sent
+        elif len(strbuf) >= 256:
+            # keep enough at the end for a marker that is not complete yet
+            if ignoring:
+                strbuf = strbuf[-20:]
+                yield ""
+            else:
+                y = strbuf[:-20]
+                strbuf = strbuf[-20:]
+                yield y
 
 def stream_file(dest, f, bufsz = -1, buflim = 2048):
+    sent = 0
+    for x in stream_file_iter(f, bufsz = bufsz, buflim = buflim):
+        dest.write(x)
+        sent += len(x)
+    return sent
+
+def stream_file_iter(f, bufsz = -1, buflim = 2048):
+    # yields the file one chunk at a time
     gc.collect()
     if bufsz <= 0:
         # handle large files by reading one chunk at a time
@@ -755,18 +1076,28 @@ def stream_file(dest, f, bufsz = -1, buflim = 2048):
         if mf > buflim:
             mf = buflim
         mf = int(round(mf))
-    sent = 0
+    else:
+        mf = bufsz
     while True:
         x = f.read(mf)
         if x is None:
             break
-        xlen = len(x)
-        sent += xlen
-        if xlen > 0:
-            dest.write(x)
+        if len(x) > 0:
+            yield x
         else:
             break
-    return sent
+
+def send_file(f, content_type, fsize):
+    # a whole file as the reply, one chunk at a time, closes the file when done, the portal closes the connection
+    try:
+        yield "HTTP/1.0 200 OK\r\ncontent-type: %s\r\ncache-control: no-cache\r\ncontent-length: %u\r\n\r\n" % (content_type, fsize)
+        for x in stream_file_iter(f):
+            yield x
+    finally:
+        try:
+            f.close()
+        except Exception as exc:
+            exclogger.log_exception(exc, to_print = False, to_file = False)
 
 def split_get_request(req):
     req_split = req.split(' ')
@@ -800,23 +1131,6 @@ def split_get_request(req):
         request_urlparams = d
     return request_page, request_urlparams
 
-def get_all_headers(client_stream, blocking = False):
-    headers = {}
-    content = ""
-    while True:
-        line = socket_readline(client_stream, blocking = blocking)
-        if line is None:
-            break
-        if ':' in line:
-            header_key = line[0:line.index(':')].lower()
-            header_value = line[line.index(':') + 1:].lstrip()
-            headers.update({header_key: header_value})
-            if header_key == "content-length":
-                socket_readline(client_stream) # extra line
-                content = socket_readall(client_stream, blocking = blocking)
-                break
-    return headers, content
-
 def split_post_form(headers, content):
     d = {}
     if "content-type" in headers:
@@ -858,6 +1172,7 @@ def handle_websocket(client_stream, req, headers):
             break
     if webkey is None:
         return False
+    websock_codec.reset() # whatever was left over belonged to the previous websocket
     respkey = calc_websocket_resp(webkey)
     resp = "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n" % str(respkey)
     client_stream.settimeout(10)
@@ -0,0 +1,97 @@
+import micropython
+micropython.opt_level(2)
+
+import ustruct
+
+# reads the binary plate solver database on the camera, the layout is described in scripts/platesolver_db.py
+# only the header and the star table are kept in memory, the records of one reference star are read with a seek when they are needed
+# the names are compared as bytes straight out of the string table, no str is made for the stars that are not asked for
+
+DB_MAGIC    = b"PSDB"
+DB_VERSION  = micropython.const(1)
+HEADER_FMT  = "<4sHHIIfHHIIII"
+HEADER_SIZE = micropython.const(40)
+STAR_FMT    = "<IIHBx"
+STAR_SIZE   = micropython.const(12)
+RECORD_SIZE = micropython.const(4)
+
+class StarDb(object):
+
+    def __init__(self, fname):
+        self.f = open(fname, "rb")
+        hdr = ustruct.unpack(HEADER_FMT, self.f.read(HEADER_SIZE))
+        if hdr[0] != DB_MAGIC:
+            raise ValueError("not a plate solver database")
+        if hdr[1] != DB_VERSION or hdr[2] != RECORD_SIZE:
+            raise ValueError("unsupported database version %u" % hdr[1])
+        self.star_cnt = hdr[3]
+        self.rec_cnt = hdr[4]
+        self.pixels_per_degree = hdr[5]
+        self.sensor_width = hdr[6]
+        self.sensor_height = hdr[7]
+        self.rec_ofst = hdr[10]
+        self.f.seek(hdr[8])
+        self.star_tbl = self.f.read(STAR_SIZE * self.star_cnt)
+        self.f.seek(hdr[9])
+        self.names = self.f.read(hdr[11])
+
+    def close(self):
+        self.f.close()
+
+    def __len__(self):
+        return self.star_cnt
+
+    def get_star(self, i):
+        # name offset, first record, record count, name length
+        return ustruct.unpack_from(STAR_FMT, self.star_tbl, i * STAR_SIZE)
+
+    def get_name(self, i):
+        s = self.get_star(i)
+        return str(self.names[s[0]:s[0] + s[3]], "utf-8")
+
+    def find(self, name):
+        # index of a reference star, or -1 if it is not in the database
+        nb = name.encode("utf-8")
+        n = len(nb)
+        names = self.names
+        i = 0
+        while i < self.star_cnt:
+            s = self.get_star(i)
+            if s[3] == n:
+                j = 0
+                while j < n and names[s[0] + j] == nb[j]:
+                    j += 1
+                if j == n:
+                    return i
+            i += 1
+        return -1
+
+    def read_records(self, i, buf):
+        # reads the records of the i-th reference star into buf, a bytearray the caller keeps, returns how many there are
+        # each record is an int16 distance and an int16 angle, see get_record
+        s = self.get_star(i)
+        cnt = s[2]
+        if len(buf) < cnt * RECORD_SIZE:
+            raise ValueError("buffer too small")
+        self.f.seek(self.rec_ofst + (s[1] * RECORD_SIZE))
+        self.f.readinto(memoryview(buf)[0:cnt * RECORD_SIZE])
+        return cnt
+
+    def get_record(self, buf, j):
+        # distance and angle of the j-th record in a buffer filled by read_records
+        return ustruct.unpack_from("<hh", buf, j * RECORD_SIZE)
+
+    def get_bucket(self, name):
+        # all the records of a reference star as a list of (distance, angle), None if it is not in the database
+        i = self.find(name)
+        if i < 0:
+            return None
+        s = self.get_star(i)
+        buf = bytearray(s[2] * RECORD_SIZE)
+        cnt = self.read_records(i, buf)
+        res = []
+        j = 0
+        while j < cnt:
+            res.append(self.get_record(buf, j))
+            j += 1
+        return res
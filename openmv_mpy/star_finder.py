@@ -23,7 +23,20 @@ EXPO_MEMORY_ERR   = micropython.const(6)
 EXPO_CAMERA_ERR   = micropython.const(7)
 EXPO_NOT_READY    = micropython.const(8)
 
-def find_stars(img, hist = None, stats = None, thresh = 0, max_dia = 100, region = None, force_solve = False, guider = False):
+STAR_POOL_SIZE    = micropython.const(150) # only the brightest are kept, the solver only wants about 20
+TOO_MANY_STARS    = micropython.const(125)
+MAX_MEAN          = micropython.const(20)  # frames brighter or noisier than this are rejected, unless the caller gives other limits
+MAX_STDEV         = micropython.const(7)
+REFINE_MAX_WIN    = micropython.const(6)   # refine_stars never looks at more than a 13 x 13 square
+REFINE_MAX_R      = micropython.const(4)   # stars bigger than this keep the blob search's centroid
+
+# allocated once here, if it was allocated for every frame then the heap fragments and find_blobs runs out of memory first
+# the polarscope's find_stars returns this same list every frame, it is filled again by the next call
+star_pool = blobstar.StarList(STAR_POOL_SIZE)
+
+def find_stars(img, hist = None, stats = None, thresh = 0, max_dia = 100, region = None, force_solve = False, guider = False, regions = None, max_mean = MAX_MEAN, max_stdev = MAX_STDEV):
+    # regions is an optional list of rectangles, only those are searched, the statistics can be from a previous frame
+    # thresh, max_mean and max_stdev can come from thresh_ctrl.ThresholdController instead of fixed settings
 
     # histogram and statistics might be computationally costly, use cached results if available
     if hist is None:
@@ -35,9 +48,9 @@ def find_stars(img, hist = None, stats = None, thresh = 0, max_dia = 100, region
         # force_solve is to test performance
         # check the quality
         # this prevents the later steps from running out of memory due to false blobs
-        if stats.mean() >= 20:
+        if stats.mean() >= max_mean:
             return [], EXPO_TOO_HIGH
-        if stats.stdev() >= 7:
+        if stats.stdev() >= max_stdev:
             return [], EXPO_TOO_NOISY
         #if stats.max() < (64 * 3):
         #    return [], EXPO_TOO_LOW
@@ -57,9 +70,14 @@ def find_stars(img, hist = None, stats = None, thresh = 0, max_dia = 100, region
     area = int(max_star_width * max_star_width)
     maxpix = int(round(((float(max_star_width) / 2.0) ** 2) * 3.14159))
 
+    if regions is None:
+        regions = [region]
+
     gc.collect()
     try:
-        blobs = img.find_blobs([(thresh, 255)], merge = False, x_stride = 2, y_stride = 2, roi = region, area_threshold = -area, pixel_threshold = -maxpix, width_threshold = -max_star_width, height_threshold = -max_star_width, guidestarmode = guider)
+        blobs = []
+        for r in regions:
+            blobs.extend(img.find_blobs([(thresh, 255)], merge = False, x_stride = 2, y_stride = 2, roi = r, area_threshold = -area, pixel_threshold = -maxpix, width_threshold = -max_star_width, height_threshold = -max_star_width, guidestarmode = guider))
     except MemoryError as exc:
         print("MEMORY ERROR from find_blobs")
         exclogger.log_exception(exc, to_file = False)
@@ -76,35 +94,19 @@ def find_stars(img, hist = None, stats = None, thresh = 0, max_dia = 100, region
             return [], EXPO_MEMORY_ERR
 
     # use old technique for polarscope
-    blobs_cnt = len(blobs)
-    stars = []
-    while blobs_cnt > 0:
-        try:
-            stars = [None] * blobs_cnt
-            break
-        except MemoryError:
-            blobs_cnt - 10
-            print("memerr allocating new list")
-    #too_long = 0
-    #too_big  = 0
-    try:
-        i = 0
-        for b in blobs:
-            r = (b.w() + b.h()) / 3
-            bb = blobstar.BlobStar(b.cxf(), b.cyf(), r, b.brightness_sum())
-            if i < blobs_cnt:
-                stars[i] = bb
-            i += 1
-    except MemoryError as exc:
-        print("MEMORY ERROR adding blob star to list")
-        exclogger.log_exception(exc, to_file = False)
-        return [], EXPO_MEMORY_ERR
+    # the blobs go into the preallocated star list, keeping the brightest, no star objects are made
+    star_pool.clear()
+    for b in blobs:
+        r = (b.w() + b.h()) / 3
+        star_pool.add(b.cxf(), b.cyf(), r, b.brightness_sum())
+    blobs = None
+    stars = star_pool
     if force_solve == False:
         #if too_big > len(stars):
         #    return stars, EXPO_TOO_BIG
         #if too_long > len(stars):
         #    return stars, EXPO_MOVEMENT
-        if len(stars) > 125:
+        if star_pool.total > TOO_MANY_STARS:
             # we have a database of around 20 stars
             # only 4 are needed for a solution
             # if you see 30, that's a really really good exposure but unlikely in all conditions
@@ -113,6 +115,121 @@ def find_stars(img, hist = None, stats = None, thresh = 0, max_dia = 100, region
             return stars, EXPO_TOO_MANY
     return stars, EXPO_JUST_RIGHT
 
+def make_regions(centers, win, width, height):
+    # square windows around each (x, y), clipped to the image
+    # windows that overlap are combined so that no star is found twice
+    half = win // 2
+    rects = []
+    for c in centers:
+        x1 = max(0, int(c[0]) - half)
+        y1 = max(0, int(c[1]) - half)
+        x2 = min(width, int(c[0]) + half)
+        y2 = min(height, int(c[1]) + half)
+        if x2 > x1 and y2 > y1:
+            rects.append([x1, y1, x2, y2])
+    merged = True
+    while merged:
+        merged = False
+        i = 0
+        while i < len(rects):
+            j = i + 1
+            while j < len(rects):
+                a = rects[i]
+                b = rects[j]
+                if a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]:
+                    a[0] = min(a[0], b[0])
+                    a[1] = min(a[1], b[1])
+                    a[2] = max(a[2], b[2])
+                    a[3] = max(a[3], b[3])
+                    rects.pop(j)
+                    merged = True
+                else:
+                    j += 1
+            i += 1
+    res = []
+    for r in rects:
+        res.append((r[0], r[1], r[2] - r[0], r[3] - r[1]))
+    return res
+
+def refine_centroid(img, cx, cy, win = 4):
+    # background subtracted, brightness weighted centroid of the (win * 2 + 1) square around (cx, cy)
+    # the blob search skips every other pixel and its centroid has the background in it, this looks at every pixel of the square
+    # the pixels are summed by the firmware, one get_statistics per row and per column of the square, never one call per pixel
+    # the background is the average of the pixels on the edge of the square
+    # returns None if the square does not fit in the image or there is nothing above the background
+    x0 = int(round(cx)) - win
+    y0 = int(round(cy)) - win
+    n = (win * 2) + 1
+    m = n - 2 # inside the edge
+    if x0 < 0 or y0 < 0 or x0 + n > img.width() or y0 + n > img.height():
+        return None
+    # the firmware's mean is rounded down, half a count is added back to every mean
+    bg  = img.get_statistics(roi = (x0, y0, n, 1)).mean()
+    bg += img.get_statistics(roi = (x0, y0 + n - 1, n, 1)).mean()
+    bg += img.get_statistics(roi = (x0, y0 + 1, 1, m)).mean()
+    bg += img.get_statistics(roi = (x0 + n - 1, y0 + 1, 1, m)).mean()
+    bg = (bg / 4) + 0.5
+    sum_w = 0.0
+    sum_p = 0.0
+    i = 1
+    while i <= m:
+        w = img.get_statistics(roi = (x0 + 1, y0 + i, m, 1)).mean() + 0.5 - bg
+        if w > 0:
+            sum_w += w
+            sum_p += w * i
+        i += 1
+    if sum_w <= 0:
+        return None
+    y = y0 + (sum_p / sum_w)
+    sum_w = 0.0
+    sum_p = 0.0
+    i = 1
+    while i <= m:
+        w = img.get_statistics(roi = (x0 + i, y0 + 1, 1, m)).mean() + 0.5 - bg
+        if w > 0:
+            sum_w += w
+            sum_p += w * i
+        i += 1
+    if sum_w <= 0:
+        return None
+    return x0 + (sum_p / sum_w), y
+
+def refine_stars(img, star_list, cnt = 10, near = None, win = 4, max_shift = 2.0):
+    # refines the centroids of the first cnt stars of the list (best rated, after guidestar.process_list)
+    # and the star closest to near, which is meant to be where the selected star was in the previous frame
+    # a result that moved too far is assumed to be caught on a neighbour or a hot pixel, and is ignored
+    # returns how many stars were refined
+    todo = star_list[:cnt]
+    if near is not None:
+        extra = None
+        extra_dist = 0
+        for s in star_list:
+            dx = s.cxf() - near[0]
+            dy = s.cyf() - near[1]
+            d = (dx * dx) + (dy * dy)
+            if extra is None or d < extra_dist:
+                extra = s
+                extra_dist = d
+        if extra is not None and extra not in todo:
+            todo.append(extra)
+    res = 0
+    for s in todo:
+        if s.max_brightness() >= 255:
+            continue # the top is clipped, the blob's own centroid is as good as it gets
+        if s.r() > REFINE_MAX_R:
+            continue # a big star already has plenty of pixels in its blob, refining it would only cost time
+        ox = s.cxf()
+        oy = s.cyf()
+        w = min(max(win, s.r() + 2), REFINE_MAX_WIN) # the square needs to reach past the star, or its edge is not background
+        c = refine_centroid(img, ox, oy, win = w)
+        if c is None:
+            continue
+        if abs(c[0] - ox) > max_shift or abs(c[1] - oy) > max_shift:
+            continue
+        s.move_coord(c[0], c[1])
+        res += 1
+    return res
+
 def simple_list(list):
     cnt = len(list)
     res = [[1.5, 1.5]] * cnt
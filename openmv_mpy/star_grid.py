@@ -0,0 +1,144 @@
+import micropython
+micropython.opt_level(2)
+
+import math
+
+# grid hash over star centroids, built once per frame
+# the stars are put into square cells, a search only has to look at the cells around a point instead of every star
+# works with anything that has cxf()/cyf() (guide stars and blobs), cx/cy (BlobStar) or is a (x, y) pair (hot pixels)
+# the on-camera frame to frame matching, clustering and hot pixel filtering are still the pairwise loops in the firmware's guidestar module,
+# its source is omv/modules/py_guidestar.c inside openmv_fw/snapshot.zip, using a grid there means rebuilding firmware.bin
+
+def star_xy(s):
+    if hasattr(s, "cxf"):
+        return s.cxf(), s.cyf()
+    if hasattr(s, "cx"):
+        return s.cx, s.cy
+    return s[0], s[1]
+
+class StarGrid(object):
+
+    def __init__(self, star_list, cell = 64):
+        self.star_list = star_list
+        self.cell = max(1, int(cell))
+        self.cells = {}
+        self.xs = []
+        self.ys = []
+        i = 0
+        cnt = len(star_list)
+        while i < cnt:
+            x, y = star_xy(star_list[i])
+            self.xs.append(x)
+            self.ys.append(y)
+            key = self.key(int(math.floor(x / self.cell)), int(math.floor(y / self.cell)))
+            if key in self.cells:
+                self.cells[key].append(i)
+            else:
+                self.cells[key] = [i]
+            i += 1
+
+    def __len__(self):
+        return len(self.star_list)
+
+    def key(self, cx, cy):
+        # the cells are sparse, so a dict is used instead of an array covering the whole sensor
+        return (cy << 16) + cx
+
+    def _search(self, x, y, r):
+        # yields the index and the distance of every star in the cells that a circle of radius r could touch
+        cx0 = int(math.floor((x - r) / self.cell))
+        cx1 = int(math.floor((x + r) / self.cell))
+        cy0 = int(math.floor((y - r) / self.cell))
+        cy1 = int(math.floor((y + r) / self.cell))
+        cy = cy0
+        while cy <= cy1:
+            cx = cx0
+            while cx <= cx1:
+                lst = self.cells.get(self.key(cx, cy))
+                if lst is not None:
+                    for i in lst:
+                        dx = self.xs[i] - x
+                        dy = self.ys[i] - y
+                        yield i, math.sqrt((dx * dx) + (dy * dy))
+                cx += 1
+            cy += 1
+
+    def nearest(self, x, y, max_dist):
+        # index of the nearest star no farther than max_dist and its distance, or (-1, max_dist)
+        # if two stars are just as far, the one earlier in the list is returned, same as a linear scan
+        best_i = -1
+        best_d = max_dist
+        for i, d in self._search(x, y, max_dist):
+            if d < best_d or (d == best_d and (best_i < 0 or i < best_i)):
+                best_i = i
+                best_d = d
+        return best_i, best_d
+
+    def nearest_star(self, x, y, max_dist):
+        i, d = self.nearest(x, y, max_dist)
+        if i < 0:
+            return None
+        return self.star_list[i]
+
+    def within(self, x, y, r):
+        # indices of all the stars closer than r, in list order
+        res = []
+        for i, d in self._search(x, y, r):
+            if d < r:
+                res.append(i)
+        res.sort()
+        return res
+
+    def any_within(self, x, y, r):
+        for i, d in self._search(x, y, r):
+            if d < r:
+                return True
+        return False
+
+def check_grid(cnt = 300):
+    # compares the grid searches against a plain scan over every star, returns how many checks failed
+    # random stars with a few exact duplicates for ties, cells of several sizes and search radii bigger and smaller than a cell
+    import random
+    fails = 0
+    n = 0
+    while n < cnt:
+        n += 1
+        stars = []
+        i = random.randint(0, 40)
+        while i > 0:
+            i -= 1
+            stars.append((random.uniform(-50.0, 700.0), random.uniform(-50.0, 500.0)))
+            if random.randint(0, 9) == 0:
+                stars.append(stars[-1])
+        grid = StarGrid(stars, cell = random.choice([1, 16, 64, 200]))
+        x = random.uniform(-100.0, 750.0)
+        y = random.uniform(-100.0, 550.0)
+        r = random.uniform(0.5, 300.0)
+        best_i = -1
+        best_d = r
+        inside = []
+        i = 0
+        while i < len(stars):
+            dx = stars[i][0] - x
+            dy = stars[i][1] - y
+            d = math.sqrt((dx * dx) + (dy * dy))
+            if d < best_d:
+                best_i = i
+                best_d = d
+            if d < r:
+                inside.append(i)
+            i += 1
+        if grid.nearest(x, y, r) != (best_i, best_d):
+            fails += 1
+            print("nearest wrong: %s, expected %s" % (str(grid.nearest(x, y, r)), str((best_i, best_d))))
+        if grid.within(x, y, r) != inside:
+            fails += 1
+            print("within wrong: %s, expected %s" % (str(grid.within(x, y, r)), str(inside)))
+        if grid.any_within(x, y, r) != (len(inside) > 0):
+            fails += 1
+            print("any_within wrong at (%.1f, %.1f) r %.1f" % (x, y, r))
+    print("star grid check, %u failed" % fails)
+    return fails
+
+if __name__ == "__main__":
+    check_grid()
@@ -0,0 +1,191 @@
+import micropython
+micropython.opt_level(2)
+
+import star_finder
+
+# adjusts the star detection threshold from frame to frame to hold the number of stars near a target
+# find_stars on its own uses mean * 3 from a single frame, which falls apart during twilight or when clouds pass,
+# the frame gets rejected with EXPO_TOO_MANY or runs out of memory in find_blobs
+# this keeps a short history of the image statistics and the star counts, so one odd frame does not swing the threshold
+# it also suggests when the gain or shutter should change, it never changes them itself
+
+HISTORY_LEN     = micropython.const(8)
+MAX_THRESH      = micropython.const(250)
+STEP_MIN        = micropython.const(2)
+MEAN_WARNING    = micropython.const(15) # find_stars rejects frames at star_finder.MAX_MEAN unless get_limits() allows more
+LIMIT_GROWTH    = 1.5                   # how far above the averaged statistics a frame can be before it is rejected
+MEAN_LIMIT_CAP  = micropython.const(83) # MAX_THRESH // 3, the threshold floor is mean * 3 and has to fit under MAX_THRESH
+STDEV_LIMIT_CAP = micropython.const(21) # 3 times this is still far below MAX_THRESH
+
+SUGGEST_NONE = micropython.const(0)
+SUGGEST_MORE = micropython.const(1)  # more gain or longer shutter
+SUGGEST_LESS = micropython.const(-1) # less gain or shorter shutter
+
+class ThresholdController(object):
+
+    def __init__(self, target_cnt = 30, history_len = HISTORY_LEN):
+        self.target_cnt = target_cnt
+        self.history_len = history_len
+        self.means = []
+        self.stdevs = []
+        self.counts = []
+        self.thresh = 0
+        self.suggestion = SUGGEST_NONE
+
+    def reset(self):
+        self.means = []
+        self.stdevs = []
+        self.counts = []
+        self.thresh = 0
+        self.suggestion = SUGGEST_NONE
+
+    def _push(self, lst, x):
+        lst.append(x)
+        if len(lst) > self.history_len:
+            lst.pop(0)
+
+    def _avg(self, lst):
+        if len(lst) <= 0:
+            return 0
+        return sum(lst) / len(lst)
+
+    def get_floor(self, stats):
+        # same rule as find_stars, but with the averaged background so a single bright frame does not raise it
+        mean = stats.mean()
+        if len(self.means) > 0:
+            mean = max(mean, self._avg(self.means))
+        return int(round(mean * 3))
+
+    def get_limits(self):
+        # the mean and stdev at which find_stars rejects a frame
+        # a background that rises slowly, like during twilight, takes the limits with it, a sudden jump in a single frame is still rejected
+        # rejected frames still go into the history, so a background that stays bright is accepted after a few frames
+        max_mean = star_finder.MAX_MEAN
+        max_stdev = star_finder.MAX_STDEV
+        if len(self.means) > 0:
+            max_mean = max(max_mean, self._avg(self.means) * LIMIT_GROWTH)
+            max_stdev = max(max_stdev, self._avg(self.stdevs) * LIMIT_GROWTH)
+        # the grown limits are capped, these caps are not the same thing as star_finder's defaults
+        return min(max_mean, MEAN_LIMIT_CAP), min(max_stdev, STDEV_LIMIT_CAP)
+
+    def get_thresh(self, stats, user_thresh = 0):
+        # threshold to use for the frame these statistics came from, never below what the user asked for
+        floor = max(self.get_floor(stats), user_thresh)
+        if self.thresh < floor:
+            self.thresh = floor
+        if self.thresh > MAX_THRESH:
+            self.thresh = MAX_THRESH
+        return self.thresh
+
+    def update(self, stats, star_cnt, code, user_thresh = 0):
+        # call after find_stars with the result of the frame, decides the threshold for the next one
+        self._push(self.means, stats.mean())
+        self._push(self.stdevs, stats.stdev())
+        too_many = code == star_finder.EXPO_TOO_MANY
+        if code == star_finder.EXPO_JUST_RIGHT and star_cnt > star_finder.TOO_MANY_STARS:
+            # the autoguider's find_stars never says EXPO_TOO_MANY, the frame is still used, but its count is just as close to running out of memory
+            too_many = True
+        if code == star_finder.EXPO_MEMORY_ERR or too_many:
+            # too many blobs, jump up instead of creeping, another failed frame costs more than a few lost faint stars
+            self.thresh += max(STEP_MIN, self.thresh // 4)
+            self.counts = []
+        elif code == star_finder.EXPO_JUST_RIGHT:
+            self._push(self.counts, star_cnt)
+            # there is a dead band around the target so the threshold does not hunt
+            # the farther off the count is, the bigger the step, the latest count is used so a passing cloud is followed quickly
+            if star_cnt > self.target_cnt * 3 // 2:
+                div = 4 if star_cnt > self.target_cnt * 3 else 8
+                self.thresh += max(STEP_MIN, self.thresh // div)
+            elif star_cnt < self.target_cnt // 2:
+                div = 4 if star_cnt < self.target_cnt // 4 else 8
+                self.thresh -= max(STEP_MIN, self.thresh // div)
+        floor = max(self.get_floor(stats), user_thresh)
+        if self.thresh < floor:
+            self.thresh = floor
+        if self.thresh > MAX_THRESH:
+            self.thresh = MAX_THRESH
+
+        # the threshold cannot go below the floor, so if there are still not enough stars the exposure has to change
+        mean = self._avg(self.means)
+        cnt = self._avg(self.counts)
+        if mean >= MEAN_WARNING or self.thresh >= MAX_THRESH:
+            self.suggestion = SUGGEST_LESS
+        elif len(self.counts) > 0 and cnt < self.target_cnt // 3 and self.thresh <= floor:
+            self.suggestion = SUGGEST_MORE
+        else:
+            self.suggestion = SUGGEST_NONE
+        return self.thresh
+
+def check_controller():
+    # runs made up frames through the controller, returns how many checks failed
+    class FakeStats(object):
+        def __init__(self, mean, stdev):
+            self.m = mean
+            self.s = stdev
+        def mean(self):
+            return self.m
+        def stdev(self):
+            return self.s
+
+    fails = 0
+    def check(cond, msg):
+        if cond:
+            return 0
+        print("threshold controller check failed: " + msg)
+        return 1
+
+    # the threshold starts at the floor, mean * 3, or what the user asked for if that is higher
+    tc = ThresholdController(target_cnt = 30)
+    stats = FakeStats(5, 2)
+    fails += check(tc.get_thresh(stats) == 15, "floor %u, expected 15" % tc.thresh)
+    fails += check(tc.get_thresh(stats, user_thresh = 40) == 40, "user threshold ignored")
+    # inside the dead band nothing changes
+    t = tc.update(stats, 30, star_finder.EXPO_JUST_RIGHT)
+    fails += check(tc.update(stats, 40, star_finder.EXPO_JUST_RIGHT) == t, "threshold moved inside the dead band")
+    # too many stars goes up, a count over TOO_MANY_STARS counts as too many even when the frame was used
+    fails += check(tc.update(stats, 100, star_finder.EXPO_JUST_RIGHT) > t, "threshold did not rise with too many stars")
+    t = tc.thresh
+    fails += check(tc.update(stats, 0, star_finder.EXPO_TOO_MANY) >= t + max(STEP_MIN, t // 4), "EXPO_TOO_MANY did not jump")
+    tc2 = ThresholdController(target_cnt = star_finder.TOO_MANY_STARS) # the count is inside its dead band
+    t = tc2.get_thresh(stats)
+    fails += check(tc2.update(stats, star_finder.TOO_MANY_STARS + 1, star_finder.EXPO_JUST_RIGHT) >= t + max(STEP_MIN, t // 4), "too many stars in a used frame did not jump")
+    # too few stars comes back down, but never below the floor, and then asks for more exposure
+    i = 0
+    while i < 50:
+        tc.update(stats, 2, star_finder.EXPO_JUST_RIGHT)
+        i += 1
+    fails += check(tc.thresh == 15, "threshold %u did not settle on the floor" % tc.thresh)
+    fails += check(tc.suggestion == SUGGEST_MORE, "no suggestion for more exposure")
+    # memory errors keep pushing up to MAX_THRESH, then it asks for less exposure
+    while i < 100:
+        tc.update(stats, 0, star_finder.EXPO_MEMORY_ERR)
+        i += 1
+    fails += check(tc.thresh == MAX_THRESH and tc.suggestion == SUGGEST_LESS, "threshold %u at the top, suggestion %d" % (tc.thresh, tc.suggestion))
+
+    # the rejection limits start at star_finder's, follow a slowly brightening sky and stop at their caps
+    tc = ThresholdController()
+    fails += check(tc.get_limits() == (star_finder.MAX_MEAN, star_finder.MAX_STDEV), "limits without history %s" % str(tc.get_limits()))
+    mean = 10
+    while mean < 200:
+        prev = tc.get_limits()
+        stats = FakeStats(mean, mean / 3)
+        tc.update(stats, 30, star_finder.EXPO_JUST_RIGHT)
+        lim = tc.get_limits()
+        fails += check(lim[0] >= prev[0] and lim[1] >= prev[1], "limits shrank while the sky got brighter")
+        fails += check(lim[0] <= MEAN_LIMIT_CAP and lim[1] <= STDEV_LIMIT_CAP, "limits %s over the caps" % str(lim))
+        mean += 5
+    fails += check(tc.get_limits() == (MEAN_LIMIT_CAP, STDEV_LIMIT_CAP), "limits %s did not reach the caps" % str(tc.get_limits()))
+    fails += check(MEAN_LIMIT_CAP * 3 <= MAX_THRESH, "MEAN_LIMIT_CAP allows a floor over MAX_THRESH")
+    # a single bright frame does not lift the limits enough to be accepted
+    tc = ThresholdController()
+    i = 0
+    while i < HISTORY_LEN:
+        tc.update(FakeStats(8, 3), 30, star_finder.EXPO_JUST_RIGHT)
+        i += 1
+    fails += check(tc.get_limits()[0] < 40, "limits %s let a sudden jump to 40 through" % str(tc.get_limits()))
+
+    print("threshold controller check, %u failed" % fails)
+    return fails
+
+if __name__ == "__main__":
+    check_controller()
@@ -1,15 +1,21 @@
 #!/usr/bin/env python
 
-import sys
+import os, sys, argparse
+import concurrent.futures
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
+import platesolver_hash
+import platesolver_db
 
 SENSOR_WIDTH  = 2592
 SENSOR_HEIGHT = 1944
 SENSOR_DIAGONAL = np.sqrt((SENSOR_WIDTH ** 2) + (SENSOR_HEIGHT ** 2))
 PIXELS_PER_DEGREE = 875.677409 / 2.9063 # calculated using "OV Cep"
 LIMIT_DEC = 90 - (SENSOR_DIAGONAL / PIXELS_PER_DEGREE)
-font = ImageFont.truetype(r"C:\Windows\Fonts\arial.ttf", 80)
+try:
+    font = ImageFont.truetype(r"C:\Windows\Fonts\arial.ttf", 80)
+except OSError:
+    font = ImageFont.load_default() # only used for drawing, don't stop the generator from running on other systems
 
 USE_GNOMONIC = False
 USE_SPHERICAL_ARC = True
@@ -19,6 +25,12 @@ USE_ONLY_AEP = False
 DRAW_AEP_IMAGE = False
 DRAW_STAR_CENTERED_IMAGE = False
 
+WRITE_HASH_INDEX = True # triangle hash index for platesolver_hash.py
+WRITE_BINARY_DB = True # same database in the format of platesolver_db.py, only with longmode = 0
+
+SHARDS_PER_JOB = 4 # more shards than workers keeps all of them busy until the end
+SHARD_FNAME = "generic_platesolver_database_output.part%03u.txt"
+
 DRAW_ME = ["* tet Dra", "* eta Dra", "* iot Dra", "* eps UMa", "* alf UMa"]
 #DRAW_ME.append("* alf UMi")
 
@@ -354,6 +366,67 @@ def draw_single_star(star, bucket, draw_lines = True):
 
     im.save(fname)
 
+class StarArrays(object):
+    # the whole catalog as numpy arrays, for computing the vectors from every star to a center star at once
+    def __init__(self, stars):
+        self.stars = stars
+        self.ra_deg = hours_to_degrees(np.array([s.ra_float for s in stars], dtype = np.float64))
+        self.dec = np.array([s.dec_float for s in stars], dtype = np.float64)
+        self.x = np.array([s.x for s in stars], dtype = np.float64)
+        self.y = np.array([s.y for s in stars], dtype = np.float64)
+        # sorted declinations allow a quick search for stars that could be close to the center star
+        self.dec_order = np.argsort(self.dec, kind = "stable")
+        self.dec_sorted = self.dec[self.dec_order]
+
+    def is_slow(self, center):
+        # projections other than the default are only done the slow way, one star at a time
+        return not (center.dec_float >= LIMIT_DEC or USE_ONLY_AEP) and (USE_GNOMONIC or not USE_SPHERICAL_ARC)
+
+    def near(self, center, maxdist):
+        # the arc distance is never smaller than the difference in declination
+        # so only a band of declination needs to be checked, indices are returned in catalog order
+        if self.is_slow(center):
+            return np.arange(len(self.stars)) # distances are not arc distances, check everything
+        r = maxdist / PIXELS_PER_DEGREE
+        lo = np.searchsorted(self.dec_sorted, center.dec_float - r, side = "left")
+        hi = np.searchsorted(self.dec_sorted, center.dec_float + r, side = "right")
+        return np.sort(self.dec_order[lo:hi])
+
+    def calc_visual_vectors(self, center, idx):
+        # same as calling calc_visual_vector(center) on each of the stars in idx, returns arrays of distances and angles
+        if self.is_slow(center):
+            res = [self.stars[j].calc_visual_vector(center) for j in idx.tolist()]
+            return np.array([r[0] for r in res], dtype = np.float64), np.array([r[1] for r in res], dtype = np.float64)
+
+        # great-circle distance, see calc_arc_dist
+        ra1 = np.radians(self.ra_deg[idx])
+        dec1 = np.radians(self.dec[idx])
+        ra2 = np.radians(hours_to_degrees(center.ra_float))
+        dec2 = np.radians(center.dec_float)
+        cosa = (np.sin(dec1) * np.sin(dec2)) + (np.cos(dec1) * np.cos(dec2) * np.cos(ra1 - ra2))
+        arcdist = np.degrees(np.arccos(np.clip(cosa, -1.0, 1.0)))
+
+        if center.dec_float >= LIMIT_DEC or USE_ONLY_AEP:
+            # see calc_aep_vector
+            dx = center.x - self.x[idx]
+            dy = center.y - self.y[idx]
+            return arcdist * PIXELS_PER_DEGREE, np.degrees(np.arctan2(dy, dx))
+
+        # see calc_arc_vector
+        arc_a = (np.pi / 2.0) - np.radians(self.dec[idx])
+        arc_b = (np.pi / 2.0) - np.radians(center.dec_float)
+        arc_c = np.radians(arcdist)
+        numerator = np.cos(arc_a) - (np.cos(arc_b) * np.cos(arc_c))
+        denominator = np.sin(arc_b) * np.sin(arc_c)
+        degenerate = denominator == 0.0
+        x = np.clip(numerator / np.where(degenerate, 1.0, denominator), -1.0, 1.0)
+        alpha = np.arccos(x)
+        delta_ra = angle_norm(hours_to_degrees(center.ra_float) - self.ra_deg[idx])
+        alpha = np.where(delta_ra < 0, -alpha, alpha)
+        dist = np.where(degenerate, 0.0, arcdist * PIXELS_PER_DEGREE)
+        ang = np.where(degenerate, 0.0, np.degrees(alpha))
+        return dist, ang
+
 def sort_rel_dist(x):
     return x.rel_dist
 
@@ -370,11 +443,11 @@ def sort_declination(x):
 #    GNOMONIC_CAL = should_be / dy
 #    print("gnomonic distance calibration %.16f" % GNOMONIC_CAL)
 
-def main():
+def parse_stars(fname):
     stars = []
-    print("parsing SIMBAD file")
-    f = open("extrastars_around_polaris.txt", "r")
+    f = open(fname, "r")
     lines = f.readlines()
+    f.close()
     started = False
     for line in lines:
         split = line.split('|')
@@ -388,7 +461,119 @@ def main():
         if started and split0.isnumeric():
             star = Star(split[1], split[3], float(split[5]))
             stars.append(star)
+    return stars
+
+def make_entry(star_arr, i, maxdist, longmode, last_name):
+    # generates the database entry for one reference star, returns None if it doesn't have enough neighbours
+    # also returns the hash index group and the rounded (dist, ang) records for the same star
+    stars = star_arr.stars
+    # only stars in a band of declination can be close enough, compute their vectors all at once
+    idx = star_arr.near(i, maxdist)
+    dist, ang = star_arr.calc_visual_vectors(i, idx)
+    inside = (dist > 0) & (dist < maxdist) # and j.bmag <= 7:
+    idx = idx[inside]
+    dist = dist[inside]
+    ang = ang[inside]
+    order = np.argsort(dist, kind = "stable") # stable, so ties stay in catalog order just like sorted() does
+    if len(order) < 4: # need a minimum number of matches
+        return None, None, None
+    bucket = []
+    for j in order.tolist():
+        s = stars[idx[j]]
+        s.rel_dist = float(dist[j])
+        s.rel_ang = float(ang[j])
+        bucket.append(s)
+    if i.name in DRAW_ME and DRAW_STAR_CENTERED_IMAGE:
+        draw_single_star(i, bucket)
+    group = None
+    if WRITE_HASH_INDEX:
+        group = platesolver_hash.make_group(i.name, [(j.name, j.rel_dist, j.rel_ang, j.bmag) for j in bucket])
+    bucket_str = ""
+    pre_val = None
+    recs = []
+    for j in bucket:
+        if len(bucket_str) > 0 and bucket_str.endswith(",") == False:
+            bucket_str += ","
+        if longmode >= 1:
+            bucket_str += "{"
+            if longmode >= 2:
+                bucket_str += "\"name\":\"%s\"," % j.name
+            bucket_str += "\"d\":%0.1f,\"a\":%0.1f}" % (j.rel_dist, j.rel_ang)
+        else:
+            val = (int(round(j.rel_dist)), int(round(j.rel_ang)))
+            if val != pre_val:
+                bucket_str += "%u,%d" % val
+                recs.append(val)
+                pre_val = val
+    if longmode >= 1:
+        str = "\"%s\":{" % i.name
+    else:
+        str = "%s:%s" % (i.name, bucket_str)
+    if longmode >= 2:
+        str += "\"ra\": %0.8f, \"dec\": %0.8f, " % (i.ra_float, i.dec_float)
+    if longmode >= 1:
+        str += "\"near\":[%s]" % bucket_str
+    if longmode >= 2:
+        str += ", \"ncnt\": %u" % len(bucket)
+    if longmode >= 1:
+        str += "}"
+    if i.name != last_name:
+        if longmode >= 1:
+            str += ","
+        else:
+            str += ";"
+    if longmode >= 2:
+        str += "\n"
+    return str, group, recs
+
+# every worker process gets its own copy of the catalog, set once by shard_init
+shard_ctx = None
+
+def shard_init(stars, maxdist, longmode, last_name):
+    global shard_ctx
+    shard_ctx = (StarArrays(stars), maxdist, longmode, last_name)
+
+def make_shard(shard_num, ref_idx):
+    # processes one contiguous slice of the reference stars and writes it to its own partial file
+    # the hash index groups and binary records are returned in the same order as the entries
+    star_arr, maxdist, longmode, last_name = shard_ctx
+    fname = SHARD_FNAME % shard_num
+    groups = []
+    entries = []
+    file = open(fname, "w")
+    for k in ref_idx:
+        i = star_arr.stars[k]
+        str, group, recs = make_entry(star_arr, i, maxdist, longmode, last_name)
+        if str is None:
+            continue
+        file.write(str)
+        if group is not None:
+            groups.append(group)
+        entries.append((i.name, recs))
+    file.close()
+    return shard_num, fname, groups, entries
+
+def make_shards(ref_idx, shard_cnt):
+    # contiguous slices, so that joining the partial files in order gives the same file as a serial run
+    res = []
+    n = len(ref_idx)
+    k = 0
+    while k < shard_cnt:
+        a = (n * k) // shard_cnt
+        b = (n * (k + 1)) // shard_cnt
+        if b > a:
+            res.append(ref_idx[a:b])
+        k += 1
+    return res
 
+def main():
+    parser = argparse.ArgumentParser(description = "generates the plate solver database from a SIMBAD query result")
+    parser.add_argument("-j", "--jobs", type = int, default = 0, help = "number of worker processes, 0 for one per CPU, 1 to run without a process pool")
+    parser.add_argument("-i", "--input", default = "extrastars_around_polaris.txt", help = "SIMBAD query result")
+    args = parser.parse_args()
+
+    print("parsing SIMBAD file")
+    stars = parse_stars(args.input)
     print("finished parsing file")
 
     if DRAW_AEP_IMAGE:
@@ -396,7 +581,8 @@ def main():
         draw_stars(stars)
         print("finished drawing stars")
 
-    dec_sorted = sorted(stars, key = sort_declination, reverse = True) # database must be in order of distance from NCP
+    dec_sorted = sorted(range(len(stars)), key = lambda k: sort_declination(stars[k]), reverse = True) # database must be in order of distance from NCP
+    last_name = stars[dec_sorted[-1]].name
 
     maxdist = SENSOR_DIAGONAL * 0.7 # only include stars within this distance
 
@@ -404,66 +590,51 @@ def main():
     # use 1 for minimal JSON object
     # use 2 for maximum JSON object
 
-    print("writing to file")
+    ref_idx = [k for k in dec_sorted if stars[k].bmag <= 6]
+    jobs = args.jobs
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    shards = make_shards(ref_idx, jobs * SHARDS_PER_JOB if jobs > 1 else 1)
+
+    print("writing to file, %u reference stars, %u shards, %u jobs" % (len(ref_idx), len(shards), jobs))
+    results = []
+    if jobs <= 1:
+        shard_init(stars, maxdist, longmode, last_name)
+        for k in range(len(shards)):
+            results.append(make_shard(k, shards[k]))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = jobs, initializer = shard_init, initargs = (stars, maxdist, longmode, last_name)) as executor:
+            futures = [executor.submit(make_shard, k, shards[k]) for k in range(len(shards))]
+            results = [f.result() for f in futures]
+
+    # merge in shard order, not in the order that the workers finished
+    results.sort(key = lambda r: r[0])
     fsz = 0
-    file = open("generic_platesolver_database_output.txt", "w") 
-    for i in dec_sorted:
-        if i.bmag > 6:
-            continue
-        for j in dec_sorted:
-            dist, ang = j.calc_visual_vector(i)
-            j.rel_dist = dist
-            j.rel_ang = ang
-        dist_sorted = sorted(stars, key = sort_rel_dist, reverse = False)
-        bucket = []
-        for j in dist_sorted:
-            if j.rel_dist > 0 and j.rel_dist < maxdist: # and j.bmag <= 7:
-                bucket.append(j)
-        if len(bucket) < 4: # need a minimum number of matches
-            continue
-        if i.name in DRAW_ME and DRAW_STAR_CENTERED_IMAGE:
-            draw_single_star(i, bucket)
-        bucket_str = ""
-        pre_val = ""
-        for j in bucket:
-            if len(bucket_str) > 0 and bucket_str.endswith(",") == False:
-                bucket_str += ","
-            if longmode >= 1:
-                bucket_str += "{"
-                if longmode >= 2:
-                    bucket_str += "\"name\":\"%s\"," % j.name
-                bucket_str += "\"d\":%0.1f,\"a\":%0.1f}" % (j.rel_dist, j.rel_ang)
-            else:
-                val_str = "%u,%d" % (int(round(j.rel_dist)), int(round(j.rel_ang)))
-                if val_str != pre_val:
-                    bucket_str += val_str
-                    pre_val = val_str
-        if longmode >= 1:
-            str = "\"%s\":{" % i.name
-        else:
-            str = "%s:%s" % (i.name, bucket_str)
-        if longmode >= 2:
-            str += "\"ra\": %0.8f, \"dec\": %0.8f, " % (i.ra_float, i.dec_float)
-        if longmode >= 1:
-            str += "\"near\":[%s]" % bucket_str
-        if longmode >= 2:
-            str += ", \"ncnt\": %u" % len(bucket)
-        if longmode >= 1:
-            str += "}"
-        if i.name != dec_sorted[-1].name:
-            if longmode >= 1:
-                str += ","
-            else:
-                str += ";"
-        file.write(str)
-        fsz += len(str)
-        if longmode >= 2:
-            file.write("\n")
-            fsz += 2
-        file.flush()
+    groups = []
+    entries = []
+    file = open("generic_platesolver_database_output.txt", "w")
+    for shard_num, fname, shard_groups, shard_entries in results:
+        f = open(fname, "r")
+        part = f.read()
+        f.close()
+        os.remove(fname)
+        file.write(part)
+        fsz += len(part)
+        groups.extend(shard_groups)
+        entries.extend(shard_entries)
     file.close()
     print("finished writing %u bytes to file" % fsz)
 
+    if WRITE_BINARY_DB and longmode == 0:
+        print("writing binary database")
+        fsz = platesolver_db.write_db("generic_platesolver_database_output.bin", entries, PIXELS_PER_DEGREE, SENSOR_WIDTH, SENSOR_HEIGHT)
+        print("finished writing %u bytes to file" % fsz)
+
+    if WRITE_HASH_INDEX:
+        print("writing hash index")
+        fsz, cnt = platesolver_hash.write_index("generic_platesolver_hash_output.txt", groups)
+        print("finished writing %u triangles, %u bytes to file" % (cnt, fsz))
+
     return 0
 
 if __name__ == "__main__":
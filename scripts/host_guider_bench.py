@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+# replays frames recorded by the autoguider's "record" command (snap-*.jpg, with the .txt metadata next to them) through the unmodified AutoGuider.decide
+# the camera, the guide pulser and the network are stand-ins, so this measures the analysis and the pulse computation, nothing else
+# reports per-stage latency percentiles and the guiding RMS, and can save the decisions to compare against after changing the hot path
+# usage: python host_guider_bench.py [--ms-per-pix N] [--save decisions.json] [--compare decisions.json] [--max-p90 MS] directories_or_files...
+
+import os, sys, glob, time, json, argparse, contextlib, io, math
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "openmv_host"))
+import hostenv
+hostenv.setup()
+
+import image
+import guidepulser
+import guidestar
+import star_finder
+import guider_calibration
+import frame_registration
+import autoguider
+
+STAGES = ["histogram", "find_stars", "process_list", "refine", "multi_star_motion", "registration", "filter", "pulse", "decide"]
+
+class StageTimer(object):
+    # wraps a function so that every call to it adds its duration to one of the stages
+    # the stages nest, "pulse" includes "filter" and "decide" includes everything
+    def __init__(self):
+        self.times = {}
+        self.cur = {}
+        for s in STAGES:
+            self.times[s] = []
+            self.cur[s] = 0
+
+    def wrap(self, stage, func):
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.cur[stage] += time.perf_counter() - t
+        return wrapper
+
+    def new_frame(self):
+        for s in STAGES:
+            self.cur[s] = 0
+
+    def end_frame(self):
+        for s in STAGES:
+            self.times[s].append(self.cur[s])
+
+class BenchCam(object):
+    # only what default_settings() reads, same values as AutoGuider.__init__ gives the real camera
+    # the guider is made with the real constructor, offline so that it does not read the settings files or start the WiFi
+    def __init__(self):
+        self.gain = 48
+        self.shutter = 1000000
+
+def make_calibration(ang, ms_per_pix, fpath = None):
+    cal = guider_calibration.GuiderCalibration(0, 0, 0)
+    if fpath is not None and os.path.isfile(fpath):
+        with open(fpath, "r") as f:
+            cal.load_json_obj(json.load(f))
+        return cal
+    cal.angle = ang
+    cal.ms_per_pix = ms_per_pix
+    cal.pix_per_ms = 1.0 / ms_per_pix
+    cal.has_cal = True
+    cal.success = "done"
+    return cal
+
+def list_frames(paths):
+    res = []
+    for p in paths:
+        if os.path.isdir(p):
+            for ext in ["snap-*.jpg", "snap-*.bmp", "snap-*.png"]:
+                res.extend(glob.glob(os.path.join(p, ext)))
+        else:
+            res.extend(glob.glob(p))
+    return sorted(set(res))
+
+def parse_meta(fpath):
+    # reads the .txt written by AutoGuider.save_image_meta, returns None if there is none
+    fpath = fpath + ".txt"
+    if os.path.isfile(fpath) == False:
+        return None
+    meta = {"mean": None, "stars": [], "res": None, "cnt": None, "multistar_cnt": None, "sel": None, "res_coord": None}
+    with open(fpath, "r") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line.startswith("\t"):
+                s = line.strip().rstrip(";").split(",")
+                if len(s) >= 5:
+                    meta["stars"].append([float(s[0]), float(s[1]), int(s[2]), int(s[3]), int(s[4])])
+            elif line.startswith("img mean:"):
+                meta["mean"] = int(line.split(":")[1])
+            elif line.startswith("res:"):
+                for kv in line.split(","):
+                    kv = kv.split(":")
+                    if len(kv) == 2:
+                        meta[kv[0].strip()] = int(kv[1])
+            elif line.startswith("sel [") or line.startswith("res ["):
+                s = line[line.index("[") + 1:line.index("]")].split(",")
+                meta["sel" if line.startswith("sel") else "res_coord"] = [float(s[0]), float(s[1])]
+    return meta
+
+def percentiles(x):
+    if len(x) <= 0:
+        return [0, 0, 0, 0]
+    a = np.array(x) * 1000.0
+    return [np.percentile(a, 50), np.percentile(a, 90), np.percentile(a, 99), a.max()]
+
+def run(frames, args):
+    timer = StageTimer()
+    image.Image.get_histogram               = timer.wrap("histogram", image.Image.get_histogram)
+    star_finder.find_stars                  = timer.wrap("find_stars", star_finder.find_stars)
+    guidestar.process_list                  = timer.wrap("process_list", guidestar.process_list)
+    star_finder.refine_stars                = timer.wrap("refine", star_finder.refine_stars)
+    guidestar.get_multi_star_motion         = timer.wrap("multi_star_motion", guidestar.get_multi_star_motion)
+    frame_registration.register             = timer.wrap("registration", frame_registration.register)
+    autoguider.AutoGuider.get_pulse_to_target = timer.wrap("filter", autoguider.AutoGuider.get_pulse_to_target)
+    autoguider.AutoGuider.pulse_to_target   = timer.wrap("pulse", autoguider.AutoGuider.pulse_to_target)
+
+    g = autoguider.AutoGuider(debug = args.verbose, cam = BenchCam(), offline = True)
+    g.settings.update({"roi_mode" : args.roi})
+    g.settings.update({"registration" : args.registration})
+    g.settings.update({"centroid_refine" : args.refine})
+    g.settings.update({"auto_thresh" : args.auto_thresh})
+    if args.thresh is not None:
+        g.settings.update({"guidecam_thresh" : args.thresh})
+    g.apply_settings()
+    g.calibration[autoguider.CALIIDX_RA]  = make_calibration(args.angle, args.ms_per_pix, fpath = args.calib_ra)
+    g.calibration[autoguider.CALIIDX_DEC] = make_calibration(args.angle + 90, args.ms_per_pix, fpath = args.calib_dec)
+
+    decisions = []
+    err_ra = []
+    err_dec = []
+    panics = 0
+    rec_match = 0
+    rec_cnt = 0
+    for f in frames:
+        img = image.Image(f)
+        img.set_timestamp(int(round(time.perf_counter() * 1000.0)))
+        meta = parse_meta(f)
+        g.img = img
+        mcnt = len(guidepulser.moves)
+        out = io.StringIO()
+        timer.new_frame()
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else out):
+            t = time.perf_counter()
+            pulse = g.decide()
+            timer.cur["decide"] = time.perf_counter() - t
+            if g.guide_state == autoguider.GUIDESTATE_PANIC:
+                # start over, the next frame selects a star again
+                panics += 1
+                guidepulser.panic(False)
+                g.guide_state = autoguider.GUIDESTATE_IDLE
+                g.target_coord = None
+                g.origin_coord = None
+            elif g.guide_state == autoguider.GUIDESTATE_IDLE and g.selected_star is not None:
+                # first frame or recovering from a panic, start guiding on the recorded selection if there is one
+                if meta is not None and meta["sel"] is not None:
+                    g.user_select_star(meta["sel"][0], meta["sel"][1])
+                g.guide_state = autoguider.GUIDESTATE_GUIDING
+        timer.end_frame()
+
+        move = guidepulser.moves[-1] if len(guidepulser.moves) > mcnt else None
+        d = {"frame": os.path.basename(f), "code": g.expo_code, "stars": len(g.stars) if g.stars is not None else 0, "pulse": pulse,
+             "move": [move[1], move[2]] if move is not None else None,
+             "star": [g.selected_star.cxf(), g.selected_star.cyf()] if g.selected_star is not None else None,
+             "move_err": g.last_move_err, "multistar_cnt": list(g.multistar_cnt)}
+        decisions.append(d)
+
+        if g.selected_star is not None and g.target_coord is not None and g.virtual_star is not None and pulse >= 0:
+            # error split into the calibrated axes, in pixels
+            dx = g.virtual_star[0] - g.target_coord[0]
+            dy = g.virtual_star[1] - g.target_coord[1]
+            ra_ang = math.radians(g.calibration[autoguider.CALIIDX_RA].angle)
+            dec_ang = math.radians(g.calibration[autoguider.CALIIDX_DEC].angle)
+            err_ra.append((dx * math.cos(ra_ang)) + (dy * math.sin(ra_ang)))
+            err_dec.append((dx * math.cos(dec_ang)) + (dy * math.sin(dec_ang)))
+
+        if meta is not None and meta["res_coord"] is not None:
+            rec_cnt += 1
+            if d["star"] is not None and abs(d["star"][0] - meta["res_coord"][0]) <= 0.5 and abs(d["star"][1] - meta["res_coord"][1]) <= 0.5:
+                rec_match += 1
+
+        if args.verbose == False and args.quiet == False:
+            line = "%s: code %u, stars %u, decide %.1f ms" % (d["frame"], d["code"], d["stars"], timer.cur["decide"] * 1000.0)
+            if d["star"] is not None:
+                line += ", star (%.1f , %.1f), err %u, cnt %u/%u" % (d["star"][0], d["star"][1], d["move_err"], d["multistar_cnt"][0], d["multistar_cnt"][1])
+            if move is not None:
+                line += ", move %d %d" % (move[1], move[2])
+            print(line)
+
+    return timer, decisions, err_ra, err_dec, panics, rec_match, rec_cnt
+
+def compare(decisions, fpath, tol):
+    with open(fpath, "r") as f:
+        ref = json.load(f)
+    bad = 0
+    if len(ref) != len(decisions):
+        print("decision count differs, %u vs %u in %s" % (len(decisions), len(ref), fpath))
+        return 1 + abs(len(ref) - len(decisions))
+    for a, b in zip(decisions, ref):
+        same = a["frame"] == b["frame"] and a["code"] == b["code"] and a["stars"] == b["stars"] and a["multistar_cnt"] == b["multistar_cnt"]
+        if (a["star"] is None) != (b["star"] is None) or (a["move"] is None) != (b["move"] is None):
+            same = False
+        if same and a["star"] is not None:
+            same = abs(a["star"][0] - b["star"][0]) <= tol and abs(a["star"][1] - b["star"][1]) <= tol
+        if same and a["move"] is not None:
+            # pulse widths are in milliseconds, allow what the position tolerance could account for
+            same = abs(a["move"][0] - b["move"][0]) <= 1 + tol * 100 and abs(a["move"][1] - b["move"][1]) <= 1 + tol * 100
+        if same == False:
+            bad += 1
+            print("mismatch %s: %s vs %s" % (a["frame"], json.dumps(a), json.dumps(b)))
+    return bad
+
+def main():
+    parser = argparse.ArgumentParser(description = "replay recorded frames through AutoGuider.decide and measure it")
+    parser.add_argument("paths", nargs = "+", help = "snap directories, image files or globs")
+    parser.add_argument("-t", "--thresh", type = int, default = None, help = "star detection threshold, same as the guidecam_thresh setting")
+    parser.add_argument("--ms-per-pix", type = float, default = 100.0, help = "synthetic calibration, pulse milliseconds per pixel")
+    parser.add_argument("--angle", type = float, default = 0.0, help = "synthetic calibration, RA axis angle in degrees, DEC is 90 degrees from it")
+    parser.add_argument("--calib-ra", help = "calib_ra.json saved by the camera, replaces the synthetic RA calibration")
+    parser.add_argument("--calib-dec", help = "calib_dec.json saved by the camera, replaces the synthetic DEC calibration")
+    parser.add_argument("--no-roi", dest = "roi", action = "store_false", help = "always search the whole frame")
+    parser.add_argument("--no-registration", dest = "registration", action = "store_false", help = "use the multi-star average instead of fitting the whole field")
+    parser.add_argument("--refine", dest = "refine", action = "store_true", help = "refine the centroids of the guiding stars, the centroid_refine setting is off by default")
+    parser.add_argument("--no-refine", dest = "refine", action = "store_false", help = "use the blob centroids as they are, this is the default")
+    parser.add_argument("--no-auto-thresh", dest = "auto_thresh", action = "store_false", help = "use the fixed threshold instead of the threshold controller")
+    parser.add_argument("-n", "--repeat", type = int, default = 1, help = "replay the frames this many times, for steadier timing")
+    parser.add_argument("--save", help = "write the decisions to this JSON file")
+    parser.add_argument("--compare", help = "compare the decisions to a file written by --save, exits with an error if they differ")
+    parser.add_argument("--tol", type = float, default = 0.05, help = "star position tolerance in pixels for --compare")
+    parser.add_argument("--max-p90", type = float, default = None, help = "exits with an error if the 90th percentile of decide() is slower than this many milliseconds")
+    parser.add_argument("-q", "--quiet", action = "store_true", help = "only print the summary")
+    parser.add_argument("-v", "--verbose", action = "store_true", help = "show the autoguider's own debug output")
+    args = parser.parse_args()
+
+    frames = list_frames(args.paths)
+    if len(frames) <= 0:
+        print("no frames found")
+        return 1
+    frames = frames * max(1, args.repeat)
+
+    t_start = time.perf_counter()
+    timer, decisions, err_ra, err_dec, panics, rec_match, rec_cnt = run(frames, args)
+    t_total = time.perf_counter() - t_start
+
+    cnt = len(frames)
+    print("")
+    print("frames: %u, total %.1f s, %u guide pulses, %u panics" % (cnt, t_total, len(guidepulser.moves), panics))
+    print("%-18s %8s %8s %8s %8s  (ms)" % ("stage", "p50", "p90", "p99", "max"))
+    for s in STAGES:
+        p = percentiles(timer.times[s])
+        print("%-18s %8.2f %8.2f %8.2f %8.2f" % (s, p[0], p[1], p[2], p[3]))
+    if len(err_ra) > 0:
+        ra = np.array(err_ra)
+        dec = np.array(err_dec)
+        print("guiding RMS: %.3f px (RA %.3f px, DEC %.3f px) over %u frames" % (math.sqrt(np.mean((ra * ra) + (dec * dec))), math.sqrt(np.mean(ra * ra)), math.sqrt(np.mean(dec * dec)), len(ra)))
+    if rec_cnt > 0:
+        print("selected star agrees with the recording: %u / %u" % (rec_match, rec_cnt))
+
+    ret = 0
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(decisions, f, indent = 1)
+        print("saved %u decisions to %s" % (len(decisions), args.save))
+    if args.compare is not None:
+        bad = compare(decisions, args.compare, args.tol)
+        if bad > 0:
+            print("FAILED: %u decisions differ from %s" % (bad, args.compare))
+            ret = 1
+        else:
+            print("decisions match %s" % args.compare)
+    if args.max_p90 is not None:
+        p90 = percentiles(timer.times["decide"])[1]
+        if p90 > args.max_p90:
+            print("FAILED: decide p90 %.2f ms is above the limit of %.2f ms" % (p90, args.max_p90))
+            ret = 1
+    return ret
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# replays recorded frames through the unmodified star_finder and pole_finder code on a PC
+# usage: python host_star_finder.py [-t THRESH] [--guider] [--force] [--track] files_or_directories...
+
+import os, sys, glob, time, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "openmv_host"))
+import hostenv
+hostenv.setup()
+
+import image
+import star_finder
+import pole_finder
+
+EXPO_NAMES = {
+    star_finder.EXPO_NO_IMG     : "NO_IMG",
+    star_finder.EXPO_TOO_LOW    : "TOO_LOW",
+    star_finder.EXPO_JUST_RIGHT : "JUST_RIGHT",
+    star_finder.EXPO_TOO_HIGH   : "TOO_HIGH",
+    star_finder.EXPO_TOO_NOISY  : "TOO_NOISY",
+    star_finder.EXPO_MOVEMENT   : "MOVEMENT",
+    star_finder.EXPO_TOO_BIG    : "TOO_BIG",
+    star_finder.EXPO_TOO_MANY   : "TOO_MANY",
+    star_finder.EXPO_MEMORY_ERR : "MEMORY_ERR",
+    star_finder.EXPO_CAMERA_ERR : "CAMERA_ERR",
+    star_finder.EXPO_NOT_READY  : "NOT_READY",
+}
+
+def list_frames(paths):
+    res = []
+    for p in paths:
+        if os.path.isdir(p):
+            for ext in ["*.jpg", "*.jpeg", "*.bmp", "*.png"]:
+                res.extend(glob.glob(os.path.join(p, ext)))
+        else:
+            res.extend(glob.glob(p))
+    return sorted(set(res))
+
+def process_frame(fpath, thresh = 0, force_solve = False, guider = False, search_limit = pole_finder.SEARCH_LIMIT, prev_sol = None):
+    img = image.Image(fpath)
+    t0 = time.perf_counter()
+    hist = img.get_histogram()
+    stats = hist.get_statistics()
+    stars, code = star_finder.find_stars(img, hist = hist, stats = stats, thresh = thresh, force_solve = force_solve, guider = guider)
+    t1 = time.perf_counter()
+    res = {"file": fpath, "code": code, "stars": len(stars), "mean": stats.mean(), "stdev": stats.stdev(), "t_find": t1 - t0, "t_solve": 0, "solution": None, "tracked": False}
+    if guider or code != star_finder.EXPO_JUST_RIGHT:
+        return res
+    solution = pole_finder.PoleSolution(stars, search_limit = search_limit)
+    if prev_sol is not None and solution.track(prev_sol):
+        res["solution"] = solution
+        res["tracked"] = True
+    elif solution.solve():
+        res["solution"] = solution
+    res["t_solve"] = time.perf_counter() - t1
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description = "replay recorded frames through star_finder and pole_finder")
+    parser.add_argument("paths", nargs = "+", help = "image files, globs or directories")
+    parser.add_argument("-t", "--thresh", type = int, default = 0, help = "star detection threshold, same as the polarscope setting")
+    parser.add_argument("-s", "--search-limit", type = int, default = pole_finder.SEARCH_LIMIT, help = "how many of the brightest stars are tried as Polaris")
+    parser.add_argument("--force", action = "store_true", help = "skip the image quality checks (force_solve)")
+    parser.add_argument("--guider", action = "store_true", help = "use the autoguider detection path (guidestarmode)")
+    parser.add_argument("--track", action = "store_true", help = "treat the frames as a sequence and track the previous solution")
+    args = parser.parse_args()
+
+    frames = list_frames(args.paths)
+    if len(frames) <= 0:
+        print("no frames found")
+        return 1
+
+    codes = {}
+    solved = 0
+    tracked = 0
+    prev_sol = None
+    t_find = 0
+    t_solve = 0
+    t_start = time.perf_counter()
+    for f in frames:
+        r = process_frame(f, thresh = args.thresh, force_solve = args.force, guider = args.guider, search_limit = args.search_limit, prev_sol = prev_sol)
+        if args.track:
+            prev_sol = r["solution"]
+        codes[r["code"]] = codes.get(r["code"], 0) + 1
+        t_find += r["t_find"]
+        t_solve += r["t_solve"]
+        line = "%s: %s, stars %u, mean %u, stdev %u, find %.1f ms" % (os.path.basename(f), EXPO_NAMES.get(r["code"], str(r["code"])), r["stars"], r["mean"], r["stdev"], r["t_find"] * 1000.0)
+        if r["solution"] is not None:
+            solved += 1
+            x, y, rot = r["solution"].get_pole_coords()
+            line += ", solve %.1f ms, pole (%.1f , %.1f) rot %.1f, matched %u, penalty %u" % (r["t_solve"] * 1000.0, x, y, rot, len(r["solution"].stars_matched), r["solution"].penalty)
+            if r["tracked"]:
+                tracked += 1
+                line += ", tracked"
+        elif args.guider == False and r["code"] == star_finder.EXPO_JUST_RIGHT:
+            line += ", no solution"
+        print(line)
+    t_total = time.perf_counter() - t_start
+
+    cnt = len(frames)
+    print("")
+    print("frames: %u, total %.1f s, %.1f frames per minute" % (cnt, t_total, cnt * 60.0 / t_total))
+    print("avg find: %.1f ms, avg solve: %.1f ms" % (t_find * 1000.0 / cnt, t_solve * 1000.0 / cnt))
+    for c in sorted(codes.keys()):
+        print("%s: %u" % (EXPO_NAMES.get(c, str(c)), codes[c]))
+    if args.guider == False:
+        print("solved: %u / %u (%.1f%%)" % (solved, cnt, solved * 100.0 / cnt))
+    if args.track:
+        print("tracked: %u / %u" % (tracked, solved))
+    return 0
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# binary version of the plate solver database, the same content as the "name:d,a,d,a;" text output of the generator
+# a reader only needs the header and the star table in memory, the records of one star are read with a single seek
+# this reader needs NumPy, openmv_mpy/star_db.py reads the same file on the camera
+# usage: python platesolver_db.py generic_platesolver_database_output.bin [star name] [--text out.txt]
+#
+# layout, everything is little endian
+#   header:   "PSDB", u16 version, u16 record size, u32 star count, u32 record count,
+#             f32 pixels per degree, u16 sensor width, u16 sensor height,
+#             u32 offset of star table, u32 offset of string table, u32 offset of records, u32 string table size
+#   star table, one per reference star, in the same order as the text database:
+#             u32 name offset into string table, u32 index of first record, u16 record count, u8 name length, u8 unused
+#   string table: names back to back, UTF-8, not terminated
+#   records:  s16 distance in pixels, s16 angle in degrees
+
+import mmap, struct, argparse
+import numpy as np
+
+DB_MAGIC     = b"PSDB"
+DB_VERSION   = 1
+HEADER_FMT   = "<4sHHIIfHHIIII"
+HEADER_SIZE  = struct.calcsize(HEADER_FMT)
+STAR_FMT     = "<IIHBx"
+STAR_SIZE    = struct.calcsize(STAR_FMT)
+RECORD_DTYPE = np.dtype([("d", "<i2"), ("a", "<i2")])
+RECORD_SIZE  = RECORD_DTYPE.itemsize
+
+def write_db(fname, entries, pixels_per_degree, sensor_width, sensor_height):
+    # entries is a list of (name, records) where records is a list of (dist, ang) already rounded to integers
+    names = b""
+    star_tbl = b""
+    rec_cnt = 0
+    for name, recs in entries:
+        nb = name.encode("utf-8")
+        if len(nb) > 255 or len(recs) > 65535:
+            raise ValueError("star %s does not fit in the database format" % name)
+        star_tbl += struct.pack(STAR_FMT, len(names), rec_cnt, len(recs), len(nb))
+        names += nb
+        rec_cnt += len(recs)
+    records = np.zeros(rec_cnt, dtype = RECORD_DTYPE)
+    i = 0
+    for name, recs in entries:
+        for d, a in recs:
+            if d < -32768 or d > 32767:
+                raise ValueError("distance %d of star %s does not fit in 16 bits" % (d, name))
+            records[i] = (d, a)
+            i += 1
+    star_ofst = HEADER_SIZE
+    names_ofst = star_ofst + len(star_tbl)
+    rec_ofst = names_ofst + len(names)
+    rec_ofst += (-rec_ofst) % 4 # keep the records aligned
+    header = struct.pack(HEADER_FMT, DB_MAGIC, DB_VERSION, RECORD_SIZE, len(entries), rec_cnt, pixels_per_degree, sensor_width, sensor_height, star_ofst, names_ofst, rec_ofst, len(names))
+    with open(fname, "wb") as f:
+        f.write(header)
+        f.write(star_tbl)
+        f.write(names)
+        f.write(b"\0" * (rec_ofst - names_ofst - len(names)))
+        f.write(records.tobytes())
+        fsz = f.tell()
+    return fsz
+
+class PlateSolverDb(object):
+    def __init__(self, fname, use_mmap = False):
+        self.f = open(fname, "rb")
+        self.mm = None
+        hdr = struct.unpack(HEADER_FMT, self.f.read(HEADER_SIZE))
+        if hdr[0] != DB_MAGIC:
+            raise ValueError("%s is not a plate solver database" % fname)
+        if hdr[1] != DB_VERSION or hdr[2] != RECORD_SIZE:
+            raise ValueError("unsupported database version %u" % hdr[1])
+        self.star_cnt = hdr[3]
+        self.rec_cnt = hdr[4]
+        self.pixels_per_degree = hdr[5]
+        self.sensor_width = hdr[6]
+        self.sensor_height = hdr[7]
+        self.rec_ofst = hdr[10]
+        self.f.seek(hdr[8])
+        self.star_tbl = np.frombuffer(self.f.read(STAR_SIZE * self.star_cnt), dtype = np.dtype([("name", "<u4"), ("rec", "<u4"), ("cnt", "<u2"), ("nlen", "u1"), ("pad", "u1")]))
+        self.f.seek(hdr[9])
+        strtbl = self.f.read(hdr[11])
+        self.names = [strtbl[s["name"]:s["name"] + s["nlen"]].decode("utf-8") for s in self.star_tbl]
+        self.name_idx = {}
+        for i in range(len(self.names)):
+            self.name_idx[self.names[i]] = i
+        if use_mmap:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.f.close()
+
+    def __len__(self):
+        return self.star_cnt
+
+    def find(self, name):
+        # index of a reference star, or -1 if it is not in the database
+        return self.name_idx.get(name, -1)
+
+    def get_records(self, i):
+        # records of the i-th reference star as an array with fields "d" and "a"
+        cnt = int(self.star_tbl[i]["cnt"])
+        ofst = self.rec_ofst + (int(self.star_tbl[i]["rec"]) * RECORD_SIZE)
+        if self.mm is not None:
+            return np.frombuffer(self.mm, dtype = RECORD_DTYPE, count = cnt, offset = ofst)
+        self.f.seek(ofst)
+        return np.frombuffer(self.f.read(cnt * RECORD_SIZE), dtype = RECORD_DTYPE)
+
+    def get_bucket(self, name):
+        i = self.find(name)
+        if i < 0:
+            return None
+        return self.get_records(i)
+
+    def to_text(self):
+        # re-creates the text database, useful for checking that nothing was lost
+        # the generator sometimes leaves a stray "," or ";" at the end of an entry, those are not kept
+        res = []
+        for i in range(self.star_cnt):
+            recs = self.get_records(i)
+            res.append("%s:%s" % (self.names[i], ",".join(["%u,%d" % (d, a) for d, a in recs.tolist()])))
+        return ";".join(res)
+
+def main():
+    parser = argparse.ArgumentParser(description = "inspect a binary plate solver database")
+    parser.add_argument("db", help = "file written by generic_platesolver_database_generator.py")
+    parser.add_argument("name", nargs = "?", help = "print the records of this reference star")
+    parser.add_argument("--text", help = "convert back into the text format and write it to this file")
+    parser.add_argument("--mmap", action = "store_true", help = "memory map the file instead of seeking")
+    args = parser.parse_args()
+
+    db = PlateSolverDb(args.db, use_mmap = args.mmap)
+    print("%u reference stars, %u records, %.6f pixels per degree, sensor %u x %u" % (db.star_cnt, db.rec_cnt, db.pixels_per_degree, db.sensor_width, db.sensor_height))
+    if args.name is not None:
+        recs = db.get_bucket(args.name)
+        if recs is None:
+            print("%s is not in the database" % args.name)
+            db.close()
+            return 1
+        for d, a in recs.tolist():
+            print("    %u , %d" % (d, a))
+    if args.text is not None:
+        s = db.to_text()
+        with open(args.text, "w") as f:
+            f.write(s)
+        print("wrote %u bytes to %s" % (len(s), args.text))
+    db.close()
+    return 0
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+# geometric hash index for blind plate solving
+# a triangle of stars is described by the ratios of its side lengths, these do not change with rotation or scale
+# the database generator writes the index, the matcher here looks up triangles formed by stars in a photo
+# usage: python platesolver_hash.py generic_platesolver_hash_output.txt [stars.txt]
+#        stars.txt has one "x,y" per line, brightest first, without it a simulated self-test is run
+
+import sys, time, random, itertools, argparse
+import numpy as np
+
+SENSOR_WIDTH  = 2592
+SENSOR_HEIGHT = 1944
+SENSOR_DIAGONAL = np.sqrt((SENSOR_WIDTH ** 2) + (SENSOR_HEIGHT ** 2))
+
+GROUP_SIZE      = 10                   # reference star plus this many minus one of the brightest stars around it
+GROUP_RADIUS    = SENSOR_HEIGHT * 0.6  # neighbours further than this are unlikely to be in the same photo
+HASH_STEP       = 0.01                 # bin size of the side ratios
+HASH_BINS       = int(round(1.0 / HASH_STEP)) + 1
+MIN_SIDE_PX     = 60                   # small triangles are too sensitive to centroid errors
+MAX_SIDE_PX     = SENSOR_DIAGONAL
+IMG_STAR_LIMIT  = 12                   # brightest stars from the photo used to form triangles
+MATCH_TOL_PX    = 12
+MATCH_REQUIRED  = 5                    # stars of a group that must land on a star in the photo
+VERIFY_LIMIT    = 20                   # hypotheses with the most votes that get checked against the whole photo
+
+class StarGroup(object):
+    def __init__(self, name, names, xy):
+        self.name = name    # reference star, always first in the list and at (0, 0)
+        self.names = names
+        self.xy = xy        # pixel coordinates relative to the reference star, same projection as the text database
+
+def make_group(name, bucket, group_size = GROUP_SIZE, radius = GROUP_RADIUS):
+    # bucket is a list of (name, dist, ang, bmag) relative to the reference star
+    near = [b for b in bucket if b[1] > 0 and b[1] < radius]
+    near = sorted(near, key = lambda b: b[3])[0:group_size - 1]
+    names = [name] + [b[0] for b in near]
+    xy = [(0.0, 0.0)] + [(b[1] * np.cos(np.radians(b[2])), b[1] * np.sin(np.radians(b[2]))) for b in near]
+    return StarGroup(name, names, np.array(xy, dtype = np.float64))
+
+def triangle_keys(xy, tris):
+    # returns the hash key for each triangle, the vertices reordered so that the first one is opposite of the longest side
+    # and a mask of the triangles that are usable
+    p = xy[tris]                                     # (T, 3, 2)
+    opp = np.stack([np.hypot(*(p[:, 1] - p[:, 2]).T), np.hypot(*(p[:, 0] - p[:, 2]).T), np.hypot(*(p[:, 0] - p[:, 1]).T)], axis = 1)
+    order = np.argsort(-opp, axis = 1, kind = "stable")
+    sides = np.take_along_axis(opp, order, axis = 1)
+    tris = np.take_along_axis(tris, order, axis = 1)
+    longest = np.maximum(sides[:, 0], 1e-9)
+    r1 = sides[:, 1] / longest
+    r2 = sides[:, 2] / longest
+    keys = (np.floor(r1 / HASH_STEP).astype(np.int64) * HASH_BINS) + np.floor(r2 / HASH_STEP).astype(np.int64)
+    ok = (sides[:, 2] >= MIN_SIDE_PX) & (sides[:, 0] <= MAX_SIDE_PX)
+    return keys, tris, ok
+
+def build_index(groups):
+    # every triangle of every group, sorted by key so that lookups are a binary search
+    all_keys = []
+    all_tris = []
+    gi = 0
+    for g in groups:
+        n = len(g.names)
+        if n >= 3:
+            combos = np.array(list(itertools.combinations(range(n), 3)), dtype = np.int64)
+            keys, tris, ok = triangle_keys(g.xy, combos)
+            all_keys.append(keys[ok])
+            all_tris.append(np.column_stack([np.full(np.count_nonzero(ok), gi, dtype = np.int64), tris[ok]]))
+        gi += 1
+    if len(all_keys) <= 0:
+        return np.zeros(0, dtype = np.int64), np.zeros((0, 4), dtype = np.int64)
+    keys = np.concatenate(all_keys)
+    tris = np.concatenate(all_tris)
+    order = np.lexsort((tris[:, 3], tris[:, 2], tris[:, 1], tris[:, 0], keys))
+    return keys[order], tris[order]
+
+def write_index(fname, groups):
+    keys, tris = build_index(groups)
+    fsz = 0
+    with open(fname, "w") as f:
+        lines = ["step|%g|%u\n" % (HASH_STEP, HASH_BINS)]
+        for g in groups:
+            s = "g|" + "|".join(["%s|%0.1f|%0.1f" % (g.names[i], g.xy[i][0], g.xy[i][1]) for i in range(len(g.names))])
+            lines.append(s + "\n")
+        for k, t in zip(keys.tolist(), tris.tolist()):
+            lines.append("t|%u|%u|%u|%u|%u\n" % (k, t[0], t[1], t[2], t[3]))
+        for s in lines:
+            f.write(s)
+            fsz += len(s)
+    return fsz, len(keys)
+
+def read_index(fname):
+    groups = []
+    keys = []
+    tris = []
+    with open(fname, "r") as f:
+        for line in f:
+            split = line.rstrip("\n").split("|")
+            if split[0] == "step":
+                if abs(float(split[1]) - HASH_STEP) > 1e-9 or int(split[2]) != HASH_BINS:
+                    raise ValueError("index was built with a different hash step")
+            elif split[0] == "g":
+                names = split[1::3]
+                xy = np.array([(float(split[i + 1]), float(split[i + 2])) for i in range(1, len(split), 3)], dtype = np.float64)
+                groups.append(StarGroup(names[0], names, xy))
+            elif split[0] == "t":
+                keys.append(int(split[1]))
+                tris.append([int(x) for x in split[2:6]])
+    return groups, np.array(keys, dtype = np.int64), np.array(tris, dtype = np.int64).reshape(-1, 4)
+
+def solve(star_xy, groups, keys, tris, tol = MATCH_TOL_PX, scale_range = (0.5, 2.0), img_star_limit = IMG_STAR_LIMIT, required = MATCH_REQUIRED):
+    # star_xy should be sorted brightest first
+    # returns None if no solution, otherwise a dict describing which group is in view and where
+    star_xy = np.asarray(star_xy, dtype = np.float64).reshape(-1, 2)
+    n = min(len(star_xy), img_star_limit)
+    if n < 3 or len(keys) <= 0:
+        return None
+    combos = np.array(list(itertools.combinations(range(n), 3)), dtype = np.int64)
+    img_keys, img_tris, ok = triangle_keys(star_xy, combos)
+    img_keys = img_keys[ok]
+    img_tris = img_tris[ok]
+    if len(img_keys) <= 0:
+        return None
+
+    # look up the bin and its neighbours, binning errors happen right at the edges
+    cand_img = []
+    cand_cat = []
+    for d1 in (-1, 0, 1):
+        for d2 in (-1, 0, 1):
+            k = img_keys + (d1 * HASH_BINS) + d2
+            lo = np.searchsorted(keys, k, side = "left")
+            hi = np.searchsorted(keys, k, side = "right")
+            cnt = hi - lo
+            total = int(cnt.sum())
+            if total <= 0:
+                continue
+            cand_img.append(np.repeat(np.arange(len(k)), cnt))
+            cand_cat.append(np.repeat(lo - np.cumsum(cnt) + cnt, cnt) + np.arange(total))
+    if len(cand_img) <= 0:
+        return None
+    cand_img = np.concatenate(cand_img)
+    cand_cat = np.concatenate(cand_cat)
+
+    # fit a similarity transform (complex multiply plus offset) from each catalog triangle to each photo triangle
+    group_xy = [g.xy[:, 0] + (1j * g.xy[:, 1]) for g in groups]
+    group_start = np.cumsum([0] + [len(g.names) for g in groups])[:-1]
+    ct = tris[cand_cat]
+    c = np.concatenate(group_xy)[group_start[ct[:, 0]][:, None] + ct[:, 1:]]
+    pz = star_xy[:, 0] + (1j * star_xy[:, 1])
+    p = pz[img_tris[cand_img]]
+    cm = c.mean(axis = 1, keepdims = True)
+    pm = p.mean(axis = 1, keepdims = True)
+    denom = (np.abs(c - cm) ** 2).sum(axis = 1)
+    a = ((p - pm) * np.conj(c - cm)).sum(axis = 1) / np.maximum(denom, 1e-9)
+    b = pm[:, 0] - (a * cm[:, 0])
+    resid = np.abs((a[:, None] * c) + b[:, None] - p).max(axis = 1)
+    scale = np.abs(a)
+    good = (resid <= tol) & (scale >= scale_range[0]) & (scale <= scale_range[1])
+    good_idx = np.flatnonzero(good)
+    if len(good_idx) <= 0:
+        return None
+    good_idx = good_idx[np.argsort(resid[good_idx], kind = "stable")]
+
+    # the right answer is supported by many triangles, so vote on the group and a coarse transform
+    # and only verify the hypotheses with the most votes, best fitting triangle of each
+    sig = np.column_stack([ct[good_idx, 0], np.round(np.degrees(np.angle(a[good_idx])) / 2.0), np.round(b[good_idx].real / tol), np.round(b[good_idx].imag / tol)]).astype(np.int64)
+    _, first, votes = np.unique(sig, axis = 0, return_index = True, return_counts = True)
+    vote_order = np.lexsort((first, -votes))[0:VERIFY_LIMIT]
+
+    # verify against all stars in the photo
+    best = None
+    for vi in vote_order.tolist():
+        ci = int(good_idx[first[vi]])
+        gi = int(ct[ci][0])
+        proj = (a[ci] * group_xy[gi]) + b[ci]
+        d = np.abs(proj[:, None] - pz[None, :])
+        nearest = d.argmin(axis = 1)
+        hit = d[np.arange(len(proj)), nearest] <= tol
+        cnt = int(np.count_nonzero(hit))
+        if best is None or cnt > best["cnt"] or (cnt == best["cnt"] and resid[ci] < best["resid"]):
+            g = groups[gi]
+            best = {"name": g.name, "group": gi, "cnt": cnt, "resid": float(resid[ci]),
+                "x": float(b[ci].real), "y": float(b[ci].imag),
+                "rotation": float(np.degrees(np.angle(a[ci]))), "scale": float(scale[ci]),
+                "matches": [(g.names[i], int(nearest[i])) for i in range(len(g.names)) if hit[i]]}
+    if best is None or best["cnt"] < required:
+        return None
+    return best
+
+def simulate(groups, rng, distractors = 30, noise = 0.7):
+    # places a random group into a virtual photo with random rotation, a small scale error and extra stars
+    g = groups[rng.randrange(len(groups))]
+    rot = np.radians(rng.uniform(-180.0, 180.0))
+    a = rng.uniform(0.97, 1.03) * np.exp(1j * rot)
+    b = complex(rng.uniform(SENSOR_WIDTH * 0.3, SENSOR_WIDTH * 0.7), rng.uniform(SENSOR_HEIGHT * 0.3, SENSOR_HEIGHT * 0.7))
+    z = (a * (g.xy[:, 0] + (1j * g.xy[:, 1]))) + b
+    truth = dict(zip(g.names, z.tolist()))
+    z = z[(z.real >= 0) & (z.real < SENSOR_WIDTH) & (z.imag >= 0) & (z.imag < SENSOR_HEIGHT)]
+    pts = [(v.real + rng.gauss(0, noise), v.imag + rng.gauss(0, noise)) for v in z]
+    extra = [(rng.uniform(0, SENSOR_WIDTH), rng.uniform(0, SENSOR_HEIGHT)) for i in range(distractors)]
+    # real stars are mostly brighter than the junk, but not always
+    stars = pts[0:len(pts) - 2] + extra[0:3] + pts[len(pts) - 2:] + extra[3:]
+    return truth, stars
+
+def main():
+    parser = argparse.ArgumentParser(description = "blind plate solve using the triangle hash index")
+    parser.add_argument("index", help = "index file written by generic_platesolver_database_generator.py")
+    parser.add_argument("stars", nargs = "?", help = "text file with one x,y per line, brightest first")
+    parser.add_argument("-n", "--trials", type = int, default = 100, help = "number of simulated photos for the self-test")
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    groups, keys, tris = read_index(args.index)
+    print("loaded %u groups, %u triangles in %.1f s" % (len(groups), len(keys), time.perf_counter() - t))
+
+    if args.stars is not None:
+        star_xy = []
+        with open(args.stars, "r") as f:
+            for line in f:
+                for item in line.split(";"):
+                    split = item.split(",")
+                    if len(split) >= 2:
+                        star_xy.append((float(split[0]), float(split[1])))
+        t = time.perf_counter()
+        res = solve(star_xy, groups, keys, tris)
+        dt = time.perf_counter() - t
+        if res is None:
+            print("no solution (%.1f ms)" % (dt * 1000.0))
+            return 1
+        print("%s at (%.1f , %.1f), rotation %.1f, scale %.3f, %u matches (%.1f ms)" % (res["name"], res["x"], res["y"], res["rotation"], res["scale"], res["cnt"], dt * 1000.0))
+        for m in res["matches"]:
+            print("    %s -> [%u] (%.1f , %.1f)" % (m[0], m[1], star_xy[m[1]][0], star_xy[m[1]][1]))
+        return 0
+
+    rng = random.Random(0)
+    good = 0
+    t_sum = 0
+    for i in range(args.trials):
+        truth, stars = simulate(groups, rng)
+        t = time.perf_counter()
+        res = solve(stars, groups, keys, tris)
+        t_sum += time.perf_counter() - t
+        # overlapping groups share stars, any of them is a correct answer
+        if res is not None and res["name"] in truth and abs(complex(res["x"], res["y"]) - truth[res["name"]]) < MATCH_TOL_PX:
+            good += 1
+    print("self-test: %u / %u solved, avg %.1f ms" % (good, args.trials, t_sum * 1000.0 / args.trials))
+    return 0
+
+if __name__ == "__main__":
+    main()